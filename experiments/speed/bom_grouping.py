@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright (c) 2024 Salvador E. Tropea
+# Copyright (c) 2024 Instituto Nacional de Tecnología Industrial
+# License: GPL-3.0
+# Project: KiBot (formerly KiPlot)
+"""
+Compares the BoM grouping strategies (pairwise vs hashed, see `fast_grouping`).
+Uses a synthetic list of components, checks both produce the same groups and measures the time.
+
+Usage: bom_grouping.py [COMPONENTS]
+Default: 10000 components
+"""
+import os
+import random
+import sys
+from time import perf_counter
+here = os.path.dirname(os.path.abspath(__file__))
+root = os.path.dirname(os.path.dirname(here))
+sys.path.insert(0, root)
+from kibot import log  # noqa: E402
+log.set_domain('kibot')
+logger = log.init()
+log.set_verbosity(logger, False, True)
+from kibot.bom.bom import create_groups  # noqa: E402
+from kibot.kicad.v5_sch import SchematicComponent, SchematicField  # noqa: E402
+
+# Defaults from out_bom.py (importing it needs the macros)
+GROUP_FIELDS = ['part', 'part lib', 'value', 'footprint', 'footprint lib', 'voltage', 'tolerance', 'current', 'power']
+ALIASES = [['r', 'r_small', 'res', 'resistor'],
+           ['l', 'l_small', 'inductor'],
+           ['c', 'c_small', 'cap', 'capacitor'],
+           ['sw', 'switch'],
+           ['zener', 'zenersmall'],
+           ['d', 'diode', 'd_small']]
+
+PARTS = [('R', 'Device', 'R', ['1k', '1000', '2k2', '2.2k', '10k', '4k7', '100', '47k', '1M', '330']),
+         ('R', 'Device', 'R_Small', ['1k', '10k', '4.7k', '100R']),
+         ('C', 'Device', 'C', ['100n', '0.1u', '10u', '1u', '22p', '4.7u', '100nF']),
+         ('C', 'Device', 'C_Small', ['100n', '1u', '10p']),
+         ('L', 'Device', 'L', ['10u', '4.7u', '1m']),
+         ('D', 'Device', 'D', ['1N4148', '1N4007', 'BAT54']),
+         ('U', 'MCU', 'STM32F103', ['STM32F103C8T6', 'STM32F103RBT6']),
+         ('U', 'Logic', '74HC595', ['74HC595', '74HCT595']),
+         ('J', 'Connector', 'Conn_01x02', ['PWR', 'SIG', 'Conn_01x02']),
+         ('J', 'Connector', 'Conn_01x04', ['I2C', 'UART'])]
+FOOTPRINTS = ['R_0603', 'R_0805', 'C_0603', 'C_0805', 'SOT-23', 'SOIC-16', 'LQFP-48', 'PinHeader_1x02', 'PinHeader_1x04']
+OPTIONAL = {'Voltage': ['', '', '', '16V', '50V'],
+            'Tolerance': ['', '', '', '1%', '5%'],
+            'Current': ['', '', '', '', '1A'],
+            'Power': ['', '', '', '', '0.25W']}
+
+
+class Config(object):
+    """ The BoM options used by the grouping code """
+    def __init__(self, fast_grouping, merge_blank_fields=True, merge_both_blank=True, fallbacks=False):
+        self.fast_grouping = fast_grouping
+        self.debug_level = 0
+        self.group_connectors = True
+        self.merge_blank_fields = merge_blank_fields
+        self.merge_both_blank = merge_both_blank
+        self.parse_value = True
+        self.group_fields = GROUP_FIELDS
+        self.group_fields_fallbacks = [None]*len(self.group_fields)
+        if fallbacks:
+            # Use the Power field if the Voltage is empty
+            self.group_fields_fallbacks[self.group_fields.index('voltage')] = 'power'
+        self.component_aliases = ALIASES
+
+
+def add_field(c, name, value):
+    f = SchematicField()
+    f.name = name
+    f.value = value
+    f.number = len(c.fields)
+    c.add_field(f)
+
+
+def create_components(n, seed=1):
+    rnd = random.Random(seed)
+    comps = []
+    counters = {}
+    for _ in range(n):
+        prefix, lib, name, values = rnd.choice(PARTS)
+        num = counters.get(prefix, 0)+1
+        counters[prefix] = num
+        c = SchematicComponent()
+        c.ref = prefix+str(num)
+        c.ref_prefix = prefix
+        c.ref_suffix = str(num)
+        c.lib = lib
+        c.name = name
+        c.value = rnd.choice(values)
+        c.project = 'bench'
+        c.fitted = rnd.random() > 0.05
+        add_field(c, 'Reference', c.ref)
+        add_field(c, 'Value', c.value)
+        add_field(c, 'Footprint', rnd.choice(FOOTPRINTS))
+        for field, values in OPTIONAL.items():
+            value = rnd.choice(values)
+            if value:
+                add_field(c, field, value)
+        comps.append(c)
+    return comps
+
+
+def measure(comps, **kwargs):
+    start = perf_counter()
+    groups = create_groups(Config(**kwargs), comps)
+    return perf_counter()-start, [[c.ref for c in g.components] for g in groups]
+
+
+def main(n):
+    comps = create_components(n)
+    ok = True
+    for opts in ({}, {'merge_blank_fields': False}, {'merge_blank_fields': False, 'merge_both_blank': False},
+                 {'fallbacks': True}):
+        slow, ref = measure(comps, fast_grouping=False, **opts)
+        fast, res = measure(comps, fast_grouping=True, **opts)
+        same = ref == res
+        ok = ok and same
+        print('{:60} groups: {:5d} pairwise: {:8.3f} s hashed: {:7.3f} s speed-up: {:6.1f} {}'.
+              format(str(opts) if opts else 'default options', len(ref), slow, fast, slow/fast, 'OK' if same else 'DIFFERENT'))
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000))
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright (c) 2024 Salvador E. Tropea
+# Copyright (c) 2024 Instituto Nacional de Tecnología Industrial
+# License: GPL-3.0
+# Project: KiBot (formerly KiPlot)
+"""
+Compares the memory and time needed to copy the schematic components using `deepcopy` (old `expand_fields` and
+`subparts` filter) and using `SchematicComponent.overlay`.
+Each run keeps its copies alive, like outputs running in the same process.
+Also checks that changing the copies doesn't affect the schematic and that both methods give the same result.
+
+Usage: comp_overlay.py [SCHEMATIC] [RUNS]
+Default: tests/board_samples/kicad_6/light_control.kicad_sch and 10 runs
+"""
+from copy import deepcopy
+import os
+import sys
+from time import perf_counter
+import tracemalloc
+here = os.path.dirname(os.path.abspath(__file__))
+root = os.path.dirname(os.path.dirname(here))
+sys.path.insert(0, root)
+from kibot import log  # noqa: E402
+log.set_domain('kibot')
+logger = log.init()
+log.set_verbosity(logger, False, True)
+from kibot.__main__ import detect_kicad  # noqa: E402
+from kibot.config_reader import CfgYamlReader  # noqa: E402
+from kibot.gs import GS  # noqa: E402
+from kibot.kiplot import load_sch, load_actions  # noqa: E402
+
+
+def has_visibility(f):
+    # KiCad 6+ fields could have no effects
+    return getattr(f, 'effects', True) is not None
+
+
+def fields(comps):
+    return [(c.ref, [(f.name, f.value, f.is_visible() if has_visibility(f) else None) for f in c.fields]) for c in comps]
+
+
+def modify(comps):
+    """ Changes applied by the outputs and filters """
+    for c in comps:
+        c.ref = 'X'+c.ref
+        c.fitted = False
+        c.set_field('Value', c.value+' (modified)')
+        c.set_field('New field', 'value')
+        if has_visibility(c.fields[0]):
+            c.fields[0].visible(False)
+    return comps
+
+
+def measure(comps, runs, copy_comps):
+    ori = fields(comps)
+    tracemalloc.start()
+    start = perf_counter()
+    copies = [modify(copy_comps(comps)) for _ in range(runs)]
+    elapsed = perf_counter()-start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert fields(comps) == ori, 'The schematic was modified'
+    return elapsed, peak, fields(copies[0])
+
+
+def main(sch, runs):
+    detect_kicad()
+    load_actions()
+    # Default global options
+    CfgYamlReader()._parse_global({})
+    GS.set_sch(sch)
+    load_sch()
+    comps = GS.sch.get_components()
+    t_deep, m_deep, res_deep = measure(comps, runs, deepcopy)
+    t_over, m_over, res_over = measure(comps, runs, lambda comps: [c.overlay() for c in comps])
+    same = res_deep == res_over
+    print('{} components, {} runs'.format(len(comps), runs))
+    print('deepcopy: {:8.3f} s {:10.1f} KiB'.format(t_deep, m_deep/1024))
+    print('overlay:  {:8.3f} s {:10.1f} KiB'.format(t_over, m_over/1024))
+    print('speed-up: {:6.1f} memory: {:6.1f} times less {}'.format(t_deep/t_over, m_deep/m_over,
+                                                                   'OK' if same else 'DIFFERENT'))
+    return 0 if same else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1] if len(sys.argv) > 1 else os.path.join(root, 'tests', 'board_samples', 'kicad_6',
+                                                                     'light_control.kicad_sch'),
+                  int(sys.argv[2]) if len(sys.argv) > 2 else 10))
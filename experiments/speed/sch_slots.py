@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright (c) 2024 Salvador E. Tropea
+# Copyright (c) 2024 Instituto Nacional de Tecnología Industrial
+# License: GPL-3.0
+# Project: KiBot (formerly KiPlot)
+"""
+Measures the memory used by the loaded schematics, the time to load them and the time to access the component
+attributes and fields, like the filters and the BoM do.
+Used to compare the `__slots__` version of the schematic classes against the old one, i.e.:
+
+$ git worktree add /tmp/kibot_base COMMIT_BEFORE_THE_CHANGE
+$ experiments/speed/sch_slots.py --base /tmp/kibot_base
+
+Usage: sch_slots.py [--base KIBOT_TREE] [RUNS] [SCHEMATIC...]
+Default: all the schematics in tests/board_samples/kicad_6 and 200 runs
+"""
+from glob import glob
+import json
+import os
+import subprocess
+import sys
+from time import perf_counter
+import tracemalloc
+here = os.path.dirname(os.path.abspath(__file__))
+root = os.path.dirname(os.path.dirname(here))
+
+
+def access(comps):
+    """ Typical accesses from the filters and the BoM """
+    n = 0
+    for c in comps:
+        if c.fitted and c.included and not c.is_power and c.ref_prefix and c.value and c.footprint is not None:
+            n += 1
+        for f in c.fields:
+            if f.number > 3 and f.name and f.value:
+                n += 1
+        if c.get_field_value('mpn') or c.get_field_value('Manf#') or c.get_field_value('config'):
+            n += 1
+    return n
+
+
+def measure(tree, runs, files):
+    """ Measures using the KiBot code from `tree` """
+    sys.path.insert(0, tree)
+    from kibot import log
+    log.set_domain('kibot')
+    logger = log.init()
+    log.set_verbosity(logger, False, True)
+    from kibot.__main__ import detect_kicad
+    from kibot.config_reader import CfgYamlReader
+    from kibot.gs import GS
+    from kibot.kiplot import load_any_sch, load_actions
+    detect_kicad()
+    load_actions()
+    # Default global options
+    CfgYamlReader()._parse_global({})
+    GS.global_cache_sch = False
+    tracemalloc.start()
+    start = perf_counter()
+    schs = []
+    for f in files:
+        try:
+            schs.append(load_any_sch(f, os.path.splitext(os.path.basename(f))[0]))
+        except SystemExit:
+            # Test schematics with errors
+            pass
+    t_load = perf_counter()-start
+    mem, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    comps = [c for sch in schs for c in sch.get_components()]
+    start = perf_counter()
+    for _ in range(runs):
+        access(comps)
+    t_access = perf_counter()-start
+    return {'schematics': len(schs), 'components': len(comps), 'memory': mem, 'load': t_load, 'access': t_access}
+
+
+def main(args):
+    base = None
+    if args and args[0] == '--base':
+        base = os.path.abspath(args[1])
+        args = args[2:]
+    if args and args[0] == '--measure':
+        # Internal use: measure in a separated process
+        print(json.dumps(measure(args[1], int(args[2]), args[3:])))
+        return 0
+    runs = int(args[0]) if args else 200
+    files = args[1:] or sorted(glob(os.path.join(root, 'tests', 'board_samples', 'kicad_6', '*.kicad_sch')))
+    trees = [('current', root)]
+    if base:
+        trees.insert(0, ('base', base))
+    res = []
+    for name, tree in trees:
+        out = subprocess.run([sys.executable, __file__, '--measure', tree, str(runs)]+files, stdout=subprocess.PIPE,
+                             stderr=subprocess.DEVNULL, check=True, text=True).stdout
+        r = json.loads(out)
+        res.append(r)
+        print('{:8}: {} schematics, {} components'.format(name, r['schematics'], r['components']))
+        print('          memory {:10.1f} KiB  load {:7.3f} s  access ({} runs) {:7.3f} s'.
+              format(r['memory']/1024, r['load'], runs, r['access']))
+    if base:
+        b, c = res
+        print('memory: {:5.2f} times less, load: {:5.2f} times faster, access: {:5.2f} times faster'.
+              format(b['memory']/c['memory'], b['load']/c['load'], b['access']/c['access']))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
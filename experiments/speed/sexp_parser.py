@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright (c) 2024 Salvador E. Tropea
+# Copyright (c) 2024 Instituto Nacional de Tecnología Industrial
+# License: GPL-3.0
+# Project: KiBot (formerly KiPlot)
+"""
+Compares the S-expression parsers (Parser vs FastParser).
+Checks both produce the same tree and measures the time.
+
+Usage: sexp_parser.py [FILE...]
+Default: all the KiCad 6+ files in tests/board_samples
+"""
+from glob import glob
+import os
+import sys
+from time import perf_counter
+here = os.path.dirname(os.path.abspath(__file__))
+root = os.path.dirname(os.path.dirname(here))
+sys.path.insert(0, root)
+from kibot.kicad.sexpdata import Parser, FastParser  # noqa: E402
+
+
+def measure(cls, text, times):
+    best = None
+    for _ in range(times):
+        start = perf_counter()
+        res = cls(text).parse()
+        elapsed = perf_counter()-start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, res
+
+
+def main(files):
+    if not files:
+        files = []
+        for ver in ('kicad_6', 'kicad_7', 'kicad_8'):
+            for ext in ('kicad_pcb', 'kicad_sch', 'kicad_sym', 'kicad_wks'):
+                files += glob(os.path.join(root, 'tests', 'board_samples', ver, '*.'+ext))
+    total_slow = total_fast = 0
+    ok = True
+    for f in sorted(files):
+        with open(f, 'rt') as fh:
+            text = fh.read()
+        times = 1 if len(text) > 2000000 else 3
+        slow, ref = measure(Parser, text, times)
+        fast, res = measure(FastParser, text, times)
+        same = ref == res
+        ok = ok and same
+        total_slow += slow
+        total_fast += fast
+        print(f'{os.path.basename(f):50} {len(text)/1e6:7.2f} MB {slow:8.4f} s {fast:8.4f} s {slow/fast:6.2f}x'
+              f'{"" if same else "  DIFFERENT!"}')
+    if total_fast:
+        print(f'Total: {total_slow:.3f} s vs {total_fast:.3f} s ({total_slow/total_fast:.2f}x)')
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
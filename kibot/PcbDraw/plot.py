@@ -19,6 +19,7 @@ from .unit import read_resistance
 from lxml import etree, objectify # type: ignore
 from .pcbnew_transition import KICAD_VERSION, isV6, isV7, pcbnew # type: ignore
 from ..gs import GS
+from .. import plot_cache
 
 T = TypeVar("T")
 Numeric = Union[int, float]
@@ -1248,15 +1249,9 @@ class PcbPlotter():
             for action in to_plot:
                 if len(action.layers) == 0:
                     continue
-                # Set the filename before opening the file as KiCAD 6.0.8
-                # requires it even for the SVG format
-                pctl.SetLayer(action.layers[0])
-                pctl.OpenPlotfile(action.name, pcbnew.PLOT_FORMAT_SVG, action.name)
-                for l in action.layers:
-                    pctl.SetColorMode(False)
-                    pctl.SetLayer(l)
-                    pctl.PlotLayer()
-            pctl.ClosePlot()
+                # KiBot: reuse the layers already plotted in this run
+                plot_cache.plot_layers(pctl, action.layers, action.name, pcbnew.PLOT_FORMAT_SVG, action.name,
+                                       board=self.board, color_mode=False)
             for action in to_plot:
                 for svg_file in os.listdir(tmp):
                     if svg_file.endswith(f"-{action.name}.svg"):
@@ -11,7 +11,7 @@ Usage:
   kibot [-b BOARD] [-e SCHEMA] [-c CONFIG] [-d OUT_DIR] [-s PRE]
          [-q | -v...] [-L LOGFILE] [-C | -i | -n] [-m MKFILE] [-A] [-g DEF] ...
          [-E DEF] ... [--defs-from-env] [-w LIST] [-D | -W] [--banner N]
-         [TARGET...]
+         [-j JOBS] [--no-macro-cache] [--worker SOCKET] [TARGET...]
   kibot [-v...] [-b BOARD] [-e SCHEMA] [-c PLOT_CONFIG] [--banner N]
          [-E DEF] ... [--defs-from-env] [--config-outs]
          [--only-pre|--only-groups] [--only-names] [--output-name-first] --list
@@ -53,6 +53,11 @@ Options:
   -E DEF, --define DEF             Define preprocessor value (VAR=VAL)
   -g DEF, --global-redef DEF       Overwrite a global value (VAR=VAL)
   -i, --invert-sel                 Generate the outputs not listed as targets
+  -j JOBS, --jobs JOBS             Generate up to JOBS outputs in parallel.
+                                   Outputs wait for the ones generating the
+                                   files they need and the ones with more
+                                   priority.
+                                   Use 0 for the number of CPUs [default: 1]
   -l, --list                       List available outputs, preflights and
                                    groups (in the config file).
                                    You don't need to specify an SCH/PCB unless
@@ -61,6 +66,8 @@ Options:
   -L, --log LOGFILE                Log to LOGFILE using maximum debug level.
                                    Is independent of what is logged to stderr
   -m MKFILE, --makefile MKFILE     Generate a Makefile (no targets created)
+  --no-macro-cache                 Don't cache the code after expanding the
+                                   macros of the internal plug-ins
   -n, --no-priority                Don't sort targets by priority
   -p, --copy-options               Copy plot options from the PCB file
   --only-names                     Print only the names. Note that for --list
@@ -75,6 +82,9 @@ Options:
   -v, --verbose                    Show debugging information
   -V, --version                    Show program's version number and exit
   -w, --no-warn LIST               Exclude the mentioned warnings (comma sep)
+  --worker SOCKET                  Run in background, generating the outputs
+                                   requested by the Makefile (-m) using the
+                                   SOCKET Unix socket
   -W, --stop-on-warnings           Stop on warnings
   -x, --example                    Create a template configuration file
 
@@ -139,6 +149,7 @@ from .config_reader import (CfgYamlReader, print_outputs_help, print_output_help
                             print_errors, print_list_rotations, print_list_offsets)
 from .kiplot import (generate_outputs, load_actions, config_output, generate_makefile, generate_examples, solve_schematic,
                      solve_board_file, solve_project_file, check_board_file)
+from .worker import run_worker
 from .registrable import RegOutput
 GS.kibot_version = __version__
 
@@ -360,6 +371,16 @@ def parse_global_redef(args):
         GS.cli_global_defs[var] = redef[len(var)+1:]
 
 
+def parse_jobs(args):
+    try:
+        jobs = int(args.jobs)
+    except ValueError:
+        jobs = -1
+    if jobs < 0:
+        GS.exit_with_error(f'-j/--jobs must be a positive integer or 0 ({args.jobs})', EXIT_BAD_ARGS)
+    return jobs
+
+
 class SimpleFilter(object):
     def __init__(self, num):
         self.number = num
@@ -429,7 +450,7 @@ def main():
     GS.out_dir = os.path.join(os.getcwd(), args.out_dir)
 
     # Load output and preflight plugins
-    load_actions()
+    load_actions(macro_cache=not args.no_macro_cache)
 
     if args.banner is not None:
         try:
@@ -528,11 +549,14 @@ def main():
 
     if args.makefile:
         # Only create a makefile
-        generate_makefile(args.makefile, plot_config, outputs)
+        generate_makefile(args.makefile, plot_config, outputs, imports=cr.imported_files)
+    elif args.worker:
+        # Persistent process used by the Makefile
+        run_worker(args.worker, [plot_config]+cr.imported_files, outputs, args.skip_pre, args.dont_stop)
     else:
         # Do all the job (preflight + outputs)
         generate_outputs(outputs, args.target, args.invert_sel, args.skip_pre, args.cli_order, args.no_priority,
-                         dont_stop=args.dont_stop)
+                         dont_stop=args.dont_stop, jobs=parse_jobs(args))
     # Print total warnings
     logger.log_totals()
 
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2024 Salvador E. Tropea
+# Copyright (c) 2024 Instituto Nacional de Tecnología Industrial
+# License: GPL-3.0
+# Project: KiBot (formerly KiPlot)
+"""
+Run-scoped snapshot of the board geometry.
+Outputs like `report`, `position`, `bom`, `copy_files` and the 3D outputs read the same data from the footprints, pads,
+tracks and vias of the board, crossing the SWIG boundary for each value.
+Here we read each value only once for each board state, the key is computed using:
+- The board (object and revision, see plot_cache)
+- The filter/variant applied to the board (see plot_cache)
+The data is stored in columns, one list for each attribute. When NumPy is available the numeric columns can be
+obtained as arrays using `Table.array`.
+The tables are created on demand, i.e. the pads are read only when an output needs them.
+"""
+from .gs import GS
+from . import plot_cache
+from . import log
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+logger = log.get_logger()
+# key -> BoardSnapshot
+cache = {}
+hits = 0
+
+
+class Table(object):
+    """ Columns of data, the same index is used for all the columns """
+    def __init__(self, columns):
+        self.columns = columns
+        for c in columns:
+            setattr(self, c, [])
+        self._arrays = {}
+
+    def __len__(self):
+        return len(getattr(self, self.columns[0]))
+
+    def array(self, column):
+        """ The column as a NumPy array, or the list if NumPy isn't available """
+        if np is None:
+            return getattr(self, column)
+        a = self._arrays.get(column)
+        if a is None:
+            a = self._arrays[column] = np.array(getattr(self, column))
+        return a
+
+
+class BoardSnapshot(object):
+    """ The footprints, pads, tracks and vias of a board """
+    def __init__(self, board):
+        self.board = board
+        self._footprints = None
+        self._pads = None
+        self._tracks = None
+        self._vias = None
+
+    @property
+    def footprints(self):
+        """ Footprint objects (`fp`), reference, value, library nickname, footprint name (`package`), layer, attributes,
+            flipped, rotation (degrees), center (`x`, `y`) and size of the pads area (`w`, `h`) """
+        if self._footprints is None:
+            self._footprints = t = Table(('fp', 'ref', 'value', 'lib_nickname', 'package', 'layer', 'attrs', 'flipped',
+                                          'rot', 'x', 'y', 'w', 'h'))
+            for m in GS.get_modules_board(self.board):
+                t.fp.append(m)
+                t.ref.append(m.GetReference())
+                t.value.append(m.GetValue())
+                lib_id = m.GetFPID()
+                t.lib_nickname.append(str(lib_id.GetLibNickname()))
+                t.package.append(str(lib_id.GetLibItemName()))  # pcbnew.UTF8 type
+                t.layer.append(m.GetLayer())
+                t.attrs.append(m.GetAttributes())
+                t.flipped.append(m.IsFlipped())
+                t.rot.append(m.GetOrientationDegrees())
+                center = GS.get_center(m)
+                t.x.append(center.x)
+                t.y.append(center.y)
+                w, h = GS.get_fp_size(m)
+                t.w.append(w)
+                t.h.append(h)
+            logger.debugl(2, f'- Board snapshot: {len(t)} footprints')
+        return self._footprints
+
+    @property
+    def pads(self):
+        """ Pads with a drill: pad objects (`pad`), index of the footprint (`fp`), attribute (`attrib`),
+            drill (`drill_x`, `drill_y`) and size (`size_x`, `size_y`) """
+        if self._pads is None:
+            self._pads = t = Table(('pad', 'fp', 'attrib', 'drill_x', 'drill_y', 'size_x', 'size_y'))
+            for n, m in enumerate(self.footprints.fp):
+                for pad in m.Pads():
+                    dr = pad.GetDrillSize()
+                    if not dr.x:
+                        continue
+                    t.pad.append(pad)
+                    t.fp.append(n)
+                    t.attrib.append(pad.GetAttribute())
+                    t.drill_x.append(dr.x)
+                    t.drill_y.append(dr.y)
+                    size = pad.GetSize()
+                    t.size_x.append(size.x)
+                    t.size_y.append(size.y)
+            logger.debugl(2, f'- Board snapshot: {len(t)} drilled pads')
+        return self._pads
+
+    def _get_tracks_and_vias(self):
+        self._tracks = tracks = Table(('width',))
+        self._vias = vias = Table(('drill', 'width', 'type'))
+        track_type = 'TRACK' if GS.ki5 else 'PCB_TRACK'
+        via_type = 'VIA' if GS.ki5 else 'PCB_VIA'
+        for t in self.board.GetTracks():
+            tclass = t.GetClass()
+            if tclass == track_type:
+                tracks.width.append(t.GetWidth())
+            elif tclass == via_type:
+                via = t.Cast()
+                vias.drill.append(via.GetDrill())
+                vias.width.append(via.GetWidth())
+                vias.type.append(via.GetViaType())
+        logger.debugl(2, f'- Board snapshot: {len(tracks)} tracks and {len(vias)} vias')
+
+    @property
+    def tracks(self):
+        """ Straight tracks: width """
+        if self._tracks is None:
+            self._get_tracks_and_vias()
+        return self._tracks
+
+    @property
+    def vias(self):
+        """ Vias: drill, width (pad size) and type (VIATYPE_*) """
+        if self._vias is None:
+            self._get_tracks_and_vias()
+        return self._vias
+
+
+def get(board=None):
+    """ Returns the snapshot for the current state of the board """
+    global hits
+    if board is None:
+        board = GS.board
+    if not GS.global_cache_board_snapshot:
+        return BoardSnapshot(board)
+    # The snapshot keeps a reference to the board, so its id remains valid
+    key = (id(board), plot_cache.revision, plot_cache.board_filter)
+    snapshot = cache.get(key)
+    if snapshot is None:
+        snapshot = cache[key] = BoardSnapshot(board)
+    else:
+        hits += 1
+    return snapshot
+
+
+def clear():
+    """ Discards all the snapshots """
+    global hits
+    if cache:
+        logger.debug(f'Board snapshots cache: {len(cache)} snapshots, reused {hits} times')
+    cache.clear()
+    hits = 0
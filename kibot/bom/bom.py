@@ -11,8 +11,9 @@ All the logic to convert a list of components into the rows and columns used to
 """
 import locale
 from copy import deepcopy
+from itertools import product
 from math import ceil
-from .units import compare_values, comp_match
+from .units import compare_values, comp_match, log_cache_stats
 from .bom_writer import write_bom
 from .columnlist import ColumnList
 from ..misc import DNF, W_FIELDCONF, W_MISSFPINFO
@@ -156,6 +157,115 @@ class Joiner:
         return refstr
 
 
+# Key used for blank fields merged with any value
+WILD = ('*',)
+
+
+class GroupsIndex(object):
+    """ Finds the group for a component using hashes of the grouping fields.
+        Gives the same result as testing the groups, in order, using `compare_components`.
+        Each field has a list of keys, two components match when they share a key for all the fields.
+        Blank fields that can be merged with anything are indexed as WILD. Components that can't be
+        hashed (empty fields with fallbacks) are compared one by one. """
+    def __init__(self, cfg):
+        self.cfg = cfg
+        self.groups = []
+        # Keys for the first component of each group, None for the ones we can't hash
+        self.keys = []
+        # One index for each set of fields ignored because the component has them blank
+        self.indexes = {}
+        # Fields where some group has a blank value
+        self.wild = set()
+        # Groups that must be compared one by one
+        self.special = []
+
+    def field_keys(self, c, field, field_alt):
+        """ Keys for a field of a component, None if it can't be hashed """
+        cfg = self.cfg
+        if field_alt is not None and c.get_field_value(field) == '':
+            # The field used depends on the other component
+            return None
+        if field == ColumnList.COL_VALUE_L:
+            value = c.value.strip().lower()
+            if value == '~':
+                value = ''
+            keys = [('s', value)]
+            if c.value_sort:
+                keys.append(('p', str(c.value_sort)))
+            if cfg.group_connectors and 'connector' in c.lib.lower():
+                # All the connectors share this key
+                keys.append(('c',))
+            return keys
+        if field == ColumnList.COL_PART_L:
+            pn = c.name.lower()
+            return [('n', pn)]+[('a', n) for n, alias in enumerate(cfg.component_aliases) if pn in alias]
+        value = c.get_field_value(field).lower()
+        if value == '':
+            if cfg.merge_blank_fields:
+                return [WILD]
+            if not cfg.merge_both_blank:
+                # Never matches
+                return [('u', id(c))]
+        return [('f', value)]
+
+    def component_keys(self, c):
+        """ Keys for all the fields of a component, None if it can't be hashed """
+        keys = [[(c.fitted, c.fixed)]]
+        if len(self.cfg.group_fields) == 0:
+            keys.append([c.ref])
+            return keys
+        for field, field_alt in zip(self.cfg.group_fields, self.cfg.group_fields_fallbacks):
+            k = self.field_keys(c, field, field_alt)
+            if k is None:
+                return None
+            keys.append(k)
+        return keys
+
+    @staticmethod
+    def add_to_index(index, mask, keys, n):
+        for k in product(*(k for i, k in enumerate(keys) if i not in mask)):
+            index.setdefault(k, n)
+
+    def find(self, c, keys):
+        """ Returns the first group that matches the component """
+        if keys is None:
+            return next((g for g in self.groups if g.match_component(c)), None)
+        # Fields where the component is blank match any value
+        mask = frozenset(i for i, k in enumerate(keys) if k[0] is WILD)
+        index = self.indexes.get(mask)
+        if index is None:
+            index = self.indexes[mask] = {}
+            for n, g_keys in enumerate(self.keys):
+                if g_keys is not None:
+                    self.add_to_index(index, mask, g_keys, n)
+        options = (k+[WILD] if i in self.wild else k for i, k in enumerate(keys) if i not in mask)
+        best = None
+        for k in product(*options):
+            n = index.get(k)
+            if n is not None and (best is None or n < best):
+                best = n
+        # Check the groups we can't hash
+        for n, g in self.special:
+            if best is not None and n > best:
+                break
+            if g.match_component(c):
+                best = n
+                break
+        return None if best is None else self.groups[best]
+
+    def add(self, g, keys):
+        """ Adds a new group, `keys` are the keys of its first component """
+        n = len(self.groups)
+        self.groups.append(g)
+        self.keys.append(keys)
+        if keys is None:
+            self.special.append((n, g))
+            return
+        for mask, index in self.indexes.items():
+            self.add_to_index(index, mask, keys, n)
+        self.wild.update(i for i, k in enumerate(keys) if k[0] is WILD)
+
+
 def _suffix_to_num(suffix):
     return 0 if suffix == '?' else int(suffix)
 
@@ -424,8 +534,10 @@ def compute_multiple_stats(cfg, groups):
                          format(sch.name, sch.comp_total, sch.comp_fitted, sch.comp_build))
 
 
-def group_components(cfg, components):
+def create_groups(cfg, components):
+    """ Classifies the components in groups, each group is a row in the BoM """
     groups = []
+    index = GroupsIndex(cfg) if cfg.fast_grouping else None
     # Iterate through each component, and test whether a group for these already exists
     for c in components:
         if not c.included:  # Skip components marked as excluded from BoM
@@ -436,6 +548,15 @@ def group_components(cfg, components):
         else:
             c.value_sort = None
         # Try to add the component to an existing group
+        if index is not None:
+            keys = index.component_keys(c)
+            g = index.find(c, keys)
+            if g is None:
+                # Create a new group
+                g = ComponentGroup(cfg)
+                index.add(g, keys)
+            g.add_component(c)
+            continue
         found = False
         for g in groups:
             if g.match_component(c):
@@ -447,6 +568,13 @@ def group_components(cfg, components):
             g = ComponentGroup(cfg)
             g.add_component(c)
             groups.append(g)
+    if cfg.debug_level > 1:
+        log_cache_stats()
+    return groups if index is None else index.groups
+
+
+def group_components(cfg, components):
+    groups = create_groups(cfg, components)
     # Now unify the data from the components of each group
     decimal_point = None
     if cfg.normalize_locale:
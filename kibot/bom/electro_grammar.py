@@ -5,6 +5,7 @@
 # Project: KiBot (formerly KiPlot)
 
 from decimal import Decimal
+from functools import lru_cache
 from lark import Lark, Transformer
 import os
 from ..gs import GS
@@ -201,7 +202,9 @@ def initialize():
     parser = Lark(g, start='main')  # , debug=DEBUG)
 
 
+@lru_cache(maxsize=4096)
 def parse(text, with_extra=False, stronger=False):
+    """ Parses a component description. The results are cached, don't modify them """
     initialize()
     if stronger:
         text = text.replace('+/-', ' +/-')
@@ -14,12 +14,14 @@ e.g.
 Oriented to normalize and sort R, L and C values.
 """
 from decimal import Decimal
+from functools import lru_cache
 import re
 import locale
 from math import log10
 from .. import log
 from ..misc import W_BADVAL1, W_BADVAL2, W_BADVAL3, W_BADVAL4, W_EXTRAINVAL
 from .electro_grammar import parse
+from . import electro_grammar
 
 logger = log.get_logger()
 
@@ -51,8 +53,8 @@ GRAM_TYPES = {'inductor': 'L', 'capacitor': 'C', 'resistor': 'R', 'led': ''}
 match = None
 # Current locale decimal point value
 decimal_point = None
-# Parser cache
-parser_cache = {}
+# Size of the cache for the parsed values
+PARSER_CACHE_SIZE = 8192
 # Flag to indicate we already warned about extra data
 warn_extra_issued = False
 
@@ -174,16 +176,17 @@ def check_extra_data(r, v):
         warn_extra_issued = True
 
 
-def comp_match(component, ref_prefix, ref=None, relax_severity=False, stronger=False, warn_extra=False):
+@lru_cache(maxsize=PARSER_CACHE_SIZE)
+def parse_value(component, ref_prefix, stronger=False):
     """
     Return a normalized value and units for a given component value string
     Also tries to separate extra data, i.e. tolerance, using a complex parser
+    The results are cached, so we don't report anything here. We return:
+    - The parsed value (or None)
+    - The data from the complex parser (if used)
+    - A message describing the problems found, without the closing parenthesis
     """
     original = component
-    global parser_cache
-    parsed = parser_cache.get(original+ref_prefix)
-    if parsed:
-        return parsed
     # Remove useless spaces
     component = component.strip()
     # ~ is the same as empty for KiCad
@@ -210,8 +213,6 @@ def comp_match(component, ref_prefix, ref=None, relax_severity=False, stronger=F
         # Ignore case
         match = re.compile(match_string(), flags=re.IGNORECASE)
 
-    log_func_warn = logger.debug if relax_severity else logger.warning
-    where = ' in {}'.format(ref) if ref is not None else ''
     result = match.match(component)
     if not result:
         # This is used to parse things like "1/8 W", but we get "1/8" here
@@ -219,31 +220,21 @@ def comp_match(component, ref_prefix, ref=None, relax_severity=False, stronger=F
         if result:
             val = int(result.group(1))/int(result.group(2))
             val, pow = get_prefix(val, '')
-            parsed = ParsedValue(val, pow, get_unit('', ref_prefix))
-            # Cache the result
-            parser_cache[original+ref_prefix] = parsed
-            return parsed
+            return ParsedValue(val, pow, get_unit('', ref_prefix)), None, None
     if not result:
         # Failed with the regex, try with the parser
-        result = parse(ref_prefix[0]+' '+with_commas, with_extra=True, stronger=stronger)
-        if result:
-            if warn_extra:
-                check_extra_data(result, original)
-            result = value_from_grammar(result)
-            if result and result.get_extra('discarded'):
-                discarded = " ".join(('`'+x+'`' for x in result.get_extra('discarded')))
-                log_func_warn(W_BADVAL4+"Malformed value: `{}` (discarded: {}{})".format(original, discarded, where))
+        r = parse(ref_prefix[0]+' '+with_commas, with_extra=True, stronger=stronger)
+        result = value_from_grammar(r) if r else None
         if not result:
-            log_func_warn(W_BADVAL1+"Malformed value: `{}` (no match{})".format(original, where))
-            return None
-        # Cache the result
-        parser_cache[original+ref_prefix] = result
-        return result
+            return None, r, W_BADVAL1+"Malformed value: `{}` (no match".format(original)
+        if result.get_extra('discarded'):
+            discarded = " ".join(('`'+x+'`' for x in result.get_extra('discarded')))
+            return result, r, W_BADVAL4+"Malformed value: `{}` (discarded: {}".format(original, discarded)
+        return result, r, None
 
     value, prefix, units, post = result.groups()
     if value == '.':
-        log_func_warn(W_BADVAL2+"Malformed value: `{}` (reduced to decimal point{})".format(original, where))
-        return None
+        return None, None, W_BADVAL2+"Malformed value: `{}` (reduced to decimal point".format(original)
     if value == '':
         value = '0'
 
@@ -253,8 +244,7 @@ def comp_match(component, ref_prefix, ref=None, relax_severity=False, stronger=F
     # We will also have a trailing number
     if post:
         if "." in value:
-            log_func_warn(W_BADVAL3+"Malformed value: `{}` (unit split, but contains decimal point{})".format(original, where))
-            return None
+            return None, None, W_BADVAL3+"Malformed value: `{}` (unit split, but contains decimal point".format(original)
         value = float(value)
         postValue = float(post)/(10**len(post))
         val = value*1.0+postValue
@@ -263,12 +253,33 @@ def comp_match(component, ref_prefix, ref=None, relax_severity=False, stronger=F
 
     # Create an object with the result
     val, pow = get_prefix(val, prefix)
-    parsed = ParsedValue(val, pow, get_unit(units, ref_prefix))
-    # Cache the result
-    parser_cache[original+ref_prefix] = parsed
+    return ParsedValue(val, pow, get_unit(units, ref_prefix)), None, None
+
+
+def comp_match(component, ref_prefix, ref=None, relax_severity=False, stronger=False, warn_extra=False):
+    """
+    Return a normalized value and units for a given component value string
+    Also tries to separate extra data, i.e. tolerance, using a complex parser
+    Note: the returned object is shared by all the components with the same value, don't modify it
+    """
+    parsed, r, error = parse_value(component, ref_prefix, stronger)
+    if r and warn_extra:
+        check_extra_data(r, component)
+    if error:
+        log_func_warn = logger.debug if relax_severity else logger.warning
+        where = ' in {}'.format(ref) if ref is not None else ''
+        log_func_warn(error+where+')')
     return parsed
 
 
+def log_cache_stats():
+    """ Debug information about the cache used for the parsed values """
+    for name, func in (('Values', parse_value), ('Complex values', electro_grammar.parse)):
+        info = func.cache_info()
+        logger.debug('{} parser cache: {} hits, {} misses ({}/{} entries)'.
+                     format(name, info.hits, info.misses, info.currsize, info.maxsize))
+
+
 def compare_values(c1, c2):
     """ Compare two values """
     # These are the results from comp_match()
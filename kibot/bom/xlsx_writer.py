@@ -21,6 +21,7 @@ from .kibot_logo import KIBOT_LOGO
 from .. import log
 from ..misc import W_NOKICOST, W_UNKDIST, KICOST_ERROR, W_BADFIELD
 from ..gs import GS
+from ..kicad.v5_sch import get_attrs
 from .. import __version__
 # Init the logger first
 logger = log.get_logger()
@@ -582,7 +583,7 @@ def _create_kicost_sheet(workbook, groups, image_data, fmt_title, fmt_info, fmt_
             logger.debug(pprint.pformat(g.__dict__))
             logger.debug("-- Components")
             for c in g.components:
-                logger.debug(pprint.pformat(c.__dict__))
+                logger.debug(pprint.pformat(get_attrs(c)))
     # Force KiCost to use our logger
     init_all_loggers(log.get_logger('kicost', indent=1), log.get_logger('kicost.dist', indent=1),
                      log.get_logger('kicost.eda', indent=1))
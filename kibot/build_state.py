@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2024 Salvador E. Tropea
+# Copyright (c) 2024 Instituto Nacional de Tecnología Industrial
+# License: GPL-3.0
+# Project: KiBot (formerly KiPlot)
+"""
+Build state, used to skip the outputs that doesn't need to be generated again (`incremental` global option).
+The state is stored in the output dir, for each output we keep its targets and a fingerprint of its inputs:
+- The PCB, schematic, project and dependencies content (hashes)
+- The files mentioned in the output options (hashes)
+- The output options tree, the global options, the preflights, filters and variants
+- The KiBot, KiCad and tools versions
+An output is skipped when the fingerprint matches and all its targets are present.
+"""
+from hashlib import sha1
+import json
+import os
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, the state isn't locked
+    fcntl = None
+from .gs import GS
+from .registrable import RegOutput
+from .pre_base import BasePreFlight
+from . import log, __version__
+
+logger = log.get_logger()
+STATE_FILE = '.kibot_state.json'
+STATE_VERSION = 1
+# Size of the blocks used to compute the hashes
+HASH_CHUNK = 1 << 20
+# Name -> {'fingerprint': str, 'targets': list}
+state = None
+# Entries updated in this run
+updates = {}
+# Path -> ((size, mtime), hash)
+file_hashes = {}
+# Dependency name -> version
+tool_versions = {}
+
+
+def _state_file():
+    return os.path.join(GS.out_dir, STATE_FILE)
+
+
+def _read_state():
+    fname = _state_file()
+    if not os.path.isfile(fname):
+        return {}
+    try:
+        with open(fname, 'rt') as f:
+            data = json.load(f)
+    except (OSError, ValueError) as e:
+        logger.debug(f'Discarding the build state `{fname}`: {e}')
+        return {}
+    if data.get('version') == STATE_VERSION:
+        return data.get('outputs', {})
+    return {}
+
+
+def load():
+    global state
+    if state is None:
+        state = _read_state()
+    return state
+
+
+def save():
+    """ Stores the entries updated in this run """
+    global state
+    if not updates:
+        return
+    fname = _state_file()
+    tmp_name = fname+'.'+str(os.getpid())
+    try:
+        os.makedirs(GS.out_dir, exist_ok=True)
+        # Other processes could be updating the file (i.e. the Makefile worker), so we merge with its current content
+        with open(fname+'.lock', 'a') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            state = _read_state()
+            state.update(updates)
+            with open(tmp_name, 'wt') as f:
+                json.dump({'version': STATE_VERSION, 'outputs': state}, f, indent=1, sort_keys=True)
+            os.replace(tmp_name, fname)
+    except OSError as e:
+        logger.non_critical_error(f'Unable to save the build state to `{fname}`: {e}')
+    updates.clear()
+
+
+def hash_file(fname):
+    try:
+        st = os.stat(fname)
+    except OSError:
+        return None
+    stamp = (st.st_size, st.st_mtime_ns)
+    cached = file_hashes.get(fname)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+    h = sha1()
+    with open(fname, 'rb') as f:
+        while True:
+            chunk = f.read(HASH_CHUNK)
+            if not chunk:
+                break
+            h.update(chunk)
+    res = h.hexdigest()
+    file_hashes[fname] = (stamp, res)
+    return res
+
+
+def _plain(v):
+    """ Converts the configuration data to something we can dump to JSON in a stable way """
+    if v is None or isinstance(v, (bool, int, float, str)):
+        return v
+    if isinstance(v, dict):
+        return {str(k): _plain(val) for k, val in v.items()}
+    if isinstance(v, (list, tuple, set)):
+        return [_plain(val) for val in v]
+    if hasattr(v, '_tree'):
+        # Optionable objects (filters, variants, etc.)
+        return _plain(v._tree)
+    return type(v).__name__
+
+
+def _referenced_files(v, files):
+    """ Looks for option values that are names of existing files """
+    if isinstance(v, dict):
+        for val in v.values():
+            _referenced_files(val, files)
+    elif isinstance(v, list):
+        for val in v:
+            _referenced_files(val, files)
+    elif isinstance(v, str) and v and len(v) < 4096:
+        fname = os.path.expanduser(v)
+        if os.path.isfile(fname):
+            files.add(os.path.abspath(fname))
+
+
+def referenced_files(tree):
+    """ Returns the absolute names of the existing files mentioned in the options """
+    files = set()
+    _referenced_files(tree, files)
+    return files
+
+
+def _tool_version(dep):
+    from .dep_downloader import check_tool_binary_system
+    key = dep.name
+    if key not in tool_versions:
+        ver = None
+        if dep.is_python:
+            try:
+                from importlib.metadata import version, PackageNotFoundError
+                try:
+                    ver = version(dep.pypi_name or dep.module_name)
+                except PackageNotFoundError:
+                    pass
+            except ImportError:
+                # Python 3.7
+                ver = 'unknown'
+        else:
+            ver = check_tool_binary_system(dep)[1]
+        tool_versions[key] = str(ver)
+    return tool_versions[key]
+
+
+def _tools(out):
+    from .dep_downloader import used_deps
+    prefix = out.type+':'
+    return {k: _tool_version(dep) for k, dep in used_deps.items() if k.startswith(prefix)}
+
+
+def fingerprint(out):
+    """ Computes a fingerprint for the inputs of this output.
+        Returns None if we can't compute it. """
+    files = set()
+    try:
+        files.update(os.path.abspath(f) for f in out.get_dependencies() if f)
+    except Exception as e:
+        logger.debug(f'Unable to get the dependencies for `{out.name}`: {e}')
+        return None
+    if (out.is_sch() or out.is_any()) and GS.sch:
+        files.update(os.path.abspath(f) for f in GS.sch.get_files())
+    if (out.is_pcb() or out.is_any()) and GS.pcb_file:
+        files.add(os.path.abspath(GS.pcb_file))
+    if GS.pro_file:
+        files.add(os.path.abspath(GS.pro_file))
+    files.update(referenced_files(out._tree))
+    data = {'version': [STATE_VERSION, __version__, GS.kicad_version],
+            'output': _plain(out._tree),
+            'globals': {k: _plain(getattr(GS, k)) for k in sorted(dir(GS)) if k.startswith('global_')},
+            'preflights': {p._name: _plain(p._value) for p in BasePreFlight.get_in_use_objs()},
+            'filters': {k: _plain(v) for k, v in RegOutput.get_filters().items()},
+            'variants': {k: _plain(v) for k, v in RegOutput.get_variants().items()},
+            'files': {f: hash_file(f) for f in sorted(files)},
+            'tools': _tools(out)}
+    return sha1(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+
+def _get_targets(out, out_dir):
+    try:
+        return sorted(os.path.abspath(f) for f in out.get_targets(out_dir) if f)
+    except Exception as e:
+        logger.debug(f'Unable to get the targets for `{out.name}`: {e}')
+        return None
+
+
+def check(out, out_dir):
+    """ Checks if we can skip this output.
+        Returns the fingerprint to record if we must generate it, None if we can skip it """
+    fp = fingerprint(out)
+    if fp is None:
+        return ''
+    # Entries updated in this run (i.e. by other workers) have more priority
+    entry = updates.get(out.name) or load().get(out.name)
+    if entry is None or entry.get('fingerprint') != fp:
+        logger.debug(f'- `{out.name}` inputs changed')
+        return fp
+    targets = _get_targets(out, out_dir)
+    if not targets or targets != entry.get('targets') or not all(os.path.exists(f) for f in targets):
+        logger.debug(f'- `{out.name}` targets changed or missing')
+        return fp
+    return None
+
+
+def record(out, out_dir, fp):
+    """ Memorizes the state for an output we just generated.
+        The fingerprint is computed again, the output could have regenerated some of its dependencies """
+    if not fp:
+        return
+    fp = fingerprint(out)
+    if not fp:
+        return
+    targets = _get_targets(out, out_dir)
+    if targets:
+        updates[out.name] = {'fingerprint': fp, 'targets': targets}
+
+
+def get_updates():
+    """ Entries updated in this run, used to send them from the workers """
+    return dict(updates)
+
+
+def add_updates(entries):
+    updates.update(entries)
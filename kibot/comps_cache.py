@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2024 Salvador E. Tropea
+# Copyright (c) 2024 Instituto Nacional de Tecnología Industrial
+# License: GPL-3.0
+# Project: KiBot (formerly KiPlot)
+"""
+Run-scoped cache for the list of components created by the `variant`, `dnf_filter` and `pre_transform` of the outputs.
+Many outputs use the same combination, here we apply the filters only once.
+The schematic components are shared by all the outputs and the filters change them, so we store a snapshot of each
+component (fields, fitted, included, etc.) and restore it when the list is reused.
+The key is computed using:
+- The variant, DNF filter and pre-transform filter (the same objects are shared by all the outputs)
+- The loaded schematic and board
+"""
+from .gs import GS
+from . import log
+
+logger = log.get_logger()
+# key -> (schematic, board, GS.variant, [(component, state)], objects used for the key)
+cache = {}
+hits = 0
+
+
+def filter_key(fil):
+    """ A hashable representation of the filter. Combined filters are created for each output, so we use its members """
+    if fil is None:
+        return None
+    members = getattr(fil, 'filters', None)
+    if members is not None:
+        # MultiFilter
+        return ('multi',)+tuple(filter_key(f) for f in members)
+    inverted = getattr(fil, '_filter', None)
+    if inverted is not None:
+        # NotFilter
+        return ('not', filter_key(inverted))
+    if fil.type == 'dummy':
+        return 'dummy'
+    return id(fil)
+
+
+def _get_key(variant, dnf_filter, pre_transform):
+    return (id(variant), filter_key(dnf_filter), filter_key(pre_transform))
+
+
+def get(variant, dnf_filter, pre_transform):
+    """ Returns the list of components for this combination, or None if we must apply the filters """
+    global hits
+    if not GS.global_cache_filtered_components:
+        return None
+    key = _get_key(variant, dnf_filter, pre_transform)
+    entry = cache.get(key)
+    if entry is None:
+        return None
+    if entry[0] is not GS.sch or entry[1] is not GS.board:
+        # The schematic or board was loaded again
+        del cache[key]
+        return None
+    hits += 1
+    logger.debugl(2, '- Reusing the filtered components')
+    # Variants can set the global variant, used for text expansions
+    GS.variant = entry[2]
+    comps = []
+    for c, state in entry[3]:
+        c.restore_state(state)
+        comps.append(c)
+    return comps
+
+
+def store(variant, dnf_filter, pre_transform, comps):
+    """ Memorizes the components after applying the filters """
+    if not GS.global_cache_filtered_components:
+        return
+    key = _get_key(variant, dnf_filter, pre_transform)
+    # We keep a reference to the variant and filters, so their ids remain valid
+    cache[key] = (GS.sch, GS.board, GS.variant, [(c, c.save_state()) for c in comps], variant, dnf_filter, pre_transform)
+
+
+def clear():
+    """ Discards all the stored lists """
+    global hits
+    if cache:
+        logger.debug(f'Filtered components cache: {len(cache)} lists, reused {hits} times')
+    cache.clear()
+    hits = 0
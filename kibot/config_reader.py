@@ -100,6 +100,8 @@ class CfgYamlReader(object):
         super().__init__()
         self.imported_globals = {}
         self.no_run_by_default = []
+        # Files imported by the configuration, used as dependencies
+        self.imported_files = []
         self.imported_global_has_less_priority = False
 
     def _check_version(self, v):
@@ -569,6 +571,8 @@ class CfgYamlReader(object):
                 raise KiPlotConfigurationError("`import` items must be strings or dicts ({})".format(str(entry)))
             fn, is_internal = self.check_import_file_name(dir_name, fn, is_external)
             fn_rel = os.path.relpath(fn)
+            if fn not in self.imported_files:
+                self.imported_files.append(fn)
             # Create a new dict for definitions applying the new ones and make it the last
             cur_definitions = deepcopy(collected_definitions[-1])
             cur_definitions.update(local_defs)
@@ -4,6 +4,7 @@
 # License: GPL-3.0
 # Project: KiBot (formerly KiPlot)
 # Description: Extracts information from the distributor spec and fills fields
+from copy import copy
 import re
 from .bom.units import comp_match, get_prefix, ParsedValue
 from .bom.xlsx_writer import get_spec
@@ -124,6 +125,8 @@ class Spec_to_Field(BaseFilter):  # noqa: F821
             for v in new_val.split(','):
                 res = comp_match(v.strip(), ' ', comp.ref, relax_severity=True, stronger=True)
                 if res is not None:
+                    # Don't modify the cached value
+                    res = copy(res)
                     res.unit = UNITS[kind]
                     res_many.append(res)
             if not res_many:
@@ -135,6 +138,7 @@ class Spec_to_Field(BaseFilter):  # noqa: F821
                     if str(r) != reference:
                         logger.warning(W_FLDCOLLISION+'Inconsistencies in multiple values {}: `{}` ({} vs {})'.
                                        format(comp.ref, val, r, reference))
+        res = copy(res)
         res.unit = UNITS[kind]
         return str(res)
 
@@ -14,7 +14,7 @@ from .pre_filters import FiltersOptions, FilterOptionsKiBot
 from .log import get_logger, set_filters
 from .misc import W_MUSTBEINT, W_ENVEXIST
 from .kicad.config import KiConf
-from .kicad.sexpdata import load, SExpData, sexp_iter, Symbol
+from .kicad.sexpdata import load_lazy, SExpData, sexp_iter, Symbol
 from .kicad.v6_sch import PCBLayer
 
 
@@ -219,6 +219,11 @@ class Globals(FiltersOptions):
             self.impedance_controlled = False
             """ The PCB needs specific dielectric characteristics.
                 KiCad 6: you should set this in the Board Setup -> Physical Stackup """
+            self.incremental = False
+            """ Skip the outputs whose inputs didn't change since the last run and whose targets are present.
+                The inputs are the PCB, schematic and project files, the files used by the output, its options,
+                the global options, preflights, filters, variants and the versions of the tools.
+                The state is stored in the output dir (`.kibot_state.json`) """
             self.output = GS.def_global_output
             """ Default pattern for output file names """
             self.pcb_finish = 'HAL'
@@ -317,6 +322,39 @@ class Globals(FiltersOptions):
             self.cache_3d_resistors = False
             """ Use a cache for the generated 3D models of colored resistors.
                 Will save time, but you could need to remove the cache if you need to regenerate them """
+            self.cache_board_snapshot = True
+            """ Read the footprints, pads, tracks and vias from the board only once for each board state and reuse
+                them in the same run. Used by the `report`, `position`, `bom`, `copy_files` and 3D outputs.
+                You can disable it if you suspect it gives wrong results """
+            self.cache_diff = False
+            """ Use a persistent cache for the images generated by the `diff` outputs, shared by all the `diff`
+                outputs (including `multivar` comparisons) and by the next runs. Only used when the `cache_dir`
+                option of the output is empty. The cache is locked, so concurrent jobs can share it """
+            self.cache_diff_dir = ''
+            """ Directory used for the diff cache. When empty we use the KiBot cache dir
+                (`~/.cache/kibot/diff`, can be changed using the `KIBOT_CACHE_DIR` environment variable) """
+            self.cache_diff_max_size = 1000
+            """ [1,1000000] Maximum size of the diff cache in MB. When exceeded the least recently used
+                entries are removed """
+            self.cache_filtered_components = True
+            """ Reuse the list of components created by the `variant`, `dnf_filter` and `pre_transform` of other
+                outputs in the same run. The filters are applied only once for each combination.
+                You can disable it if you suspect it gives wrong results """
+            self.cache_layer_plots = True
+            """ Reuse the layers plotted by KiCad in the same run. When the `pcb_print` and `pcbdraw` outputs
+                plot a layer using the same options, board state and variant the plot is done only once.
+                You can disable it if you suspect it gives wrong results """
+            self.cache_sch = False
+            """ Store the loaded schematic in an on-disk cache and reuse it on the next runs.
+                The key is a hash of the content of all the files used to load the schematic.
+                Useful when KiBot is invoked many times for the same project, i.e. using a Makefile.
+                Note that warnings produced while loading the schematic aren't reported when using the cache """
+            self.cache_sch_dir = ''
+            """ Directory used for the schematic cache. When empty we use the KiBot cache dir
+                (`~/.cache/kibot/sch`, can be changed using the `KIBOT_CACHE_DIR` environment variable) """
+            self.cache_sch_max_size = 100
+            """ [1,100000] Maximum size of the schematic cache in MB. When exceeded the least recently used
+                entries are removed """
             self.resources_dir = 'kibot_resources'
             """ Directory where various resources are stored. Currently we support colors and fonts.
                 They must be stored in sub-dirs. I.e. kibot_resources/fonts/MyFont.ttf
@@ -406,17 +444,16 @@ class Globals(FiltersOptions):
 
     def get_stack_up(self):
         logger.debug("Looking for stack-up information in the PCB")
-        pcb = None
+        pcb = iter = None
         with open(GS.pcb_file, 'rt') as fh:
             try:
-                pcb = load(fh)
+                # Only the needed elements are parsed
+                pcb = load_lazy(fh)
+                iter = sexp_iter(pcb, 'setup/stackup') if pcb.name == 'kicad_pcb' else None
             except SExpData as e:
                 # Don't make it an error, will be detected and reported latter
                 logger.debug("- Failed to load the PCB "+str(e))
-        if pcb is None:
-            return
-        iter = sexp_iter(pcb, 'kicad_pcb/setup/stackup')
-        if iter is None:
+        if pcb is None or iter is None:
             return
         sp = next(iter, None)
         if sp is None:
@@ -134,6 +134,15 @@ class GS(object):
     # The class that controls the global options
     class_for_global_opts = None
     global_cache_3d_resistors = None
+    global_cache_board_snapshot = None
+    global_cache_diff = None
+    global_cache_diff_dir = None
+    global_cache_diff_max_size = None
+    global_cache_filtered_components = None
+    global_cache_layer_plots = None
+    global_cache_sch = None
+    global_cache_sch_dir = None
+    global_cache_sch_max_size = None
     global_castellated_pads = None
     global_colored_tht_resistors = None
     global_copper_thickness = None
@@ -160,6 +169,7 @@ class GS(object):
     global_hide_excluded = None
     global_git_diff_strategy = None
     global_impedance_controlled = None
+    global_incremental = None
     global_invalidate_pcb_text_cache = None
     global_kiauto_time_out_scale = None
     global_kiauto_wait_start = None
@@ -480,6 +490,24 @@ class GS(object):
         for num in range(4 if GS.ki5 else 9):
             logger.debug("PCB comment {}: `{}`".format(num+1, GS.pcb_com[num]))
 
+    @staticmethod
+    def get_cache_dir(sub=None):
+        """ Directory used to store persistent caches.
+            Can be changed using the KIBOT_CACHE_DIR environment variable.
+            Returns None if we can't create it """
+        cache_dir = os.environ.get('KIBOT_CACHE_DIR')
+        if cache_dir is None:
+            base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+            cache_dir = os.path.join(base, 'kibot')
+        if sub:
+            cache_dir = os.path.join(cache_dir, sub)
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+        except OSError as e:
+            logger.debug(f'Unable to create the cache dir `{cache_dir}`: {e}')
+            return None
+        return os.path.abspath(cache_dir)
+
     @staticmethod
     def check_pcb():
         if not GS.pcb_file:
@@ -7,7 +7,7 @@
 KiCad v5/6 PCB format.
 Currently used only for the paper size
 """
-from .sexpdata import load, SExpData
+from .sexpdata import load_lazy, SExpData
 from .v6_sch import _check_str, _check_symbol, _check_is_symbol_list, _check_float
 PAGE_SIZE = {'A0': (841, 1189),
              'A1': (594, 841),
@@ -41,15 +41,18 @@ class PCB(object):
         with open(file, 'rt') as fh:
             error = None
             try:
-                pcb = load(fh)[0]
+                # Only the needed elements are parsed
+                pcb = load_lazy(fh)
+                if pcb.name == 'kicad_pcb':
+                    paper = pcb.get('paper')+pcb.get('page')
             except SExpData as e:
                 error = str(e)
             if error:
                 raise PCBError(error)
-        if not isinstance(pcb, list) or pcb[0].value() != 'kicad_pcb':
+        if pcb.name != 'kicad_pcb':
             raise PCBError('No kicad_pcb signature')
         o = PCB()
-        for e in pcb[1:]:
+        for e in paper:
             e_type = _check_is_symbol_list(e)
             if e_type == 'paper' or e_type == 'page':
                 o.paper = _check_str(e, 1, e_type) if e_type == 'paper' else _check_symbol(e, 1, e_type)
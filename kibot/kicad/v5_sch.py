@@ -9,12 +9,14 @@ A basic implementation of the .sch file format.
 Currently oriented to collect the components for the BoM.
 """
 # Encapsulate file/line
+import io
 import re
 import os
+import sys
 from xml.etree.ElementTree import Element, SubElement, tostring
 from xml.dom import minidom
 from datetime import datetime
-from copy import deepcopy
+from copy import copy
 from collections import OrderedDict
 from .config import KiConf, un_quote
 from .error import SchError, SchFileError, SchLibError
@@ -25,6 +27,40 @@ from ..misc import (W_BADPOLI, W_POLICOORDS, W_BADSQUARE, W_BADCIRCLE, W_BADARC,
 from .. import log
 
 logger = log.get_logger()
+# Class -> all the slots defined by the class and its parents
+_slots_cache = {}
+
+
+def _slots_of(cls):
+    names = _slots_cache.get(cls)
+    if names is None:
+        names = []
+        for c in reversed(cls.__mro__):
+            names.extend(n for n in c.__dict__.get('__slots__', ()) if n != '__dict__')
+        names = _slots_cache[cls] = tuple(names)
+    return names
+
+
+def get_attrs(obj):
+    """ All the attributes of an object that uses `__slots__` and `__dict__` """
+    attrs = dict(obj.__dict__)
+    for n in _slots_of(type(obj)):
+        try:
+            attrs[n] = getattr(obj, n)
+        except AttributeError:
+            # Not yet assigned
+            pass
+    return attrs
+
+
+def set_attrs(obj, attrs):
+    """ Replaces all the attributes of an object that uses `__slots__` and `__dict__` """
+    obj.__dict__.clear()
+    for n in _slots_of(type(obj)):
+        if n not in attrs and hasattr(obj, n):
+            delattr(obj, n)
+    for k, v in attrs.items():
+        setattr(obj, k, v)
 
 
 class LineReader(object):
@@ -104,6 +140,8 @@ def _split_space(s):
 class LibComponentField(object):
     """ A field for a component in the library.
         Almost the same as a field in the schematic, but incompatible!!! """
+    __slots__ = ('number', 'value', 'x', 'y', 'size', 'horizontal', 'visible', 'hjustify', 'vjustify', 'italic', 'bold',
+                 'name')
     # F n "text" posx posy dimension orientation visibility hjustify vjustify/italic/bold "name"
     field_re = re.compile(r'F\s*(\d+)\s+'               # 0 Field number
                           r'"((?:[^\\]|(?:\\.))*)"\s+'  # 1 Field value
@@ -152,7 +190,7 @@ class LibComponentField(object):
         field.italic = gs[8][1] == 'I'
         field.bold = gs[8][2] == 'B'
         if gs[9]:
-            field.name = gs[9][1:-1]
+            field.name = sys.intern(gs[9][1:-1])
         else:
             if field.number > 3:
                 logger.warning(W_MISFLDNAME + 'Missing component field name ({} line {})'.format(lib_name, f.line))
@@ -183,6 +221,7 @@ class DrawPoligon(object):
                         r'(-?\d+)\s+'       # 3 Thickness (Components from 74xx.lib has polygons with -1000)
                         r'((?:-?\d+\s+)+)'  # 4 The points
                         r'([NFf])')         # 5 Normal, Filled
+    __slots__ = ('points', 'sub_part', 'convert', 'thickness', 'fill', 'coords')
 
     def __init__(self):
         super().__init__()
@@ -238,6 +277,7 @@ class DrawRectangle(object):
                         r'([012])\s+'   # 5 Which representation (0 == both) for DeMorgan
                         r'(\d+)\s+'     # 6 Thickness
                         r'([NFf])')     # 7 Normal, Filled
+    __slots__ = ('start_x', 'start_y', 'end_x', 'end_y', 'sub_part', 'convert', 'thickness', 'fill')
 
     def __init__(self):
         super().__init__()
@@ -281,6 +321,7 @@ class DrawCircle(object):
                         r'([012])\s+'   # 4 Which representation (0 == both) for DeMorgan
                         r'(\d+)\s+'     # 5 Thickness
                         r'([NFf])')     # 6 Normal, Filled
+    __slots__ = ('pos_x', 'pos_y', 'radius', 'sub_part', 'convert', 'thickness', 'fill')
 
     def __init__(self):
         super().__init__()
@@ -329,6 +370,8 @@ class DrawArc(object):
                         r'(-?\d+)\s+'   # 10 Start Pos Y
                         r'(-?\d+)\s+'   # 11 End Pos X
                         r'(-?\d+)')     # 12 End Pos Y
+    __slots__ = ('pos_x', 'pos_y', 'radius', 'start', 'end', 'sub_part', 'convert', 'thickness', 'fill', 'start_x', 'start_y',
+                 'end_x', 'end_y')
 
     def __init__(self):
         super().__init__()
@@ -384,6 +427,8 @@ class DrawText(object):
                         r'([01])\s+'                 # 9 Bold
                         r'([CLR])\s+'                # 10 HJustify
                         r'([CBT])')                  # 11 VJustify
+    __slots__ = ('orientation', 'pos_x', 'pos_y', 'size', 'type', 'sub_part', 'convert', 'text', 'italic', 'bold', 'hjustify',
+                 'vjustify')
 
     def __init__(self):
         super().__init__()
@@ -435,6 +480,8 @@ class Pin(object):
                         r'((?:\s+)\S+)?')   # 11 Graphic type
     type2name = {'I': 'input', 'O': 'output', 'B': 'BiDi', 'T': '3state', 'P': 'passive', 'U': 'unspc',
                  'W': 'power_in', 'w': 'power_out', 'C': 'openCol', 'E': 'openEm', 'N': 'NotConnected'}
+    __slots__ = ('name', 'number', 'pos_x', 'pos_y', 'len', 'dir', 'size_name', 'size_num', 'sub_part', 'convert', 'type',
+                 'gtype')
 
     def __init__(self):
         super().__init__()
@@ -535,7 +582,7 @@ class LibComponent(object):
                 # A field
                 field = LibComponentField.parse(line, lib_name, f)
                 self.fields.append(field)
-                self.dfields[field.name.lower()] = field
+                self.dfields[sys.intern(field.name.lower())] = field
             elif line.startswith('ALIAS'):
                 self.alias = _split_space(line[6:])
             elif line.startswith('$FPLIST'):
@@ -751,9 +798,12 @@ class SchematicField(object):
     # F n "text" orientation posx posy dimension flags hjustify vjustify/italic/bold "name"
     field_re = re.compile(r'F\s*(\d+)\s+"((?:[^\\]|(?:\\.))*)"\s+([HV])\s+(-?\d+)\s+(-?\d+)\s+(\d+)\s+(\d+)'
                           r'\s+([LRCBT])\s+([LRCBT][IN][BN])\s*("(?:[^\\]|(?:\\.))*")?')
+    __slots__ = ('number', 'value', 'name', 'horizontal', 'x', 'y', 'size', 'flags', 'hjustify', 'vjustify', 'italic', 'bold')
 
     def __init__(self):
         super().__init__()
+        self.number = 0
+        self.value = self.name = ''
         self.horizontal = True  # H -> True, V -> False
         self.x = 0
         self.y = 0
@@ -803,7 +853,7 @@ class SchematicField(object):
         field.italic = gs[8][1] == 'I'
         field.bold = gs[8][2] == 'B'
         if gs[9]:
-            field.name = gs[9][1:-1]
+            field.name = sys.intern(gs[9][1:-1])
         else:
             if field.number > 3:
                 raise SchFileError('Missing component field name', line, f)
@@ -880,8 +930,15 @@ class SchematicComponent(object):
         - footprint_h: height of the footprint (pads only)
         - qty: amount of this part used.
         - kicad_dnp: is the KiCad v7 DNP flag. If not defined (v5/6) is None and is like False.
+        The attributes used by all the components are slots, the outputs and filters can add more attributes.
         """
     ref_re = re.compile(r'([^\d]+)([\?\d]+)')
+    __slots__ = ('field_ref', 'value', 'footprint', 'footprint_lib', 'datasheet', 'desc', 'fields', 'dfields', 'fields_bkp',
+                 'dfields_bkp', 'fitted', 'included', 'fixed', 'bottom', 'footprint_rot', 'footprint_x', 'footprint_y',
+                 'footprint_w', 'footprint_h', 'has_pcb_info', 'qty', 'annotation_error', 'pos_offset_x', 'pos_offset_y',
+                 'smd', 'virtual', 'tht', 'in_bom', 'on_board', 'in_bom_pcb', 'in_pos', 'in_pcb_only', 'kicad_dnp', 'project',
+                 'name', 'f_ref', 'ref', 'ref_prefix', 'ref_suffix', 'lib', 'unit', 'unit2', 'id', 'x', 'y', 'ar', 'matrix',
+                 'is_power', 'sheet_path', 'sheet_path_h', '__dict__')
 
     def __init__(self):
         super().__init__()
@@ -976,27 +1033,52 @@ class SchematicComponent(object):
 
     def add_field(self, field):
         self.fields.append(field)
-        self.dfields[field.name.lower()] = field
+        self.dfields[sys.intern(field.name.lower())] = field
+
+    def _copy_fields(self, fields):
+        """ Uses copies of the fields.
+            A shallow copy is enough, the fields only contain immutable values and shared `FontEffects`. """
+        self.fields = [copy(f) for f in fields]
+        self.dfields = {sys.intern(f.name.lower()): f for f in self.fields}
 
     def rename_field(self, old_name, new_name):
         old_name = old_name.lower()
         field = self.dfields[old_name]
         field.name = new_name
         del self.dfields[old_name]
-        self.dfields[new_name.lower()] = field
+        self.dfields[sys.intern(new_name.lower())] = field
 
     def back_up_fields(self):
         """ First call makes a back-up of the fields.
             Next calls restores the back-up. """
         if self.fields_bkp:
             # We have a back-up, restore from it
-            self.fields = deepcopy(self.fields_bkp)
-            self.dfields = {f.name.lower(): f for f in self.fields}
+            self._copy_fields(self.fields_bkp)
             self._solve_fields(LineReader(None, '**Internal**'))
         else:
             # No back-up. Make one for the next reset
-            self.fields_bkp = deepcopy(self.fields)
-            self.dfields_bkp = {f.name.lower(): f for f in self.fields_bkp}
+            self.fields_bkp = [copy(f) for f in self.fields]
+            self.dfields_bkp = {sys.intern(f.name.lower()): f for f in self.fields_bkp}
+
+    def overlay(self):
+        """ A light copy of the component, used instead of `deepcopy`.
+            The attributes are shared with this component, including the schematic objects (parent sheet, library
+            symbol, pins, etc.). Only the fields are copied, so changing the fields or assigning attributes doesn't
+            affect this component. """
+        new = copy(self)
+        new._copy_fields(self.fields)
+        return new
+
+    def save_state(self):
+        """ Snapshot of the component, used to restore the changes applied by filters and variants """
+        state = get_attrs(self)
+        state['fields'] = [copy(f) for f in self.fields]
+        return state
+
+    def restore_state(self, state):
+        """ Restores a snapshot created by `save_state`, the snapshot isn't affected by changes to the component """
+        set_attrs(self, state)
+        self._copy_fields(state['fields'])
 
     def _solve_ref(self, path):
         """ Look for the correct reference for this path.
@@ -1523,6 +1605,37 @@ def _path(p):
     return p
 
 
+class SheetFilesCache(object):
+    """ Cache for the files loaded during the load of a hierarchy.
+        Used to read/parse each sub-sheet only once, even when used by more than one sheet.
+        The key is the absolute name and the modification time of the file. """
+    def __init__(self):
+        super().__init__()
+        self.data = {}
+
+    def clear(self):
+        self.data = {}
+
+    def get(self, fname, loader):
+        """ Returns the result of `loader(fname)`, calling it only once for each file """
+        key = (os.path.abspath(fname), os.path.getmtime(fname))
+        res = self.data.get(key)
+        if res is None:
+            res = self.data[key] = loader(fname)
+        else:
+            logger.debug('- Reusing the data from '+fname)
+        return res
+
+
+# Sub-sheets loaded during the current load
+sheet_files = SheetFilesCache()
+
+
+def _read_sch_file(fname):
+    with open(fname, 'rt') as fh:
+        return fh.read()
+
+
 class Schematic(object):
     def __init__(self):
         super().__init__()
@@ -1590,7 +1703,9 @@ class Schematic(object):
         self.project = project
         self.sheet_path = sheet_path
         self.sheet_path_h = sheet_path_h
-        with open(fname, 'rt') as fh:
+        if parent is None:
+            sheet_files.clear()
+        with io.StringIO(sheet_files.get(fname, _read_sch_file)) as fh:
             f = SCHLineReader(fh, fname)
             line = f.get_line()
             m = re.match(r'EESchema Schematic File Version (\d+)', line)
@@ -1665,6 +1780,8 @@ class Schematic(object):
                 if sheet.annotation_error:
                     self.annotation_error = True
                 self.sub_sheets.append(sheet)
+            if parent is None:
+                sheet_files.clear()
 
     def get_files(self):
         """ A list of the names for all the sheets, including this one.
@@ -11,9 +11,10 @@ Documentation: https://dev-docs.kicad.org/en/file-formats/sexpr-schematic/
 """
 # Encapsulate file/line
 from collections import OrderedDict
-from copy import deepcopy
+from copy import copy, deepcopy
 import os
 import re
+import sys
 from ..gs import GS
 from .. import log
 from ..misc import W_NOLIB, W_UNKFLD, W_MISSCMP
@@ -22,7 +23,7 @@ from .sexpdata import load, SExpData, Symbol, dumps, Sep
 from .sexp_helpers import (_check_is_symbol_list, _check_len, _check_len_total, _check_symbol, _check_hide, _check_integer,
                            _check_float, _check_str, _check_symbol_value, _check_symbol_float, _check_symbol_int,
                            _check_symbol_str, _get_offset, _get_yes_no, _get_at, _get_size, _get_xy, _get_points)
-from .v5_sch import SchematicComponent, Schematic
+from .v5_sch import SchematicComponent, Schematic, sheet_files
 
 logger = log.get_logger()
 CROSSED_LIB = 'kibot_crossed'
@@ -82,6 +83,8 @@ def find_our_project(obj, default, exp_hierarchy):
 
 
 class PointXY(object):
+    __slots__ = ('x', 'y')
+
     def __init__(self, x, y):
         super().__init__()
         self.x = x
@@ -89,6 +92,8 @@ class PointXY(object):
 
 
 class Box(object):
+    __slots__ = ('x1', 'y1', 'x2', 'y2', 'set')
+
     def __init__(self, points=None):
         self.x1 = self.y1 = self.x2 = self.y2 = 0
         self.set = False
@@ -127,7 +132,12 @@ class Box(object):
 
 
 class FontEffects(object):
-    """ Class used to describe text attributes """
+    """ Class used to describe text attributes.
+        The objects returned by `parse` are shared, don't modify them, assign a modified copy. """
+    __slots__ = ('hide', 'w', 'h', 'thickness', 'bold', 'italic', 'hjustify', 'vjustify', 'mirror', 'color', 'href', 'face')
+    # Objects returned by `parse`, indexed by `key()`
+    shared = {}
+
     def __init__(self):
         super().__init__()
         self.hide = False
@@ -209,7 +219,13 @@ class FontEffects(object):
                     o.href = _check_str(i, 1, 'font effect')
                 else:
                     raise SchError('Unknown font effect attribute `{}`'.format(i))
-        return o
+        # Most texts use the same attributes, share them
+        return FontEffects.shared.setdefault(o.key(), o)
+
+    def key(self):
+        c = self.color
+        return (self.hide, self.w, self.h, self.thickness, self.bold, self.italic, self.hjustify, self.vjustify, self.mirror,
+                None if c is None else (c.r, c.g, c.b, c.a), self.href, self.face)
 
     def write_font(self):
         data = []
@@ -252,6 +268,8 @@ class FontEffects(object):
 
 
 class Color(object):
+    __slots__ = ('r', 'g', 'b', 'a')
+
     def __init__(self, items=None):
         super().__init__()
         if items:
@@ -272,6 +290,8 @@ class Color(object):
 
 
 class Stroke(object):
+    __slots__ = ('width', 'type', 'color')
+
     def __init__(self):
         super().__init__()
         self.width = 0
@@ -303,6 +323,8 @@ class Stroke(object):
 
 
 class Fill(object):
+    __slots__ = ('type', 'color')
+
     def __init__(self):
         super().__init__()
         self.type = None
@@ -332,6 +354,8 @@ class Fill(object):
 
 
 class DrawArcV6(object):
+    __slots__ = ('start', 'mid', 'end', 'stroke', 'fill', 'uuid', 'box')
+
     def __init__(self):
         super().__init__()
         self.start = None
@@ -375,6 +399,8 @@ class DrawArcV6(object):
 
 
 class DrawCircleV6(object):
+    __slots__ = ('center', 'radius', 'stroke', 'fill', 'uuid', 'box')
+
     def __init__(self):
         super().__init__()
         self.center = None
@@ -416,6 +442,8 @@ class DrawCircleV6(object):
 
 
 class DrawRectangleV6(object):
+    __slots__ = ('start', 'end', 'stroke', 'fill', 'uuid', 'box')
+
     def __init__(self):
         super().__init__()
         self.start = None
@@ -456,6 +484,8 @@ class DrawRectangleV6(object):
 
 class DrawCurve(object):
     """ Qubic Bezier """
+    __slots__ = ('points', 'stroke', 'fill', 'box')
+
     def __init__(self):
         super().__init__()
         self.points = []
@@ -490,6 +520,8 @@ class DrawCurve(object):
 
 
 class DrawPolyLine(object):
+    __slots__ = ('points', 'stroke', 'fill', 'box')
+
     def __init__(self):
         super().__init__()
         self.points = []
@@ -524,6 +556,8 @@ class DrawPolyLine(object):
 
 
 class DrawTextV6(object):
+    __slots__ = ('text', 'x', 'y', 'ang', 'effects', 'box')
+
     def __init__(self):
         super().__init__()
         self.text = None
@@ -545,12 +579,18 @@ class DrawTextV6(object):
         return _symbol('text', data)
 
 
+# Used by the fields created from scratch
+DEFAULT_EFFECTS = FontEffects()
+
+
 def _get_effects(items, pos, name):
     values = _check_symbol_value(items, pos, name, 'effects')
     return FontEffects.parse(values)
 
 
 class PinAlternate(object):
+    __slots__ = ('name', 'type', 'gtype')
+
     def __init__(self):
         super().__init__()
 
@@ -573,6 +613,9 @@ def _get_alternate(items, pos, name):
 
 
 class PinV6(object):
+    __slots__ = ('type', 'gtype', 'name', 'number', 'pos_x', 'pos_y', 'ang', 'len', 'name_effects', 'number_effects', 'hide',
+                 'box', 'alternate')
+
     def __init__(self):
         super().__init__()
         self.type = self.gtype = self.name = self.number = ''
@@ -649,6 +692,8 @@ class SchematicFieldV6(object):
     # 2 Footprint
     # 3 Datasheet
     # Reserved names: ki_keywords, ki_description, ki_locked, ki_fp_filters
+    __slots__ = ('name', 'value', 'number', 'x', 'y', 'ang', 'effects', 'do_not_autoplace', 'show_name')
+
     def __init__(self, name='', value='', id=0, x=0, y=0, ang=0):
         super().__init__()
         self.name = name
@@ -657,12 +702,17 @@ class SchematicFieldV6(object):
         self.x = x
         self.y = y
         self.ang = ang
-        self.effects = FontEffects()
+        self.effects = DEFAULT_EFFECTS
         self.do_not_autoplace = False
         self.show_name = False
 
+    def change_effects(self):
+        """ The effects are shared, get a copy before changing them """
+        self.effects = copy(self.effects)
+        return self.effects
+
     def visible(self, v):
-        self.effects.hide = not v
+        self.change_effects().hide = not v
 
     def is_visible(self):
         return not self.effects.hide
@@ -678,13 +728,13 @@ class SchematicFieldV6(object):
         self.x = x
         self.y = y
         if hjustify:
-            self.effects.hjustify = hjustify
+            self.change_effects().hjustify = hjustify
 
     @staticmethod
     def parse(items, number):
         field = SchematicFieldV6()
         name = 'field'
-        field.name = _check_str(items, 1, name+' name')
+        field.name = sys.intern(_check_str(items, 1, name+' name'))
         field.value = _check_str(items, 2, name+' value')
         # Default values
         field.number = number
@@ -822,7 +872,7 @@ class LibComponent(object):
                 field = SchematicFieldV6.parse(i, field_id)
                 field_id += 1
                 comp.fields.append(field)
-                comp.dfields[field.name.lower()] = field
+                comp.dfields[sys.intern(field.name.lower())] = field
             # GRAPHIC_ITEMS...
             elif i_type == 'arc':
                 vis_obj = DrawArcV6.parse(i)
@@ -998,6 +1048,10 @@ class SymbolInstance(object):
 
 
 class SchematicComponentV6(SchematicComponent):
+    __slots__ = ('pins', 'unit_specified', 'local_name', 'fields_autoplaced', 'mirror', 'convert', 'pin_alternates', 'uuid',
+                 'uuid_ori', 'projects', 'all_instances', 'lib_id', 'lib_symbol', 'ang', 'parent_sheet', 'path', 'p_path',
+                 'p_path_ori')
+
     def __init__(self):
         super().__init__()
         self.pins = OrderedDict()
@@ -1182,7 +1236,7 @@ class SchematicComponentV6(SchematicComponent):
         field.name = 'part'
         field.value = comp.name
         field.number = -1
-        field.effects.hide = True
+        field.visible(False)
         comp.add_field(field)
         # Memorize the current path, used for expanded hierarchy
         comp.path = parent.sheet_path
@@ -1792,6 +1846,18 @@ def _add_items_list(name, items, sch):
     sch.extend([Sep(), _symbol(name, data), Sep()])
 
 
+def _load_sch_sexp(fname):
+    with open(fname, 'rt') as fh:
+        error = None
+        try:
+            sch = load(fh)[0]
+        except SExpData as e:
+            error = str(e)
+        if error:
+            raise SchError(error)
+    return sch
+
+
 class SchematicV6(Schematic):
     def __init__(self):
         super().__init__()
@@ -2204,14 +2270,10 @@ class SchematicV6(Schematic):
         self.symbol_uuids = {}
         if not os.path.isfile(fname):
             raise SchError('Missing subsheet: '+fname)
-        with open(fname, 'rt') as fh:
-            error = None
-            try:
-                sch = load(fh)[0]
-            except SExpData as e:
-                error = str(e)
-            if error:
-                raise SchError(error)
+        if parent is None:
+            sheet_files.clear()
+        # Parse each file only once, the tree isn't modified
+        sch = sheet_files.get(fname, _load_sch_sexp)
         if not isinstance(sch, list) or sch[0].value() != 'kicad_sch':
             raise SchError('No kicad_sch signature')
         for e in sch[1:]:
@@ -2300,6 +2362,7 @@ class SchematicV6(Schematic):
         if parent is not None:
             # Here we finished for sub-sheets
             return
+        sheet_files.clear()
         # On the main sheet analyze the sheet and symbol instances
         # Solve the sheet pages: assign the page numbers.
         # KiCad 6: for all pages
@@ -8,23 +8,33 @@
 """
 Main KiBot code
 """
-from copy import deepcopy
+import ast
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from collections import OrderedDict
+import json
 import os
 import re
 from sys import path as sys_path
 from shutil import which, copy2
 from subprocess import run, PIPE, STDOUT, Popen, CalledProcessError
 from glob import glob
-from importlib.util import spec_from_file_location, module_from_spec
-
+from hashlib import sha256
+from importlib.machinery import SourceFileLoader
+from importlib.util import spec_from_file_location, module_from_spec, MAGIC_NUMBER
+import marshal
+import pickle
+from multiprocessing import get_context, get_all_start_methods, cpu_count
+from multiprocessing.connection import wait
+
+from . import __version__
 from .gs import GS
-from .registrable import RegOutput
+from .registrable import Registrable, RegOutput, RegVariant, RegFilter
 from .misc import (PLOT_ERROR, CORRUPTED_PCB, EXIT_BAD_ARGS, CORRUPTED_SCH, version_str2tuple,
                    EXIT_BAD_CONFIG, WRONG_INSTALL, UI_SMD, UI_VIRTUAL, TRY_INSTALL_CHECK, MOD_SMD, MOD_THROUGH_HOLE,
                    MOD_VIRTUAL, W_PCBNOSCH, W_NONEEDSKIP, W_WRONGCHAR, name2make, W_TIMEOUT, W_KIAUTO, W_VARSCH,
                    NO_SCH_FILE, NO_PCB_FILE, W_VARPCB, NO_YAML_MODULE, WRONG_ARGUMENTS, FAILED_EXECUTE, W_VALMISMATCH,
-                   MOD_EXCLUDE_FROM_POS_FILES, MOD_EXCLUDE_FROM_BOM, MOD_BOARD_ONLY, hide_stderr, W_MAXDEPTH, DONT_STOP)
+                   MOD_EXCLUDE_FROM_POS_FILES, MOD_EXCLUDE_FROM_BOM, MOD_BOARD_ONLY, hide_stderr, W_MAXDEPTH, DONT_STOP,
+                   INTERNAL_ERROR)
 from .error import PlotError, KiPlotConfigurationError, config_error, KiPlotError
 from .config_reader import CfgYamlReader
 from .pre_base import BasePreFlight
@@ -32,7 +42,13 @@ from .dep_downloader import register_deps
 import kibot.dep_downloader as dep_downloader
 from .kicad.v5_sch import Schematic, SchFileError, SchError, SchematicField
 from .kicad.v6_sch import SchematicV6, SchematicComponentV6
+from .kicad import v6_sch
 from .kicad.config import KiConfError, KiConf, expand_env
+from . import build_state
+from . import board_snapshot
+from . import comps_cache
+from . import plot_cache
+from .worker_client import WORKER_SOCKET
 from . import log
 
 logger = log.get_logger()
@@ -40,6 +56,23 @@ logger = log.get_logger()
 script_versions = {}
 actions_loaded = False
 needed_imports = {}
+# Plug-ins imported on demand
+PLUGINS_CLASSES = {'output': RegOutput, 'pre': BasePreFlight, 'variant': RegVariant, 'filter': RegFilter}
+RE_PLUGIN_CLASS = re.compile(r'^@(output|pre|variant|filter)_class\s*\nclass\s+(\w+)', re.M)
+plugins_types = {k: {} for k in PLUGINS_CLASSES}
+plugins_loaded = set()
+plugins_user = {}
+# Cache for the code after expanding the macros
+macro_cache_dir = None
+macro_cache_salt = None
+macro_cache_paths = []
+macro_cache_mtime = 0
+# Maximum size of the expanded macros cache, in MB
+macro_cache_max_size = 50
+# Tasks for the forked workers used by run_in_parallel
+parallel_tasks = None
+# Outputs updating the outputs they use, to avoid loops
+updating_used_outputs = set()
 
 try:
     import yaml
@@ -62,7 +95,7 @@ def try_register_deps(mod, name):
         register_deps(name, data)
 
 
-def _import(name, path):
+def _import(name, path, reg_deps=True):
     # Python 3.4+ import mechanism
     spec = spec_from_file_location("kibot."+name, path)
     mod = module_from_spec(spec)
@@ -72,43 +105,248 @@ def _import(name, path):
         GS.exit_with_error(('Unable to import plug-ins: '+str(e),
                             'Make sure you used `--no-compile` if you used pip for installation',
                             'Python path: '+str(sys_path)), WRONG_INSTALL)
-    try_register_deps(mod, name)
+    if reg_deps:
+        try_register_deps(mod, name)
 
 
-def _load_actions(path, load_internals=False):
-    logger.debug("Importing from "+path)
+def _plugin_files(path, load_internals=False):
     lst = glob(os.path.join(path, 'out_*.py')) + glob(os.path.join(path, 'pre_*.py'))
     lst += glob(os.path.join(path, 'var_*.py')) + glob(os.path.join(path, 'fil_*.py'))
     if load_internals:
         lst += [os.path.join(path, 'globals.py')]
-    for p in sorted(lst):
+    return sorted(lst)
+
+
+def _load_actions(path, load_internals=False):
+    logger.debug("Importing from "+path)
+    for p in _plugin_files(path, load_internals):
         name = os.path.splitext(os.path.basename(p))[0]
         logger.debug("- Importing "+name)
         _import(name, p)
 
 
-def load_actions():
-    """ Load all the available outputs and preflights """
+def _index_plugin(path):
+    """ Static scan of a plug-in, looking for the registered classes and the dependencies """
+    with open(path, 'rt') as f:
+        src = f.read()
+    types = [[kind, cls.lower()] for kind, cls in RE_PLUGIN_CLASS.findall(src)]
+    doc = ast.get_docstring(ast.parse(src, path), clean=False)
+    return {'types': types, 'deps': yaml.safe_load(doc) if doc else None}
+
+
+def get_plugins_index(path):
+    """ Index for the internal plug-ins: registered types and dependencies for each module.
+        Stored in the cache dir, created again when any of the plug-ins changes.
+        Returns None if we fail to create it. """
+    files = _plugin_files(path, True)
+    stamps = {}
+    for p in files:
+        st = os.stat(p)
+        stamps[os.path.basename(p)] = [st.st_mtime_ns, st.st_size]
+    cache_dir = GS.get_cache_dir()
+    fname = os.path.join(cache_dir, 'plugins_index.json') if cache_dir else None
+    if fname and os.path.isfile(fname):
+        try:
+            with open(fname, 'rt') as f:
+                index = json.load(f)
+            if index.get('version') == __version__ and index.get('stamps') == stamps:
+                logger.debug('Using the plug-ins index from '+fname)
+                return index
+        except (OSError, ValueError, AttributeError) as e:
+            logger.debug(f'Discarding the plug-ins index `{fname}`: {e}')
+    logger.debug('Creating the plug-ins index')
+    modules = {}
+    for p in files:
+        try:
+            modules[os.path.splitext(os.path.basename(p))[0]] = _index_plugin(p)
+        except (OSError, SyntaxError, ValueError, yaml.YAMLError) as e:
+            logger.debug(f'Failed to index `{p}`: {e}')
+            return None
+    index = {'version': __version__, 'stamps': stamps, 'modules': modules}
+    if fname:
+        tmp_name = fname+'.'+str(os.getpid())
+        try:
+            with open(tmp_name, 'wt') as f:
+                json.dump(index, f)
+            os.replace(tmp_name, fname)
+        except (OSError, TypeError, ValueError) as e:
+            logger.debug(f'Unable to save the plug-ins index `{fname}`: {e}')
+            if os.path.isfile(tmp_name):
+                os.remove(tmp_name)
+    return index
+
+
+def _cache_evict(dir, pattern, max_size, what):
+    """ Removes the least recently used files matching `pattern` until the cache fits in `max_size` bytes """
+    entries = []
+    total = 0
+    for f in glob(os.path.join(dir, pattern)):
+        try:
+            st = os.stat(f)
+        except OSError:
+            continue
+        entries.append((st.st_mtime, st.st_size, f))
+        total += st.st_size
+    if total <= max_size:
+        return
+    for _, size, f in sorted(entries):
+        logger.debug(f'- Removing old {what} cache entry {f}')
+        try:
+            os.remove(f)
+        except OSError:
+            continue
+        total -= size
+        if total <= max_size:
+            break
+
+
+def _macro_cache_source_to_code(loader, data, path, *, _optimize=-1):
+    """ Import hook used instead of the one from mcpyrate.
+        Caches the code after expanding the macros, using a hash of the source as key """
+    from .mcpyrate.importer import source_to_xcode
+    if not path.startswith(tuple(macro_cache_paths)):
+        return source_to_xcode(loader, data, path)
+    h = sha256(macro_cache_salt)
+    h.update(path.encode())
+    h.update(loader.name.encode())
+    h.update(data)
+    fname = os.path.join(macro_cache_dir, h.hexdigest()+'.bin')
+    try:
+        with open(fname, 'rb') as f:
+            code = marshal.load(f)
+        # Mark it as recently used
+        os.utime(fname)
+        return code
+    except (OSError, EOFError, ValueError, TypeError):
+        pass
+    logger.debugl(2, '- Expanding macros for '+path)
+    code = source_to_xcode(loader, data, path)
+    tmp_name = fname+'.'+str(os.getpid())
+    try:
+        with open(tmp_name, 'wb') as f:
+            marshal.dump(code, f)
+        os.replace(tmp_name, fname)
+    except (OSError, ValueError) as e:
+        logger.debug(f'Unable to store the expanded code for `{path}`: {e}')
+        if os.path.isfile(tmp_name):
+            os.remove(tmp_name)
+        return code
+    _cache_evict(macro_cache_dir, '*.bin', macro_cache_max_size*1024*1024, 'expanded macros')
+    return code
+
+
+def _macro_cache_path_stats(loader, path):
+    """ Import hook used instead of the one from mcpyrate.
+        Avoids parsing the source to find the macro-imports, we assume they come from `macros.py` """
+    from .mcpyrate.importer import path_xstats
+    if not path.startswith(tuple(macro_cache_paths)):
+        return path_xstats(loader, path)
+    return {'mtime': max(os.stat(path).st_mtime, macro_cache_mtime), 'size': None}
+
+
+def init_macro_cache(paths):
+    """ Enables the cache for the code after expanding the macros.
+        The key includes the macros definition, KiBot version and Python byte-code version.
+        Only for the modules in `paths` importing the macros from `macros.py`, other macro modules aren't in the key """
+    global macro_cache_dir
+    global macro_cache_salt
+    global macro_cache_mtime
+    macro_cache_dir = GS.get_cache_dir('macros')
+    if macro_cache_dir is None:
+        return
+    macros_file = os.path.join(os.path.dirname(__file__), 'macros.py')
+    with open(macros_file, 'rb') as f:
+        h = sha256(f.read())
+    macro_cache_mtime = os.stat(macros_file).st_mtime
+    h.update(__version__.encode())
+    h.update(MAGIC_NUMBER)
+    macro_cache_salt = h.digest()
+    macro_cache_paths.extend(os.path.join(p, '') for p in paths)
+    logger.debug('Using `{}` to cache the expanded macros'.format(macro_cache_dir))
+
+
+def activate_macros():
+    """ Enables the macros expansion on import """
+    from kibot.mcpyrate import activate
+    activate.activate()
+    if macro_cache_dir is not None:
+        SourceFileLoader.source_to_code = _macro_cache_source_to_code
+        SourceFileLoader.path_stats = _macro_cache_path_stats
+    return activate
+
+
+def _import_plugin(name):
+    if name in plugins_loaded:
+        return
+    plugins_loaded.add(name)
+    logger.debug("- Importing "+name+" (on demand)")
+    activate = activate_macros()
+    try:
+        _import(name, os.path.join(os.path.dirname(__file__), name+'.py'), reg_deps=False)
+    finally:
+        activate.deactivate()
+    # User plug-ins have more priority
+    for kind, types in plugins_user.items():
+        PLUGINS_CLASSES[kind]._registered.update(types)
+
+
+def load_plugin(kind, name):
+    """ Imports the internal plug-in that implements `name` """
+    mod = plugins_types.get(kind, {}).get(name)
+    if mod is not None:
+        _import_plugin(mod)
+
+
+def load_all_plugins(kind):
+    """ Imports all the internal plug-ins for this `kind` """
+    if kind is None:
+        # Dependencies, registered using the index
+        return
+    for mod in sorted(set(plugins_types.get(kind, {}).values())):
+        _import_plugin(mod)
+
+
+def load_actions(macro_cache=True):
+    """ Load all the available outputs and preflights.
+        When possible the internal plug-ins are imported on demand. """
     global actions_loaded
     if actions_loaded:
         return
     actions_loaded = True
     try_register_deps(dep_downloader, 'global')
-    from kibot.mcpyrate import activate
-    # activate.activate()
-    _load_actions(os.path.abspath(os.path.dirname(__file__)), True)
+    internal_dir = os.path.abspath(os.path.dirname(__file__))
     home = os.environ.get('HOME')
+    user_dirs = []
     if home:
-        dir = os.path.join(home, '.config', 'kiplot', 'plugins')
-        if os.path.isdir(dir):
-            _load_actions(dir)
-        dir = os.path.join(home, '.config', 'kibot', 'plugins')
+        user_dirs = [os.path.join(home, '.config', 'kiplot', 'plugins'), os.path.join(home, '.config', 'kibot', 'plugins')]
+    if macro_cache:
+        # The user plug-ins can import macros from their own modules, so we let mcpyrate check them
+        init_macro_cache([internal_dir])
+    activate = activate_macros()
+    index = get_plugins_index(internal_dir)
+    if index is None:
+        _load_actions(internal_dir, True)
+    else:
+        _import('globals', os.path.join(internal_dir, 'globals.py'), reg_deps=False)
+        for name, data in index['modules'].items():
+            if data['deps']:
+                register_deps(name, data['deps'])
+            for kind, tname in data['types']:
+                plugins_types[kind][tname] = name
+    internals = {kind: dict(cls._registered) for kind, cls in PLUGINS_CLASSES.items()}
+    for dir in user_dirs:
         if os.path.isdir(dir):
             _load_actions(dir)
     # de_activate in old mcpy
     if 'deactivate' in activate.__dict__:
         logger.debug('Deactivating macros')
         activate.deactivate()
+    if index is not None:
+        # Types defined by the user plug-ins
+        for kind, cls in PLUGINS_CLASSES.items():
+            plugins_user[kind] = {k: v for k, v in cls._registered.items() if internals[kind].get(k) is not v}
+        Registrable._load_plugin = load_plugin
+        Registrable._load_all_plugins = load_all_plugins
 
 
 def extract_errors(text):
@@ -170,6 +408,48 @@ def run_command(command, change_to=None, just_raise=False, use_x11=False, err_ms
     return res.stdout.decode().rstrip()
 
 
+def _parallel_worker(n):
+    """ Runs a task in a forked process. SystemExit can't cross the process boundary, so we return its code.
+        The warnings reported by the task are also returned, so the parent can count them """
+    counters = log.get_warn_counters()
+    try:
+        return False, parallel_tasks[0](parallel_tasks[1][n]), log.get_warn_counters(counters)
+    except SystemExit as e:
+        return True, e.code, log.get_warn_counters(counters)
+
+
+def run_in_parallel(func, items, jobs, use_processes=False):
+    """ Applies `func` to all the `items` using up to `jobs` workers (0 means one per CPU).
+        Returns the results in the same order used by `items`.
+        Threads are used by default, they are fine for tasks running external tools.
+        Python code can use `use_processes`, this needs *fork* and is disabled when not available. """
+    global parallel_tasks
+    if jobs <= 0:
+        jobs = cpu_count()
+    jobs = min(jobs, len(items))
+    if jobs <= 1:
+        return [func(i) for i in items]
+    if use_processes and 'fork' in get_all_start_methods():
+        logger.debug(f'Running {len(items)} tasks using {jobs} processes')
+        # The forked workers inherit the tasks, so they don't need to be pickled
+        parallel_tasks = (func, items)
+        try:
+            with ProcessPoolExecutor(max_workers=jobs, mp_context=get_context('fork')) as executor:
+                res = list(executor.map(_parallel_worker, range(len(items))))
+        finally:
+            parallel_tasks = None
+        for _, _, counters in res:
+            log.add_warn_counters(counters)
+        for is_exit, r, _ in res:
+            if is_exit:
+                # The worker already reported the problem
+                GS.exit_with_error(None, r)
+        return [r for _, r, _ in res]
+    logger.debug(f'Running {len(items)} tasks using {jobs} threads')
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(func, items))
+
+
 def exec_with_retry(cmd, exit_with=None):
     cmd_str = GS.pasteable_cmd(cmd)
     logger.debug('Executing: '+cmd_str)
@@ -226,6 +506,7 @@ def load_board(pcb_file=None, forced=False):
                     dr.SetUnitsMode(forced_units)
                     dr.Update()
         GS.board = board
+        plot_cache.board_changed()
     except OSError as e:
         GS.exit_with_error(['Error loading PCB file. Corrupted?', str(e)], CORRUPTED_PCB)
     assert board is not None
@@ -238,7 +519,112 @@ def ki_conf_error(e):
                         'Line content: `{}`'.format(e.code.rstrip())), EXIT_BAD_CONFIG)
 
 
+def _sch_cache_deps(sch, file):
+    """ Files used to load the schematic """
+    files = sch.get_files()
+    if not isinstance(sch, SchematicV6):
+        # KiCad 5 also loads the libraries
+        files.append(os.path.join(os.path.dirname(file), 'sym-lib-table'))
+        files.append(file.replace('.sch', '-cache.lib'))
+        for lib in filter(None, sch.libs.values()):
+            files.append(lib)
+            files.append(os.path.splitext(lib)[0]+'.dcm')
+    return [os.path.abspath(f) for f in files]
+
+
+def _sch_cache_key(file, project, deps):
+    """ Hash of the content of all the files used to load the schematic """
+    h = sha256('{}|{}|{}|{}'.format(__version__, GS.kicad_version_n, os.path.abspath(file), project).encode())
+    for f in deps:
+        h.update(f.encode())
+        try:
+            with open(f, 'rb') as fh:
+                h.update(sha256(fh.read()).digest())
+        except OSError:
+            h.update(b'missing')
+    return h.hexdigest()
+
+
+def _sch_cache_dir():
+    if GS.global_cache_sch_dir:
+        dir = os.path.abspath(os.path.expanduser(GS.global_cache_sch_dir))
+        try:
+            os.makedirs(dir, exist_ok=True)
+        except OSError as e:
+            logger.debug(f'Unable to create the schematic cache dir `{dir}`: {e}')
+            return None
+        return dir
+    return GS.get_cache_dir('sch')
+
+
+def _sch_cache_index(dir, file, project):
+    h = sha256('{}|{}'.format(os.path.abspath(file), project).encode())
+    return os.path.join(dir, h.hexdigest()+'.json')
+
+
+def _sch_cache_write(fname, data):
+    tmp_name = fname+'.'+str(os.getpid())
+    try:
+        with open(tmp_name, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_name, fname)
+    except OSError as e:
+        logger.debug(f'Unable to store the schematic cache `{fname}`: {e}')
+        if os.path.isfile(tmp_name):
+            os.remove(tmp_name)
+        return False
+    return True
+
+
+def load_sch_from_cache(file, project):
+    """ Looks for a previously loaded schematic in the on-disk cache.
+        The key is a hash of the content of all the files returned by `get_files()` (and libs for KiCad 5) """
+    if not GS.global_cache_sch:
+        return None
+    dir = _sch_cache_dir()
+    if dir is None:
+        return None
+    try:
+        with open(_sch_cache_index(dir, file, project), 'rt') as f:
+            deps = json.load(f)
+        fname = os.path.join(dir, _sch_cache_key(file, project, deps)+'.pickle')
+        with open(fname, 'rb') as f:
+            sch = pickle.load(f)
+        # Mark it as recently used
+        os.utime(fname)
+    except (OSError, ValueError, EOFError, pickle.UnpicklingError, AttributeError, ImportError, TypeError):
+        return None
+    logger.debug('Using cached schematic from '+fname)
+    if isinstance(sch, SchematicV6):
+        # The writers use the version of the loaded file, usually set by the parser
+        v6_sch.version = sch.version
+    return sch
+
+
+def save_sch_to_cache(sch, file, project):
+    """ Stores the loaded schematic in the on-disk cache """
+    if not GS.global_cache_sch:
+        return
+    dir = _sch_cache_dir()
+    if dir is None:
+        return
+    try:
+        data = pickle.dumps(sch, pickle.HIGHEST_PROTOCOL)
+    except (pickle.PicklingError, RecursionError, TypeError, AttributeError) as e:
+        logger.debug(f'Unable to serialize the schematic: {e}')
+        return
+    deps = _sch_cache_deps(sch, file)
+    fname = os.path.join(dir, _sch_cache_key(file, project, deps)+'.pickle')
+    if _sch_cache_write(fname, data):
+        logger.debug('Schematic stored in the cache as '+fname)
+        _sch_cache_write(_sch_cache_index(dir, file, project), json.dumps(deps).encode())
+        _cache_evict(dir, '*.pickle', GS.global_cache_sch_max_size*1024*1024, 'schematic')
+
+
 def load_any_sch(file, project):
+    sch = load_sch_from_cache(file, project)
+    if sch is not None:
+        return sch
     if file[-9:] == 'kicad_sch':
         sch = SchematicV6()
         load_libs = False
@@ -258,6 +644,7 @@ def load_any_sch(file, project):
         GS.exit_with_error(('While loading `{}`'.format(file), str(e)), CORRUPTED_SCH)
     except KiConfError as e:
         ki_conf_error(e)
+    save_sch_to_cache(sch, file, project)
     return sch
 
 
@@ -327,9 +714,9 @@ def get_board_comps_data(comps):
         cur_list = comps_hash.get(c.ref, [])
         cur_list.append(c)
         comps_hash[c.ref] = cur_list
-    for m in GS.get_modules():
-        ref = m.GetReference()
-        attrs = m.GetAttributes()
+    fps = board_snapshot.get().footprints
+    for n, ref in enumerate(fps.ref):
+        attrs = fps.attrs[n]
         if ref not in comps_hash:
             if not (attrs & MOD_BOARD_ONLY) and not ref.startswith('KiKit_'):
                 logger.warning(W_PCBNOSCH + '`{}` component in board, but not in schematic'.format(ref))
@@ -337,20 +724,20 @@ def get_board_comps_data(comps):
                 # v1.6.3 behavior
                 continue
             # Create a component for this so we can include/exclude it using filters
-            c = create_component_from_footprint(m, ref)
+            c = create_component_from_footprint(fps.fp[n], ref)
             comps_hash[ref] = [c]
             comps.append(c)
         for c in comps_hash[ref]:
-            new_value = m.GetValue()
+            new_value = fps.value[n]
             if new_value != c.value and '${' not in c.value:
                 logger.warning(f"{W_VALMISMATCH}Value field mismatch for `{ref}` (SCH: `{c.value}` PCB: `{new_value}`)")
             c.value = new_value
-            c.bottom = m.IsFlipped()
-            c.footprint_rot = m.GetOrientationDegrees()
-            center = GS.get_center(m)
-            c.footprint_x = center.x
-            c.footprint_y = center.y
-            (c.footprint_w, c.footprint_h) = GS.get_fp_size(m)
+            c.bottom = fps.flipped[n]
+            c.footprint_rot = fps.rot[n]
+            c.footprint_x = fps.x[n]
+            c.footprint_y = fps.y[n]
+            c.footprint_w = fps.w[n]
+            c.footprint_h = fps.h[n]
             c.has_pcb_info = True
             if GS.ki5:
                 # KiCad 5
@@ -397,9 +784,13 @@ def expand_comp_fields(c, env):
 
 def expand_fields(comps, dont_copy=False):
     if not dont_copy:
-        new_comps = deepcopy(comps)
-        for n_c, c in zip(new_comps, comps):
+        # Light copies, the expanded fields don't affect the schematic
+        new_comps = []
+        for c in comps:
+            n_c = c.overlay()
             n_c.original_copy = c
+            new_comps.append(n_c)
+        comps = new_comps
     env = KiConf.kicad_env
     env.update(GS.load_pro_variables())
     for c in comps:
@@ -475,9 +866,28 @@ def get_output_targets(output, parent):
     return files_list, out_dir, out
 
 
+def run_used_outputs(out, dont_stop):
+    """ Runs the outputs that generate the files used by `out` (i.e. for `compress`).
+        Used for incremental builds, so the fingerprint of `out` uses the updated files.
+        They are skipped if nothing changed. """
+    if out.name in updating_used_outputs:
+        return
+    updating_used_outputs.add(out.name)
+    try:
+        for name in out.get_used_outputs():
+            used = RegOutput.get_output(name)
+            if used is not None and not used._done and config_output(used, dont_stop=dont_stop):
+                logger.debug(f'- Updating `{name}`, used by `{out.name}`')
+                run_output(used, dont_stop)
+    finally:
+        updating_used_outputs.discard(out.name)
+
+
 def run_output(out, dont_stop=False):
     if out._done:
         return
+    if GS.global_incremental and out._incremental:
+        run_used_outputs(out, dont_stop)
     if GS.global_set_text_variables_before_output and hasattr(out.options, 'variant'):
         pre = BasePreFlight.get_preflight('set_text_variables')
         if pre:
@@ -485,9 +895,18 @@ def run_output(out, dont_stop=False):
             pre.apply()
             load_board()
     GS.current_output = out.name
+    fp = None
+    if GS.global_incremental and out._incremental:
+        fp = build_state.check(out, get_output_dir(out.dir, out, dry=True))
+        if fp is None:
+            logger.info('   Skipped, nothing changed since the last run')
+            out._done = True
+            return
     try:
-        out.run(get_output_dir(out.dir, out))
+        out_dir = get_output_dir(out.dir, out)
+        out.run(out_dir)
         out._done = True
+        build_state.record(out, out_dir, fp)
     except KiPlotConfigurationError as e:
         msg = "In section '"+out.name+"' ("+out.type+"): "+str(e)
         if dont_stop:
@@ -522,7 +941,7 @@ def look_for_output(name, op_name, parent, valids):
     return out
 
 
-def _generate_outputs(outputs, targets, invert, skip_pre, cli_order, no_priority, dont_stop):
+def _generate_outputs(outputs, targets, invert, skip_pre, cli_order, no_priority, dont_stop, jobs):
     logger.debug("Starting outputs for board {}".format(GS.pcb_file))
     # Make a list of target outputs
     n = len(targets)
@@ -574,10 +993,16 @@ def _generate_outputs(outputs, targets, invert, skip_pre, cli_order, no_priority
     # Run the preflights
     preflight_checks(skip_pre, targets)
     logger.debug('Outputs after preflights: {}'.format([t.name for t in targets]))
-    if not cli_order and not no_priority:
+    use_priority = not cli_order and not no_priority
+    if use_priority:
         # Sort by priority
         targets = sorted(targets, key=lambda o: o.priority, reverse=True)
         logger.debug('Outputs after sorting: {}'.format([t.name for t in targets]))
+    if jobs != 1 and len(targets) > 1:
+        if 'fork' in get_all_start_methods():
+            run_outputs_parallel(targets, jobs, dont_stop)
+            return
+        logger.debug('No `fork` support, running the outputs sequentially')
     # Configure and run the outputs
     for out in targets:
         if config_output(out, dont_stop=dont_stop):
@@ -585,15 +1010,128 @@ def _generate_outputs(outputs, targets, invert, skip_pre, cli_order, no_priority
             run_output(out, dont_stop)
 
 
-def generate_outputs(outputs, targets, invert, skip_pre, cli_order, no_priority, dont_stop=False):
+def get_output_files(out):
+    """ Absolute names for the targets and dependencies of an output.
+        Returns None, None if we can't determine them. """
+    try:
+        targets = out.get_targets(get_output_dir(out.dir, out, dry=True))
+        deps = out.get_dependencies()
+    except (KiPlotConfigurationError, PlotError, KiPlotError) as e:
+        logger.debug(f'Unable to get the targets/dependencies for `{out.name}`: {e}')
+        return None, None
+    return {os.path.abspath(f) for f in targets if f}, {os.path.abspath(f) for f in deps if f}
+
+
+def get_outputs_dag(targets):
+    """ Computes which outputs must be finished before starting each output.
+        An output depends on another when it needs any of the files generated by the other.
+        Outputs with different priority, or when we can't determine the files, keep the order used to generate
+        the outputs sequentially (`targets` is already sorted by priority, or in the CLI order).
+        I.e. outputs like `navigate_results` (low priority) wait for the rest, and outputs like `qr_lib` (high
+        priority) are finished before starting the rest.
+        Returns a dict: name -> set of names """
+    needs = {}
+    files = {out.name: get_output_files(out) for out in targets}
+    for n, out in enumerate(targets):
+        _, deps = files[out.name]
+        cur = set()
+        for m, other in enumerate(targets):
+            if m == n:
+                continue
+            o_targets, _ = files[other.name]
+            if deps is None or o_targets is None or other.priority != out.priority:
+                # Unknown relation, or different priority, keep the sequential order
+                if m < n:
+                    cur.add(other.name)
+            elif deps & o_targets:
+                cur.add(other.name)
+        needs[out.name] = cur
+    if GS.debug_level > 1:
+        for out in targets:
+            logger.debug(f'- `{out.name}` needs: {sorted(needs[out.name])}')
+    return needs
+
+
+def _run_output_worker(out, dont_stop, conn):
+    """ Runs an output in a forked process.
+        The process has its own copy of the board and schematic, so changes applied by variants and
+        filters can't affect other outputs. """
+    counters = log.get_warn_counters()
+    try:
+        run_output(out, dont_stop)
+    finally:
+        plot_cache.clear()
+        board_snapshot.clear()
+        conn.send((log.get_warn_counters(counters), build_state.get_updates()))
+        conn.close()
+
+
+def run_outputs_parallel(targets, jobs, dont_stop):
+    """ Runs the outputs using up to `jobs` worker processes.
+        Independent outputs are started as soon as a worker is available. """
+    if jobs <= 0:
+        jobs = cpu_count()
+    logger.debug(f'Running outputs using {jobs} parallel jobs')
+    # Configure all the outputs, this also loads the PCB and schematic, so the workers inherit them
+    pending = [out for out in targets if config_output(out, dont_stop=dont_stop)]
+    needs = get_outputs_dag(pending)
+    ctx = get_context('fork')
+    running = {}
+    finished = set()
+    while pending or running:
+        for out in list(pending):
+            if len(running) >= jobs:
+                break
+            if needs[out.name]-finished:
+                continue
+            pending.remove(out)
+            logger.info('- '+str(out))
+            r_conn, w_conn = ctx.Pipe(duplex=False)
+            p = ctx.Process(target=_run_output_worker, args=(out, dont_stop, w_conn), name='kibot-'+out.name)
+            p.start()
+            w_conn.close()
+            running[p.sentinel] = (p, out, r_conn)
+        if not running:
+            # Dependency loop, break it using the declared order
+            out = pending[0]
+            logger.debug(f'Dependency loop detected, forcing `{out.name}`')
+            needs[out.name] = set()
+            continue
+        for sentinel in wait(list(running.keys())):
+            p, out, r_conn = running.pop(sentinel)
+            p.join()
+            try:
+                counters, updates = r_conn.recv()
+                log.add_warn_counters(counters)
+                build_state.add_updates(updates)
+            except EOFError:
+                pass
+            r_conn.close()
+            finished.add(out.name)
+            if p.exitcode:
+                logger.debug(f'Output `{out.name}` finished with error {p.exitcode}')
+                if not dont_stop:
+                    for p_run, _, _ in running.values():
+                        p_run.terminate()
+                        p_run.join()
+                    GS.exit_with_error(None, p.exitcode if p.exitcode > 0 else INTERNAL_ERROR)
+            else:
+                out._done = True
+
+
+def generate_outputs(outputs, targets, invert, skip_pre, cli_order, no_priority, dont_stop=False, jobs=1):
     setup_resources()
     prj = None
     if GS.global_restore_project:
         # Memorize the project content to restore it at exit
         prj = GS.read_pro()
     try:
-        _generate_outputs(outputs, targets, invert, skip_pre, cli_order, no_priority, dont_stop)
+        _generate_outputs(outputs, targets, invert, skip_pre, cli_order, no_priority, dont_stop, jobs)
     finally:
+        plot_cache.clear()
+        comps_cache.clear()
+        board_snapshot.clear()
+        build_state.save()
         # Restore the project file
         GS.write_pro(prj)
 
@@ -650,6 +1188,25 @@ def get_pre_targets(targets, dependencies, is_pre):
     return pcb_targets, sch_targets
 
 
+def get_out_dependencies(out):
+    """ Precise list of files needed to create this output.
+        Includes the files reported by the output (i.e. 3D models), all the schematic sheets, the PCB and the files
+        mentioned in the options (i.e. templates and style sheets) """
+    files = list(out.get_dependencies())
+    if out.is_sch():
+        files.extend(GS.sch.get_files() if GS.sch else [GS.sch_file])
+    if out.is_pcb():
+        files.append(GS.pcb_file)
+    files.extend(sorted(build_state.referenced_files(out._tree)))
+    deps = []
+    for fn in files:
+        if fn:
+            fn = adapt_file_name(fn)
+            if fn not in deps:
+                deps.append(fn)
+    return deps
+
+
 def get_out_targets(outputs, ori_names, targets, dependencies, comments, no_default):
     pcb_targets = sch_targets = ''
     try:
@@ -660,7 +1217,7 @@ def get_out_targets(outputs, ori_names, targets, dependencies, comments, no_defa
             if not tg:
                 continue
             targets[name] = [adapt_file_name(fn) for fn in tg]
-            dependencies[name] = [adapt_file_name(fn) for fn in out.get_dependencies()]
+            dependencies[name] = get_out_dependencies(out)
             if out.comment:
                 comments[name] = out.comment
             if not out.run_by_default:
@@ -674,8 +1231,9 @@ def get_out_targets(outputs, ori_names, targets, dependencies, comments, no_defa
     return pcb_targets, sch_targets
 
 
-def generate_makefile(makefile, cfg_file, outputs, kibot_sys=False):
+def generate_makefile(makefile, cfg_file, outputs, kibot_sys=False, imports=None):
     cfg_file = os.path.relpath(cfg_file)
+    cfg_files = [cfg_file]+[adapt_file_name(fn) for fn in imports or []]
     logger.info('- Creating makefile `{}` from `{}`'.format(makefile, cfg_file))
     with open(makefile, 'wt') as f:
         f.write('#!/usr/bin/make\n')
@@ -711,6 +1269,18 @@ def generate_makefile(makefile, cfg_file, outputs, kibot_sys=False):
         pre_pcb_targets, pre_sch_targets = get_pre_targets(targets, dependencies, is_pre)
         # Outputs
         out_pcb_targets, out_sch_targets = get_out_targets(outputs, ori_names, targets, dependencies, comments, no_default)
+        # How to run the outputs, the preflights with targets are handled by its own rules
+        skip_all = ' -s '+','.join(sorted(is_pre)) if is_pre else ''
+        f.write('#\n# Persistent worker, use `make WORKER=1 -jN` to load the PCB/SCH only once\n#\n')
+        f.write('KIBOT_SOCKET?=$(DEST)/{}\n'.format(WORKER_SOCKET))
+        f.write('KIBOT_CLIENT?=python3 {}\n'.format(os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                                                 'worker_client.py'))))
+        f.write('export KIBOT_WORKER_CMD=$(KIBOT_CMD){} --worker $(KIBOT_SOCKET)\n'.format(skip_all))
+        f.write('ifdef WORKER\n')
+        f.write('KIBOT_OUT=$(KIBOT_CLIENT) $(KIBOT_SOCKET)\n')
+        f.write('else\n')
+        f.write('KIBOT_OUT=$(KIBOT_CMD){}\n'.format(skip_all))
+        f.write('endif\n\n')
         # all target
         f.write('#\n# Default target\n#\n')
         f.write('all: '+' '.join(filter(lambda x: x not in no_default, targets.keys()))+'\n\n')
@@ -726,22 +1296,26 @@ def generate_makefile(makefile, cfg_file, outputs, kibot_sys=False):
         # Generate the output dependencies
         f.write('#\n# Rules and dependencies\n#\n')
         if GS.debug_enabled:
-            kibot_cmd = '\t$(KIBOT_CMD)'
+            at = ''
             log_action = ''
         else:
-            kibot_cmd = '\t@$(KIBOT_CMD)'
+            at = '@'
             log_action = ' 2>> $(LOGFILE)'
-        skip_all = ','.join(is_pre)
         for name, dep in dependencies.items():
             if name in comments:
                 f.write('# '+comments[name]+'\n')
-            dep.append(cfg_file)
+            dep.extend(fn for fn in cfg_files if fn not in dep)
             f.write(' '.join(targets[name])+': '+' '.join(dep)+'\n')
             if name in is_pre:
                 skip = filter(lambda n: n != name, is_pre)
-                f.write('{} -s {} -i{}\n\n'.format(kibot_cmd, ','.join(skip), log_action))
+                f.write('\t{}$(KIBOT_CMD) -s {} -i{}\n\n'.format(at, ','.join(skip), log_action))
             else:
-                f.write('{} -s {} "{}"{}\n\n'.format(kibot_cmd, skip_all, ori_names[name], log_action))
+                f.write('\t{}$(KIBOT_OUT) "{}"{}\n\n'.format(at, ori_names[name], log_action))
+        # Worker control
+        f.write('#\n# Worker control\n#\n')
+        f.write('worker_start:\n\t{}$(KIBOT_CLIENT) --start $(KIBOT_SOCKET)\n\n'.format(at))
+        f.write('worker_stop:\n\t{}$(KIBOT_CLIENT) --stop $(KIBOT_SOCKET)\n\n'.format(at))
+        extra_targets.extend(['worker_start', 'worker_stop'])
         # Mark all outputs as PHONY
         f.write('.PHONY: '+' '.join(extra_targets+list(targets.keys()))+'\n')
 
@@ -178,6 +178,27 @@ class MyLogger(logging.Logger):
         return os.path.normcase(f.f_code.co_filename), f.f_lineno, f.f_code.co_name, sinfo
 
 
+def get_warn_counters(start=None):
+    """Get the warning counters and the reported warnings, if `start` is provided returns the difference"""
+    cur = (MyLogger.warn_tcnt, MyLogger.n_filtered, dict(MyLogger.warn_hash))
+    if start is None:
+        return cur
+    old = start[2]
+    return (cur[0]-start[0], cur[1]-start[1], {k: v-old.get(k, 0) for k, v in cur[2].items() if v != old.get(k, 0)})
+
+
+def add_warn_counters(counters):
+    """Add the counters collected by another process.
+       Warnings already reported by this process, or other processes, aren't counted as unique"""
+    MyLogger.warn_tcnt += counters[0]
+    MyLogger.n_filtered += counters[1]
+    for buf, n in counters[2].items():
+        if buf not in MyLogger.warn_hash:
+            MyLogger.warn_cnt += 1
+            MyLogger.warn_hash[buf] = 0
+        MyLogger.warn_hash[buf] += n
+
+
 def set_verbosity(logger, verbose, quiet):
     # Choose the log level
     log_level = logging.INFO
@@ -3,8 +3,15 @@
 # Copyright (c) 2022-2024 Instituto Nacional de Tecnología Industrial
 # License: GPL-3.0
 # Project: KiBot (formerly KiPlot)
+from contextlib import contextmanager
 import os
+from shutil import rmtree
 from tempfile import NamedTemporaryFile
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, the cache isn't locked
+    fcntl = None
 from .gs import GS
 from .kiplot import run_command
 from .out_base import VariantOptions
@@ -13,6 +20,54 @@ from .macros import macros, document, output_class  # noqa: F401
 from . import log
 
 logger = log.get_logger()
+# Sub-dir of the cache used for the lock files
+LOCKS_DIR = '.locks'
+
+
+def _dir_size(path):
+    size = 0
+    for root, _, files in os.walk(path):
+        for f in files:
+            try:
+                size += os.lstat(os.path.join(root, f)).st_size
+            except OSError:
+                pass
+    return size
+
+
+def _open_lock(cache_dir, hash):
+    dir = os.path.join(cache_dir, LOCKS_DIR)
+    os.makedirs(dir, exist_ok=True)
+    return open(os.path.join(dir, hash), 'a')
+
+
+def evict_diff_cache(cache_dir, max_size):
+    """ Removes the least recently used entries until the cache fits in `max_size` bytes.
+        Entries in use by other jobs (locked) are skipped """
+    entries = []
+    total = 0
+    for entry in os.scandir(cache_dir):
+        if entry.name == LOCKS_DIR or not entry.is_dir(follow_symlinks=False):
+            continue
+        size = _dir_size(entry.path)
+        entries.append((entry.stat().st_mtime, size, entry.name))
+        total += size
+    logger.debug(f'Diff cache size: {total} bytes ({len(entries)} entries)')
+    if total <= max_size:
+        return
+    for _, size, name in sorted(entries):
+        with _open_lock(cache_dir, name) as lock:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    logger.debug(f'- Diff cache entry {name} in use, not removed')
+                    continue
+            logger.debug(f'- Removing old diff cache entry {name}')
+            rmtree(os.path.join(cache_dir, name), ignore_errors=True)
+        total -= size
+        if total <= max_size:
+            break
 
 
 class AnyDiffOptions(VariantOptions):
@@ -26,6 +81,7 @@ class AnyDiffOptions(VariantOptions):
         self._expand_id = 'diff'
         self._expand_ext = 'pdf'
         self._kiri_mode = False
+        self._shared_cache = False
 
     def add_zones_ops(self, cmd):
         if self.zones == 'global':
@@ -36,7 +92,33 @@ class AnyDiffOptions(VariantOptions):
         elif self.zones == 'unfill':
             cmd.extend(['--zones', 'unfill'])
 
+    @contextmanager
+    def locked_cache(self, *hashes, shared=()):
+        """ Locks the cache entries for `hashes` when the cache is shared with other jobs.
+            Entries in `shared` are just read, so we use a shared lock for them.
+            The entries are also marked as recently used """
+        locks = []
+        try:
+            if self._shared_cache and fcntl is not None:
+                # Always use the same order to avoid dead-locks
+                for hash in sorted(set(hashes)):
+                    lock = _open_lock(self.cache_dir, hash)
+                    locks.append(lock)
+                    fcntl.flock(lock, fcntl.LOCK_SH if hash in shared else fcntl.LOCK_EX)
+            yield
+        finally:
+            if self._shared_cache:
+                for hash in hashes:
+                    entry = os.path.join(self.cache_dir, hash)
+                    if os.path.isdir(entry):
+                        os.utime(entry)
+            # Closing the file releases the lock
+            for lock in locks:
+                lock.close()
+
     def add_to_cache(self, name, hash):
+        """ Adds `name` to the cache using `hash`, returns the name of the file used.
+            Can be called from worker threads, so we don't store anything in the object. """
         cmd = [self.command, '--no_reader', '--only_cache', '--old_file_hash', hash, '--cache_dir', self.cache_dir]
         if self._kiri_mode:
             cmd.append('--kiri_mode')
@@ -48,8 +130,9 @@ class AnyDiffOptions(VariantOptions):
         if GS.debug_enabled:
             cmd.insert(1, '-'+'v'*GS.debug_level)
         cmd.extend([name, name])
-        self.name_used_for_cache = name
-        run_command(cmd)
+        with self.locked_cache(hash):
+            run_command(cmd)
+        return name
 
     def run_git(self, cmd, cwd=None, just_raise=False):
         if cwd is None:
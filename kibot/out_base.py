@@ -26,6 +26,8 @@ from .registrable import RegOutput
 from .optionable import Optionable, BaseOptions
 from .fil_base import BaseFilter, apply_fitted_filter, reset_filters, apply_pre_transform
 from .kicad.config import KiConf
+from . import comps_cache
+from . import plot_cache
 from .macros import macros, document  # noqa: F401
 from .error import KiPlotConfigurationError
 from . import log
@@ -97,6 +99,8 @@ class BaseOutput(RegOutput):
         self._any_related = False    # True if we need an schematic OR a PCB
         self._unknown_is_error = True
         self._done = False
+        # Can be skipped when its inputs didn't change (`incremental` global option)
+        self._incremental = True
         self._category = None
 
     @staticmethod
@@ -126,6 +130,10 @@ class BaseOutput(RegOutput):
         """ Returns a list of targets suitable for the navigate results """
         return self.get_targets(out_dir), None
 
+    def get_used_outputs(self):
+        """ Returns the names of the outputs that generate files used by this output """
+        return []
+
     def get_dependencies(self):
         """ Returns a list of files needed to create this output """
         if self._sch_related:
@@ -791,6 +799,8 @@ class VariantOptions(BaseOptions):
         if not self.will_filter_pcb_components():
             return False
         self.comps_hash = self.get_refs_hash()
+        self._old_board_filter = plot_cache.board_filter
+        plot_cache.set_board_filter(self.get_filter_fingerprint(do_3D, do_2D, highlight))
         if self._sub_pcb:
             self._sub_pcb.apply(self.comps_hash)
         if self._comps:
@@ -812,6 +822,13 @@ class VariantOptions(BaseOptions):
                 self.highlight_3D_models(GS.board, highlight)
         return True
 
+    def get_filter_fingerprint(self, do_3D, do_2D, highlight):
+        """ Computes a value describing the changes applied to the board by filter_pcb_components """
+        comps = tuple((c.ref, c.fitted, c.included, c.fixed, tuple((f.name, f.value) for f in c.fields))
+                      for c in self._comps) if self._comps else None
+        return hash((do_3D, do_2D, tuple(highlight) if highlight else None, getattr(self, 'hide_excluded', False),
+                     self._sub_pcb.name if self._sub_pcb else None, comps))
+
     def unfilter_pcb_components(self, do_3D=False, do_2D=True):
         if not self.will_filter_pcb_components():
             return
@@ -831,6 +848,7 @@ class VariantOptions(BaseOptions):
             self.unhighlight_3D_models(GS.board)
         if self._sub_pcb:
             self._sub_pcb.revert(self.comps_hash)
+        plot_cache.set_board_filter(getattr(self, '_old_board_filter', None))
 
     def set_title(self, title, sch=False):
         self.old_title = None
@@ -1028,17 +1046,22 @@ class VariantOptions(BaseOptions):
         if not self.dnf_filter and not self.variant and not self.pre_transform:
             return
         load_sch()
-        # Get the components list from the schematic
-        comps = GS.sch.get_components()
-        get_board_comps_data(comps)
-        # Apply the filter
-        reset_filters(comps)
-        comps = apply_pre_transform(comps, self.pre_transform)
-        apply_fitted_filter(comps, self.dnf_filter)
-        # Apply the variant
-        if self.variant:
+        # Other outputs could have applied the same filters
+        comps = comps_cache.get(self.variant, self.dnf_filter, self.pre_transform)
+        if comps is None:
+            # Get the components list from the schematic
+            comps = GS.sch.get_components()
+            get_board_comps_data(comps)
+            # Apply the filter
+            reset_filters(comps)
+            comps = apply_pre_transform(comps, self.pre_transform)
+            apply_fitted_filter(comps, self.dnf_filter)
             # Apply the variant
-            comps = self.variant.filter(comps)
+            if self.variant:
+                # Apply the variant
+                comps = self.variant.filter(comps)
+            comps_cache.store(self.variant, self.dnf_filter, self.pre_transform, comps)
+        if self.variant:
             self._sub_pcb = self.variant._sub_pcb
         self._comps = comps
 
@@ -19,6 +19,7 @@ from .optionable import Optionable
 from .out_base import VariantOptions, BaseOutput
 from .kicad.config import KiConf
 from .macros import macros, document  # noqa: F401
+from . import board_snapshot
 from . import log
 
 logger = log.get_logger()
@@ -478,10 +479,8 @@ class Base3DOptions(VariantOptions):
             rel_dirs.append(self._tmp_dir)
             logger.debug('Using `{}` as dir for downloaded 3D models'.format(self._tmp_dir))
         # Look for all the footprints
-        for m in GS.get_modules():
-            ref = m.GetReference()
-            lib_id = m.GetFPID()
-            lib_nickname = str(lib_id.GetLibNickname())
+        fps = board_snapshot.get().footprints
+        for m, ref, lib_nickname in zip(fps.fp, fps.ref, fps.lib_nickname):
             sch_comp = all_comps_hash.get(ref, None)
             # Extract the models (the iterator returns copies)
             models = m.Models()
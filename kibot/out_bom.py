@@ -518,6 +518,10 @@ class BoMOptions(BaseOptions):
             self.group_fields_fallbacks = Optionable
             """ [list(string)] List of fields to be used when the fields in `group_fields` are empty.
                 The first field in this list is the fallback for the first in `group_fields`, and so on """
+            self.fast_grouping = True
+            """ Use hashes of the `group_fields` to find the group for each component, instead of comparing it
+                against all the groups. The result is the same, this is much faster for big BoMs.
+                Disable it only for debug purposes """
             self.component_aliases = ComponentAliases
             """ [list(list(string))] A series of values which are considered to be equivalent for the part name.
                 Each entry is a list of equivalen names. Example: ['c', 'c_small', 'cap' ]
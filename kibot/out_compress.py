@@ -14,13 +14,21 @@ Dependencies:
     debian: rar
     arch: rar(AUR)
 """
-import re
-import os
+import bz2
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 import glob
+import gzip
+import lzma
+import os
+import re
+from shutil import copyfileobj
+import struct
 import sys
-from zipfile import ZipFile, ZIP_STORED, ZIP_DEFLATED, ZIP_BZIP2, ZIP_LZMA
 from tarfile import open as tar_open
-from collections import OrderedDict
+from tempfile import NamedTemporaryFile, SpooledTemporaryFile
+from zipfile import ZipFile, ZipInfo, ZIP_STORED, ZIP_DEFLATED, ZIP_BZIP2, ZIP_LZMA, ZIP64_LIMIT
+import zlib
 from .gs import GS
 from .kiplot import config_output, run_output, get_output_targets, run_command
 from .misc import WRONG_INSTALL, W_EMPTYZIP, INTERNAL_ERROR
@@ -30,6 +38,142 @@ from .macros import macros, document, output_class  # noqa: F401
 from . import log
 
 logger = log.get_logger()
+# Files that are already compressed, stored when using the `auto` compression
+COMPRESSED_EXTS = {'png', 'jpg', 'jpeg', 'gif', 'webp', 'pdf', 'zip', 'gz', 'tgz', 'bz2', 'xz', 'lzma', 'zst', '7z', 'rar',
+                   'xlsx', 'ods', 'odt', 'docx', 'pcb3d', 'glb', 'mp4', 'webm'}
+# Size of the blocks used to read and compress
+CHUNK_SIZE = 1 << 20
+# Size of the independently compressed blocks for TAR files
+TAR_BLOCK_SIZE = 8 << 20
+# Compressed members bigger than this are stored on disk
+SPOOL_SIZE = 16 << 20
+# Compressors for the TAR blocks, same levels used by tarfile
+TAR_COMPRESSORS = {'gz': lambda data: gzip.compress(data, compresslevel=9),
+                   'bz2': lambda data: bz2.compress(data, compresslevel=9),
+                   'xz': lambda data: lzma.compress(data)}
+# LZMA options used for ZIP files, the defaults used by zipfile (preset 6)
+LZMA_FILTER = {'id': lzma.FILTER_LZMA1, 'dict_size': 1 << 23, 'lc': 3, 'lp': 0, 'pb': 2}
+
+
+def is_compressed(fname):
+    return os.path.splitext(fname)[1][1:].lower() in COMPRESSED_EXTS
+
+
+class LZMAZipCompressor(object):
+    """ LZMA compressor for ZIP members: a header with the LZMA properties followed by the raw LZMA stream """
+    def __init__(self):
+        self.compressor = lzma.LZMACompressor(lzma.FORMAT_RAW, filters=[LZMA_FILTER])
+        # Properties: lc/lp/pb packed in one byte and the dictionary size
+        props = struct.pack('<BI', (LZMA_FILTER['pb']*5+LZMA_FILTER['lp'])*9+LZMA_FILTER['lc'], LZMA_FILTER['dict_size'])
+        # LZMA SDK version (9.4) and size of the properties
+        self.header = struct.pack('<BBH', 9, 4, len(props))+props
+
+    def compress(self, data):
+        res = self.header+self.compressor.compress(data)
+        self.header = b''
+        return res
+
+    def flush(self):
+        res = self.header+self.compressor.flush()
+        self.header = b''
+        return res
+
+
+def get_compressor(compress_type, compresslevel):
+    """ Compressor for the ZIP members, generates the same data as ZipFile """
+    if compress_type == ZIP_DEFLATED:
+        return zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION if compresslevel is None else compresslevel, zlib.DEFLATED, -15)
+    if compress_type == ZIP_BZIP2:
+        return bz2.BZ2Compressor(9 if compresslevel is None else compresslevel)
+    if compress_type == ZIP_LZMA:
+        return LZMAZipCompressor()
+    raise ValueError('Unsupported ZIP compression {}'.format(compress_type))
+
+
+def can_add_compressed(zip):
+    """ Checks if we can add compressed members using `zip_add_compressed`.
+        We need to write the local header again, this isn't part of the documented ZipFile API. """
+    return hasattr(zip, 'fp') and hasattr(zip.fp, 'seek') and hasattr(ZipInfo, 'FileHeader')
+
+
+def compress_member(fname, compress_type, compresslevel):
+    """ Compresses a file as ZipFile does. Returns the compressed data, its CRC and the original size """
+    compressor = get_compressor(compress_type, compresslevel)
+    data = SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    crc = size = 0
+    with open(fname, 'rb') as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+            data.write(compressor.compress(chunk))
+    data.write(compressor.flush())
+    data.seek(0)
+    return data, crc, size
+
+
+def zip_add_compressed(zip, zinfo, data, crc, size):
+    """ Adds a member to the ZIP file, the data is already compressed using `zinfo.compress_type`.
+        We write it as a stored member and then fix the header. """
+    compress_type = zinfo.compress_type
+    zinfo.compress_type = ZIP_STORED
+    zinfo.file_size = size
+    # Same criteria used by ZipFile.open
+    zip64 = size*1.05 > ZIP64_LIMIT
+    with zip.open(zinfo, 'w', force_zip64=zip64) as dest:
+        copyfileobj(data, dest, CHUNK_SIZE)
+    zinfo.compress_type = compress_type
+    zinfo.CRC = crc
+    zinfo.file_size = size
+    if compress_type == ZIP_LZMA:
+        # Compressed data includes an end-of-stream (EOS) marker
+        zinfo.flag_bits |= 0x02
+    pos = zip.fp.tell()
+    zip.fp.seek(zinfo.header_offset)
+    zip.fp.write(zinfo.FileHeader(zip64))
+    zip.fp.seek(pos)
+
+
+class BlocksCompressor(object):
+    """ Write-only file that compresses the data in independent blocks, using threads.
+        The result is a concatenation of compressed streams, supported by gzip, bzip2 and xz """
+    def __init__(self, output, compressor, jobs):
+        self.output = output
+        self.compressor = compressor
+        self.jobs = jobs
+        self.executor = ThreadPoolExecutor(max_workers=jobs)
+        self.pending = deque()
+        self.buffer = []
+        self.buffered = 0
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= TAR_BLOCK_SIZE:
+            self.flush_block()
+        return len(data)
+
+    def flush_block(self):
+        if not self.buffered:
+            return
+        self.pending.append(self.executor.submit(self.compressor, b''.join(self.buffer)))
+        self.buffer = []
+        self.buffered = 0
+        # Limit the amount of data in memory
+        while len(self.pending) > self.jobs:
+            self.output.write(self.pending.popleft().result())
+
+    def close(self):
+        try:
+            self.flush_block()
+            while self.pending:
+                self.output.write(self.pending.popleft().result())
+        finally:
+            for f in self.pending:
+                f.cancel()
+            self.executor.shutdown()
 
 
 class FilesList(Optionable):
@@ -74,7 +218,8 @@ class CompressOptions(BaseOptions):
             self.format = 'ZIP'
             """ *[ZIP,TAR,RAR] Output file format """
             self.compression = 'auto'
-            """ [auto,stored,deflated,bzip2,lzma] Compression algorithm. Use auto to let KiBot select a suitable one """
+            """ [auto,stored,deflated,bzip2,lzma] Compression algorithm. Use auto to let KiBot select a suitable one.
+                When using auto the files that are already compressed (i.e. PNG, PDF or ZIP) are just stored """
             self.files = FilesList
             """ *[list(dict)] Which files will be included """
             self.move_files = False
@@ -85,6 +230,10 @@ class CompressOptions(BaseOptions):
             """ Store the file pointed by symlinks, not the symlink """
             self.skip_not_run = False
             """ Skip outputs with `run_by_default: false` """
+            self.jobs = 0
+            """ [0,256] Number of threads used to compress. ZIP files compress the files in parallel, TAR files
+                compress the stream in independent blocks and RAR files use it for the `-mt` option.
+                Use 0 to use one thread for each CPU, 1 disables the parallel compression """
         super().__init__()
 
     def config(self, parent):
@@ -95,21 +244,74 @@ class CompressOptions(BaseOptions):
         self._expand_id = parent.name
         self._expand_ext = self.solve_extension()
 
+    def get_jobs(self):
+        return self.jobs if self.jobs > 0 else os.cpu_count() or 1
+
     def create_zip(self, output, files):
         extra = {}
-        extra['compression'] = self.ZIP_ALGORITHMS[self.compression]
+        compression = extra['compression'] = self.ZIP_ALGORITHMS[self.compression]
+        compresslevel = None
         if sys.version_info >= (3, 7):
-            extra['compresslevel'] = 9
+            compresslevel = extra['compresslevel'] = 9
+        jobs = self.get_jobs()
         with ZipFile(output, 'w', **extra) as zip:
-            for fname, dest in files.items():
-                logger.debug('Adding '+fname+' as '+dest)
-                zip.write(fname, dest)
+            if compression == ZIP_STORED or jobs == 1 or not can_add_compressed(zip):
+                for fname, dest in files.items():
+                    logger.debug('Adding '+fname+' as '+dest)
+                    store = self.compression == 'auto' and is_compressed(fname)
+                    zip.write(fname, dest, compress_type=ZIP_STORED if store else None)
+                return
+            # Compress the files in parallel, but add them in order
+            pending = deque()
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
+                try:
+                    for fname, dest in files.items():
+                        logger.debug('Adding '+fname+' as '+dest)
+                        zinfo = ZipInfo.from_file(fname, dest)
+                        if zinfo.is_dir() or (self.compression == 'auto' and is_compressed(fname)):
+                            future = None
+                        else:
+                            zinfo.compress_type = compression
+                            future = executor.submit(compress_member, fname, compression, compresslevel)
+                        pending.append((fname, dest, zinfo, future))
+                        # Limit the amount of compressed data waiting to be added
+                        while len(pending) > 2*jobs:
+                            self.zip_add(zip, *pending.popleft())
+                    while pending:
+                        self.zip_add(zip, *pending.popleft())
+                finally:
+                    for _, _, _, future in pending:
+                        if future is not None:
+                            future.cancel()
+
+    @staticmethod
+    def zip_add(zip, fname, dest, zinfo, future):
+        if future is None:
+            # Directories and already compressed files
+            zip.write(fname, dest, compress_type=ZIP_STORED)
+            return
+        data, crc, size = future.result()
+        with data:
+            zip_add_compressed(zip, zinfo, data, crc, size)
 
     def create_tar(self, output, files):
-        with tar_open(output, 'w:'+self.TAR_MODE[self.compression]) as tar:
-            for fname, dest in files.items():
-                logger.debug('Adding '+fname+' as '+dest)
-                tar.add(fname, dest)
+        mode = self.TAR_MODE[self.compression]
+        jobs = self.get_jobs()
+        if not mode or jobs == 1:
+            with tar_open(output, 'w:'+mode) as tar:
+                for fname, dest in files.items():
+                    logger.debug('Adding '+fname+' as '+dest)
+                    tar.add(fname, dest)
+            return
+        with open(output, 'wb') as f:
+            compressor = BlocksCompressor(f, TAR_COMPRESSORS[mode], jobs)
+            try:
+                with tar_open(fileobj=compressor, mode='w|') as tar:
+                    for fname, dest in files.items():
+                        logger.debug('Adding '+fname+' as '+dest)
+                        tar.add(fname, dest)
+            finally:
+                compressor.close()
 
     def create_rar(self, output, files):
         if os.path.isfile(output):
@@ -117,10 +319,26 @@ class CompressOptions(BaseOptions):
         command = self.ensure_tool('RAR')
         if command is None:
             return
+        base_cmd = [command, 'a', '-m5', '-ep']
+        if self.jobs:
+            # RAR supports up to 64 threads
+            base_cmd.append('-mt'+str(min(self.jobs, 64)))
+        if self.compression == 'auto':
+            base_cmd.append('-ms'+';'.join(sorted(COMPRESSED_EXTS)))
+        # The destination dir is a command line option, so we run rar once for each destination dir
+        dirs = OrderedDict()
         for fname, dest in files.items():
             logger.debugl(2, 'Adding '+fname+' as '+dest)
-            cmd = [command, 'a', '-m5', '-ep', '-ap'+os.path.dirname(dest), output, fname]
-            run_command(cmd, err_msg='Failed to invoke rar command, error {ret}', err_lvl=WRONG_INSTALL)
+            dirs.setdefault(os.path.dirname(dest), []).append(fname)
+        for dest_dir, names in dirs.items():
+            with NamedTemporaryFile(suffix='.lst', delete=False) as f:
+                f.write(b''.join(os.fsencode(n)+b'\n' for n in names))
+                list_name = f.name
+            try:
+                cmd = base_cmd+['-ap'+dest_dir, output, '@'+list_name]
+                run_command(cmd, err_msg='Failed to invoke rar command, error {ret}', err_lvl=WRONG_INSTALL)
+            finally:
+                os.remove(list_name)
 
     def solve_extension(self):
         if self.format == 'ZIP':
@@ -207,6 +425,15 @@ class CompressOptions(BaseOptions):
         files, _ = self.get_files(output, no_out_run=True)
         return files.keys()
 
+    def get_used_outputs(self):
+        used = []
+        for f in self.files:
+            if f.from_output:
+                out = RegOutput.get_output(f.from_output)
+                if out is not None and (out.run_by_default or not self.skip_not_run):
+                    used.append(f.from_output)
+        return used
+
     def get_categories(self):
         cats = set()
         for f in self.files:
@@ -277,3 +504,6 @@ class Compress(BaseOutput):  # noqa: F821
 
     def get_dependencies(self):
         return self.options.get_dependencies()
+
+    def get_used_outputs(self):
+        return self.options.get_used_outputs()
@@ -18,6 +18,7 @@ from .optionable import Optionable
 from .out_base_3d import Base3DOptions
 from .registrable import RegOutput
 from .macros import macros, document, output_class  # noqa: F401
+from . import board_snapshot
 from . import log
 
 logger = log.get_logger()
@@ -125,9 +126,8 @@ class Copy_FilesOptions(Base3DOptions):
         aliases = {}
         extra_files = []
         added = set()
-        for m in GS.get_modules():
-            id = m.GetFPID()
-            lib_nick = str(id.GetLibNickname())
+        fps = board_snapshot.get().footprints
+        for lib_nick, name in zip(fps.lib_nickname, fps.package):
             src_alias = KiConf.fp_nick_to_path(lib_nick)
             if src_alias is None:
                 logger.warning(f'{W_MISSLIB}Missing footprint library `{lib_nick}`')
@@ -140,7 +140,6 @@ class Copy_FilesOptions(Base3DOptions):
                 new_alias.uri = os.path.join(out_lib_base_prj, lib_nick+'.pretty')
                 aliases[lib_nick] = new_alias
 
-            name = str(id.GetLibItemName())
             mod_fname = name+'.kicad_mod'
             footprint_src = os.path.join(src_lib, mod_fname)
             if not os.path.isfile(footprint_src):
@@ -349,6 +348,9 @@ class Copy_FilesOptions(Base3DOptions):
         files = self.get_files(no_out_run=True)
         return sorted([v for v, _ in files if v is not None])
 
+    def get_used_outputs(self):
+        return [f.source for f in self.files if f.source_type == 'output']
+
     def run(self, output):
         super().run(output)
         # Output file name
@@ -406,6 +408,9 @@ class Copy_Files(BaseOutput):  # noqa: F821
     def get_dependencies(self):
         return self.options.get_dependencies()
 
+    def get_used_outputs(self):
+        return self.options.get_used_outputs()
+
     def run(self, output_dir):
         # No output member, just a dir
         self.options.output_dir = output_dir
@@ -23,21 +23,36 @@ from hashlib import sha1
 from itertools import combinations
 import os
 import re
-from shutil import rmtree, copy2
+from shutil import rmtree, copy2, move
 from subprocess import CalledProcessError
 from tempfile import mkdtemp
 from .error import KiPlotConfigurationError
 from .gs import GS
-from .kiplot import load_any_sch, run_command, config_output, get_output_dir, run_output
+from .kiplot import load_any_sch, run_command, config_output, get_output_dir, run_output, run_in_parallel
 from .layer import Layer
 from .misc import DIFF_TOO_BIG, FAILED_EXECUTE
 from .registrable import RegOutput
-from .out_any_diff import AnyDiffOptions
+from .out_any_diff import AnyDiffOptions, evict_diff_cache
 from .macros import macros, document, output_class  # noqa: F401
 from . import log
 
 logger = log.get_logger()
 STASH_MSG = 'KiBot_Changes_Entry'
+# Size of the blocks used to compute the hashes
+HASH_CHUNK = 1 << 20
+
+
+class DiffCompare(object):
+    """ Data needed to compare two files already in the cache """
+    def __init__(self, old_hash, old_desc, old_name, new_hash, new_desc, new_name, name, name_ori):
+        self.old_hash = old_hash
+        self.old_desc = old_desc
+        self.old_name = old_name
+        self.new_hash = new_hash
+        self.new_desc = new_desc
+        self.new_name = new_name
+        self.name = name
+        self.name_ori = name_ori
 
 
 class DiffOptions(AnyDiffOptions):
@@ -72,7 +87,8 @@ class DiffOptions(AnyDiffOptions):
                 This is an extension of the `output` mode.
                 If `old` is also `multivar` then it becomes the reference, otherwise we compare using pairs of variants """
             self.cache_dir = ''
-            """ Directory to cache the intermediate files. Leave it blank to disable the cache """
+            """ Directory to cache the intermediate files. Leave it blank to use the shared cache (see the
+                `cache_diff` global option), or to disable the cache when the shared cache is disabled """
             self.diff_mode = 'red_green'
             """ [red_green,stats,2color] In the `red_green` mode added stuff is green and red when removed.
                 The `stats` mode is used to measure the amount of difference. In this mode all
@@ -113,6 +129,9 @@ class DiffOptions(AnyDiffOptions):
             """ Color used for the added stuff in the '2color' mode """
             self.color_removed = '#FF0000'
             """ Color used for the removed stuff in the '2color' mode """
+            self.jobs = 1
+            """ [0,256] Number of comparisons done in parallel when using the `multivar` type.
+                The variants are generated only once. Use 0 to run one job for each CPU """
         super().__init__()
         self.add_to_doc("zones", "Be careful with the cache when changing this setting")
 
@@ -134,13 +153,25 @@ class DiffOptions(AnyDiffOptions):
     def get_targets(self, out_dir):
         return [self._parent.expand_filename(out_dir, self.output)]
 
+    @staticmethod
+    def get_shared_cache_dir():
+        if GS.global_cache_diff_dir:
+            dir = os.path.abspath(os.path.expanduser(GS.global_cache_diff_dir))
+            try:
+                os.makedirs(dir, exist_ok=True)
+            except OSError as e:
+                logger.debug(f'Unable to create the diff cache dir `{dir}`: {e}')
+                return None
+            return dir
+        return GS.get_cache_dir('diff')
+
     def get_digest(self, file_path, restart=True):
         logger.debug('Hashing '+file_path)
         if restart:
             self.h = sha1()
         with open(file_path, 'rb') as file:
             while True:
-                chunk = file.read(self.h.block_size)
+                chunk = file.read(HASH_CHUNK)
                 if not chunk:
                     break
                 self.h.update(chunk)
@@ -159,7 +190,7 @@ class DiffOptions(AnyDiffOptions):
             name, to_remove = self.write_empty_file(name, create_tmp=True)
             self._to_remove.extend(to_remove)
         hash = self.get_digest(name)
-        self.add_to_cache(name, hash)
+        self.name_used_for_cache = self.add_to_cache(name, hash)
         return hash
 
     def cache_sch(self, name, force_exist):
@@ -182,7 +213,7 @@ class DiffOptions(AnyDiffOptions):
             for f in files[1:]:
                 hash = self.get_digest(f, restart=False)
         hash = 'sch'+hash
-        self.add_to_cache(name, hash)
+        self.name_used_for_cache = self.add_to_cache(name, hash)
         return hash
 
     def cache_file(self, name=None, force_exist=False):
@@ -451,18 +482,32 @@ class DiffOptions(AnyDiffOptions):
     def create_layers_incl(self, layers):
         return self.save_layers_incl(Layer.solve(layers)) if self.pcb and not isinstance(layers, type) else None
 
-    def do_compare(self, old, old_type, new, new_type, name, name_ori):
-        dir_name = os.path.dirname(name)
-        file_name = os.path.basename(name)
-        # Populate the cache
-        old_hash = self.cache_obj(old, old_type)
-        gh1 = self.git_hash
-        name_used_for_old = self.name_used_for_cache
-        new_hash = self.cache_obj(new, new_type)
-        gh2 = self.git_hash
-        name_used_for_new = self.name_used_for_cache
-        # Compute the diff using the cache
-        cmd = [self.command, '--no_reader', '--new_file_hash', new_hash, '--old_file_hash', old_hash,
+    def cache_obj_once(self, name, type):
+        """ Populates the cache, files and outputs are processed only once in each run.
+            Returns the hash, the description and the name of the file used """
+        key = (name, type)
+        res = self._cached_objs.get(key)
+        if res is None:
+            hash = self.cache_obj(name, type)
+            res = (hash, self.git_hash, self.name_used_for_cache)
+            if type in ('file', 'output'):
+                self._cached_objs[key] = res
+        return res
+
+    def prepare_compare(self, old, old_type, new, new_type, name, name_ori):
+        """ Populates the cache for both files """
+        old_hash, gh1, name_used_for_old = self.cache_obj_once(old, old_type)
+        new_hash, gh2, name_used_for_new = self.cache_obj_once(new, new_type)
+        return DiffCompare(old_hash, gh1, name_used_for_old, new_hash, gh2, name_used_for_new, name, name_ori)
+
+    def run_compare(self, c, warm=(), private_dir=False):
+        """ Computes the diff using the cache.
+            The entries in `warm` were already used for a comparison, so we just read them.
+            Use `private_dir` when running various comparisons at the same time, KiDiff creates temporal files using
+            fixed names in the output dir. """
+        dir_name = mkdtemp() if private_dir else os.path.dirname(c.name)
+        file_name = os.path.basename(c.name)
+        cmd = [self.command, '--no_reader', '--new_file_hash', c.new_hash, '--old_file_hash', c.old_hash,
                '--cache_dir', self.cache_dir, '--output_dir', dir_name, '--output_name', file_name,
                '--diff_mode', self.diff_mode, '--fuzz', str(self.fuzz), '--no_exist_check',
                '--added_2color', self.color_added, '--removed_2color', self.color_removed]
@@ -475,29 +520,69 @@ class DiffOptions(AnyDiffOptions):
             cmd.append('--only_different')
         if not self.only_first_sch_page:
             cmd.append('--all_pages')
-        cmd.extend([name_used_for_old, name_used_for_new])
+        cmd.extend([c.old_name, c.new_name])
         if GS.debug_enabled:
             cmd.insert(1, '-'+'v'*GS.debug_level)
         try:
-            run_command(cmd, just_raise=True)
+            # KiDiff stores the PNGs for the compared files in the cache
+            with self.locked_cache(c.old_hash, c.new_hash, shared=warm):
+                run_command(cmd, just_raise=True)
+            if private_dir:
+                move(os.path.join(dir_name, file_name), c.name)
         except CalledProcessError as e:
             if e.returncode == 10:
                 GS.exit_with_error('Diff above the threshold', DIFF_TOO_BIG)
             GS.exit_with_error(None, FAILED_EXECUTE, e)
+        finally:
+            if private_dir:
+                rmtree(dir_name, ignore_errors=True)
+
+    def add_link(self, c):
         if self.add_link_id:
-            name_comps = os.path.splitext(name_ori)
-            target = name_comps[0]+'_'+gh1+'-'+gh2+name_comps[1]
+            name_comps = os.path.splitext(c.name_ori)
+            target = name_comps[0]+'_'+c.old_desc+'-'+c.new_desc+name_comps[1]
             if self.copy_instead_of_link:
-                copy2(name, target)
+                copy2(c.name, target)
             else:
                 if os.path.isfile(target):
                     os.remove(target)
-                os.symlink(os.path.basename(name), target)
+                os.symlink(os.path.basename(c.name), target)
+
+    def do_compare(self, old, old_type, new, new_type, name, name_ori):
+        c = self.prepare_compare(old, old_type, new, new_type, name, name_ori)
+        self.run_compare(c)
+        self.add_link(c)
+
+    def run_compares(self, compares):
+        """ Runs various comparisons in parallel.
+            The first comparison using a cache entry writes to it (KiDiff adds PNGs), so we run them in batches.
+            A batch never contains two comparisons writing the same entry. """
+        private_dir = len(compares) > 1 and self.jobs != 1
+        warm = set()
+        pending = compares
+        while pending:
+            batch = []
+            rest = []
+            busy = set()
+            for c in pending:
+                cold = {c.old_hash, c.new_hash}-warm
+                if cold & busy:
+                    rest.append(c)
+                    continue
+                busy |= cold
+                batch.append(c)
+            logger.debug(f'Running {len(batch)} comparisons, {len(rest)} pending')
+            run_in_parallel(lambda c: self.run_compare(c, warm, private_dir), batch, self.jobs)
+            warm |= busy
+            pending = rest
+        for c in compares:
+            self.add_link(c)
 
     def run(self, name):
         self.command = self.ensure_tool('KiDiff')
         self._to_remove = []
         self._worktrees_to_remove = []
+        self._cached_objs = {}
         if self.old_type == 'git' or self.new_type == 'git':
             self.git_command = self.ensure_tool('Git')
         if not self.pcb:
@@ -505,6 +590,9 @@ class DiffOptions(AnyDiffOptions):
             self.ensure_tool('KiAuto')
         # Solve the cache dir
         self.dirs_to_remove = []
+        if not self.cache_dir and GS.global_cache_diff:
+            self.cache_dir = self.get_shared_cache_dir()
+            self._shared_cache = self.cache_dir is not None
         if not self.cache_dir:
             self.cache_dir = mkdtemp()
             self.dirs_to_remove.append(self.cache_dir)
@@ -516,23 +604,27 @@ class DiffOptions(AnyDiffOptions):
             if self.new_type == 'multivar' and self.old_type != 'multivar':
                 # Special case, we generate various files
                 base_id = self._expand_id
+                compares = []
                 for pair in combinations(self.new, 2):
                     logger.debug('Using variants '+str(pair))
                     logger.info(' - {} vs {}'.format(pair[0], pair[1]))
                     self._expand_id = '{}_variants_{}_VS_{}'.format(base_id, pair[0], pair[1])
                     name = self._parent.expand_filename(self._parent.output_dir, self.output)
-                    self.do_compare(pair[0], 'output', pair[1], 'output', name, name_ori)
+                    compares.append(self.prepare_compare(pair[0], 'output', pair[1], 'output', name, name_ori))
                 self._expand_id = base_id
+                self.run_compares(compares)
             elif self.new_type == 'multivar' and self.old_type == 'multivar':
                 # Special case, we generate various files
                 base_id = self._expand_id
+                compares = []
                 for new_variant in self.new:
                     ref_name = self.old if self.old else 'current'
                     logger.info(' - {} vs {}'.format(ref_name, new_variant))
                     self._expand_id = '{}_variant_{}'.format(base_id, new_variant)
                     name = self._parent.expand_filename(self._parent.output_dir, self.output)
-                    self.do_compare(self.old, 'file', new_variant, 'output', name, name_ori)
+                    compares.append(self.prepare_compare(self.old, 'file', new_variant, 'output', name, name_ori))
                 self._expand_id = base_id
+                self.run_compares(compares)
             else:
                 self.do_compare(self.old, self.old_type, self.new, self.new_type, name, name_ori)
         finally:
@@ -546,6 +638,8 @@ class DiffOptions(AnyDiffOptions):
             # Remove any git worktree that we created
             for w in self._worktrees_to_remove:
                 self.remove_git_worktree(w)
+            if self._shared_cache:
+                evict_diff_cache(self.cache_dir, GS.global_cache_diff_max_size*1024*1024)
 
 
 @output_class
@@ -557,6 +651,8 @@ class Diff(BaseOutput):  # noqa: F821
         super().__init__()
         self._category = ['PCB/docs', 'Schematic/docs']
         self._any_related = True
+        # Depends on the git history, we can't skip it
+        self._incremental = False
         with document:
             self.options = DiffOptions
             """ *[dict] Options for the `diff` output """
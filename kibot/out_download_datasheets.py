@@ -3,9 +3,19 @@
 # Copyright (c) 2021 Instituto Nacional de Tecnología Industrial
 # License: GPL-3.0
 # Project: KiBot (formerly KiPlot)
+from concurrent.futures import ThreadPoolExecutor
+from glob import glob
+from hashlib import sha256
+import json
 import os
 import re
 import requests
+from requests.adapters import HTTPAdapter
+from shutil import copyfile, rmtree
+from tempfile import mkdtemp
+from threading import Lock, Semaphore
+from time import sleep
+from urllib.parse import urlparse
 from .out_base import VariantOptions
 from .fil_base import DummyFilter
 from .error import KiPlotConfigurationError
@@ -20,6 +30,180 @@ def is_url(ds):
     return ds.startswith('http://') or ds.startswith('https://')
 
 
+# HTTP status codes that worth a retry
+RETRY_STATUS = {408, 429, 500, 502, 503, 504}
+
+
+class DatasheetsFetcher(object):
+    """ Downloads URLs using a pool of threads and a shared session.
+        Limits the concurrent downloads from the same host and retries failed downloads.
+        The downloaded files are stored in the cache dir, and the ETag/Last-Modified headers
+        are used to avoid downloading them again. The least recently used files are removed
+        when the cache exceeds `cache_max_size` MB. """
+    def __init__(self, jobs, jobs_per_host, retries, retry_delay, timeout, cache, cache_max_size=500):
+        super().__init__()
+        self.jobs = jobs
+        self.jobs_per_host = jobs_per_host
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers['User-Agent'] = USER_AGENT
+        adapter = HTTPAdapter(pool_connections=jobs, pool_maxsize=jobs)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.cache_dir = GS.get_cache_dir('datasheets') if cache else None
+        self.use_cache = self.cache_dir is not None
+        self.max_size = cache_max_size*1024*1024
+        if not self.use_cache:
+            self.cache_dir = mkdtemp()
+        self.lock = Lock()
+        self.hosts = {}
+        self.results = {}
+
+    def host_semaphore(self, url):
+        host = urlparse(url).netloc
+        with self.lock:
+            sem = self.hosts.get(host)
+            if sem is None:
+                sem = self.hosts[host] = Semaphore(self.jobs_per_host)
+        return sem
+
+    def load_meta(self, meta_name):
+        if not self.use_cache:
+            return {}
+        try:
+            with open(meta_name, 'rt') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save(self, r, url, data_name, meta_name):
+        """ Stores the downloaded data, and the information needed to validate it """
+        tmp_name = data_name+'.'+str(os.getpid())+'.tmp'
+        try:
+            with open(tmp_name, 'wb') as f:
+                for chunk in r.iter_content(chunk_size=65536):
+                    f.write(chunk)
+            os.replace(tmp_name, data_name)
+        finally:
+            if os.path.isfile(tmp_name):
+                os.remove(tmp_name)
+        if not self.use_cache:
+            return
+        meta = {'url': url, 'etag': r.headers.get('ETag'), 'last_modified': r.headers.get('Last-Modified')}
+        tmp_name = meta_name+'.'+str(os.getpid())+'.tmp'
+        with open(tmp_name, 'wt') as f:
+            json.dump(meta, f)
+        os.replace(tmp_name, meta_name)
+
+    def request(self, url, headers):
+        """ GET with retries, returns the response or the error message """
+        attempt = 0
+        while True:
+            error = None
+            try:
+                r = self.session.get(url, allow_redirects=True, headers=headers, timeout=self.timeout, stream=True)
+                if r.status_code not in RETRY_STATUS:
+                    return r, None
+                error = 'Failed with status '+str(r.status_code)
+                r.close()
+            except requests.exceptions.Timeout:
+                error = 'Timeout'
+            except requests.exceptions.SSLError:
+                return None, 'SSL Error'
+            except requests.exceptions.TooManyRedirects:
+                return None, 'More than 30 redirections'
+            except requests.exceptions.ConnectionError:
+                error = 'Connection'
+            except requests.exceptions.RequestException as e:
+                return None, str(e)
+            if attempt >= self.retries:
+                return None, error
+            delay = self.retry_delay*(2**attempt)
+            attempt += 1
+            logger.debug('- {} downloading `{}`, retry {} in {} s'.format(error, url, attempt, delay))
+            sleep(delay)
+
+    def fetch(self, url):
+        """ Downloads an URL, returns the name of the file containing the data, or an error message """
+        base = os.path.join(self.cache_dir, sha256(url.encode()).hexdigest())
+        data_name = base+'.data'
+        meta_name = base+'.json'
+        headers = {}
+        meta = self.load_meta(meta_name)
+        if meta.get('url') == url and os.path.isfile(data_name):
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+        with self.host_semaphore(url):
+            r, error = self.request(url, headers)
+            if error:
+                return None, error
+            with r:
+                if r.status_code == 304 and headers:
+                    logger.debug('- Not modified: '+url)
+                    # Mark it as recently used
+                    os.utime(data_name)
+                    return data_name, None
+                if r.status_code != 200:
+                    return None, 'Failed with status '+str(r.status_code)
+                try:
+                    self.save(r, url, data_name, meta_name)
+                except (OSError, requests.exceptions.RequestException) as e:
+                    return None, str(e)
+        logger.debug('- Downloaded: '+url)
+        return data_name, None
+
+    def fetch_all(self, urls):
+        """ Downloads a list of URLs concurrently """
+        if not urls:
+            return
+        logger.debug('Downloading {} URLs using {} threads'.format(len(urls), self.jobs))
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            for url, res in zip(urls, executor.map(self.fetch, urls)):
+                self.results[url] = res
+
+    def get(self, url):
+        """ Result for an URL, downloaded on demand if not already fetched """
+        res = self.results.get(url)
+        if res is None:
+            res = self.results[url] = self.fetch(url)
+        return res
+
+    def evict(self):
+        """ Removes the least recently used datasheets until the cache fits in the configured size """
+        entries = []
+        total = 0
+        for f in glob(os.path.join(self.cache_dir, '*.data')):
+            try:
+                st = os.stat(f)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, f))
+            total += st.st_size
+        if total <= self.max_size:
+            return
+        for _, size, f in sorted(entries):
+            logger.debug('- Removing old datasheet from the cache '+f)
+            for name in (f, f[:-5]+'.json'):
+                try:
+                    os.remove(name)
+                except OSError:
+                    pass
+            total -= size
+            if total <= self.max_size:
+                break
+
+    def close(self):
+        self.session.close()
+        if self.use_cache:
+            self.evict()
+        else:
+            rmtree(self.cache_dir, ignore_errors=True)
+
+
 class Download_Datasheets_Options(VariantOptions):
     _vars_regex = re.compile(r'\$\{([^\}]+)\}')
 
@@ -38,8 +222,27 @@ class Download_Datasheets_Options(VariantOptions):
                 It only makes sense if the `output` field makes their output different """
             self.link_repeated = True
             """ Instead of download things we already downloaded use symlinks """
+            self.jobs = 8
+            """ [1,64] Number of concurrent downloads. Use 1 to download them one by one """
+            self.jobs_per_host = 2
+            """ [1,64] Maximum number of concurrent downloads from the same server """
+            self.retries = 2
+            """ [0,10] Number of retries for downloads failing due to time-outs, connection problems or
+                temporal server errors (HTTP 408, 429 and 5xx) """
+            self.retry_delay = 1
+            """ [0,60] Time in seconds to wait before the first retry. It's doubled for each retry """
+            self.timeout = 20
+            """ [1,600] Time-out in seconds for each download """
+            self.cache = False
+            """ Keep a copy of the downloaded datasheets in the KiBot cache dir (`~/.cache/kibot/datasheets`).
+                The *ETag* and *Last-Modified* information is used to avoid downloading unchanged datasheets """
+            self.cache_max_size = 500
+            """ [1,100000] Maximum size of the datasheets cache in MB. When exceeded the least recently used
+                datasheets are removed """
         # Used to collect the targets
         self._dry = False
+        self._fetcher = None
+        self._names = {}
         self._unknown_is_error = True
 
     def config(self, parent):
@@ -68,22 +271,10 @@ class Download_Datasheets_Options(VariantOptions):
         elif not os.path.isfile(dest):
             # Download
             if not self._dry:
-                try:
-                    r = requests.get(ds, allow_redirects=True, headers={'User-Agent': USER_AGENT}, timeout=20)
-                except requests.exceptions.ReadTimeout:
-                    return self.do_warning('Timeout', ds, c)
-                except requests.exceptions.SSLError:
-                    return self.do_warning('SSL Error', ds, c)
-                except requests.exceptions.TooManyRedirects:
-                    return self.do_warning('More than 30 redirections', ds, c)
-                except requests.exceptions.ConnectionError:
-                    return self.do_warning('Connection', ds, c)
-                except requests.exceptions.RequestException as e:
-                    return self.do_warning(str(e), ds, c)
-                if r.status_code != 200:
-                    return self.do_warning('Failed with status '+str(r.status_code), ds, c)
-                with open(dest, 'wb') as f:
-                    f.write(r.content)
+                fname, error = self._fetcher.get(ds)
+                if error:
+                    return self.do_warning(error, ds, c)
+                copyfile(fname, dest)
             self._downloaded.add(name)
             self._created.append(os.path.relpath(dest))
         elif self._dry:
@@ -92,7 +283,14 @@ class Download_Datasheets_Options(VariantOptions):
 
     def out_name(self, c):
         """ Compute the name of the output file.
-            Replaces `${FIELD}` and %X. """
+            Replaces `${FIELD}` and %X.
+            The names are computed only once for each component, to avoid repeating the warnings. """
+        out = self._names.get(id(c))
+        if out is None:
+            out = self._names[id(c)] = self.compute_out_name(c)
+        return out
+
+    def compute_out_name(self, c):
         out = ''
         last = 0
         pattern = self.output
@@ -113,11 +311,38 @@ class Download_Datasheets_Options(VariantOptions):
         out = self.expand_filename_sch(out)
         return out.replace('/', '_')
 
+    def prefetch(self, output_dir):
+        """ Download the needed URLs concurrently """
+        urls = {}
+        for c in self._comps:
+            if not c.included or (not c.fitted and not self.dnf):
+                continue
+            ds = c.get_field_value(self.field)
+            if ds and is_url(ds) and ds not in urls:
+                urls[ds] = os.path.join(output_dir, self.out_name(c))
+        self._fetcher.fetch_all([url for url, dest in urls.items() if not os.path.isfile(dest)])
+
     def run(self, output_dir):
         if not self.dnf_filter and not self.variant:
             # Add a dummy filter to force the creation of a components list
             self.dnf_filter = DummyFilter()
         super().run(output_dir)
+        # Names computed for the components (by id), valid only during this run
+        self._names = {}
+        if not self._dry:
+            self._fetcher = DatasheetsFetcher(self.jobs, self.jobs_per_host, self.retries, self.retry_delay,
+                                              self.timeout, self.cache, self.cache_max_size)
+            try:
+                if self.jobs > 1:
+                    self.prefetch(output_dir)
+                self.process(output_dir)
+            finally:
+                self._fetcher.close()
+                self._fetcher = None
+        else:
+            self.process(output_dir)
+
+    def process(self, output_dir):
         self._urls = {}
         self._downloaded = set()
         self._created = []
@@ -32,6 +32,8 @@ class InfoOptions(BaseOptions):
         self._expand_id = 'info'
         self._expand_ext = 'txt'
         self._none_related = True
+        # Reports the environment, we can't skip it
+        self._incremental = False
 
     def get_targets(self, out_dir):
         return [self._parent.expand_filename(out_dir, self.output)]
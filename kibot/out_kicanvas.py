@@ -212,6 +212,8 @@ class KiCanvas(BaseOutput):  # noqa: F821
         super().__init__()
         self._category = ['PCB/docs', 'Schematic/docs']
         self._any_related = True
+        # Uses the script from the KiCanvas web, we can't skip it
+        self._incremental = False
         with document:
             self.output = GS.def_global_output
             """ *Filename for the output (%i=kicanvas, %x=html) """
@@ -19,13 +19,17 @@ Dependencies:
     role: Compare schematics
     version: 2.2.0
 """
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import datetime
 import glob
+import hashlib
+from multiprocessing import cpu_count
 import pwd
 import os
-from shutil import copy2, rmtree
+from shutil import copy2, copytree, rmtree
 from subprocess import CalledProcessError
 from tempfile import mkdtemp
+from threading import Lock
 from .error import KiPlotConfigurationError
 from .gs import GS
 from .kicad.color_theme import load_color_theme
@@ -38,6 +42,11 @@ from . import log
 
 logger = log.get_logger()
 HASH_LOCAL = '_local_'
+# Stores the hash of the content used to generate the images of a commit
+CONTENT_KEY_FILE = '.kibot_content'
+# Files that affects the generated images
+CONTENT_EXTS = ('.kicad_pcb', '.kicad_sch', '.sch', '.kicad_pro', '.pro', '.kicad_prl', '.kicad_wks', '.lib', '.kicad_sym',
+                'sym-lib-table', 'fp-lib-table')
 UNDEF_COLOR = '#DBDBDB'
 LAYER_COLORS_HEAD = """/* ==============================
    Layer colors
@@ -68,7 +77,12 @@ class KiRiOptions(AnyDiffOptions):
             """ Starting point for the commits, can be a branch, a hash, etc.
                 Note that this can be a revision-range, consult the gitrevisions manual for more information """
             self.keep_generated = False
-            """ *Avoid PCB and SCH images regeneration. Useful for incremental usage """
+            """ *Avoid PCB and SCH images regeneration. Useful for incremental usage.
+                Note that commits are always skipped when their files and the options used to generate the
+                images didn't change """
+            self.jobs = 1
+            """ [0,256] Number of commits processed in parallel, each one uses its own git worktree.
+                Use 0 to run one job for each CPU """
         super().__init__()
         self.add_to_doc("zones", "Be careful with the *keep_generated* option when changing this setting")
         self._kiri_mode = True
@@ -269,6 +283,128 @@ class KiRiOptions(AnyDiffOptions):
         pcb_dirty = self.git_dirty(GS.pcb_file)
         return hashes, sch_dirty, pcb_dirty, sch_files
 
+    def get_options_key(self):
+        """ Options that affect the generated images """
+        opts = [self.command, str(self._kiri_mode)]
+        self.add_zones_ops(opts)
+        if self.incl_file:
+            with open(self.incl_file, 'rt') as f:
+                opts.append(f.read())
+        return '|'.join(opts)
+
+    def get_content_keys(self, hashes):
+        """ Computes a key for each commit using the hashes of the blobs that affect the generated images.
+            We use the whole tree, sub-sheets and libs can be anywhere in the repo (i.e. `../lib/sym-lib-table`) """
+        opts = self.get_options_key()
+        keys = {}
+        for h in hashes:
+            hash = h[0]
+            content = [opts]
+            for ln in self.run_git(['ls-tree', '-r', '-z', '--full-tree', hash]).split('\0'):
+                # <mode> <type> <object>\t<file>
+                info, _, fname = ln.partition('\t')
+                if fname.endswith(CONTENT_EXTS) or info.split(' ')[1:2] == ['commit']:
+                    content.append(ln)
+            keys[hash] = hashlib.sha256('\n'.join(content).encode()).hexdigest()
+        return keys
+
+    @staticmethod
+    def read_content_key(dst_dir):
+        try:
+            with open(os.path.join(dst_dir, CONTENT_KEY_FILE), 'rt') as f:
+                return f.read().strip()
+        except OSError:
+            return None
+
+    def process_commit(self, hash):
+        """ Generates the images for a commit using a new worktree.
+            Runs in a worker thread, git operations that modify the repo are serialized. """
+        git_tmp_wd = mkdtemp()
+        with self._git_lock:
+            self._worktrees.append(git_tmp_wd)
+            logger.debug('Checking out '+hash+' to '+git_tmp_wd)
+            self.run_git(['worktree', 'add', '--detach', '--force', git_tmp_wd, hash])
+            self.run_git(['submodule', 'update', '--init', '--recursive'], cwd=git_tmp_wd)
+        # Generate SVGs for the schematic
+        name_sch = self.do_cache(self.sch_rel_name, git_tmp_wd, hash)
+        # Generate SVGs for the PCB
+        self.do_cache(self.pcb_rel_name, git_tmp_wd, hash)
+        # List of layers
+        self.save_pcb_layers(hash)
+        return git_tmp_wd, name_sch
+
+    def copy_commit(self, src_dir, hash):
+        """ Same files and options, just copy the images """
+        copytree(src_dir, os.path.join(self.cache_dir, hash[:7]))
+
+    def process_commits(self, hashes):
+        """ Generates the images for all the commits that need it """
+        keys = self.get_content_keys(hashes)
+        total = len(hashes)
+        done = 0
+        # Commits already generated, indexed by content
+        generated = {}
+        todo = []
+        for h in hashes:
+            hash = h[0]
+            dst_dir = os.path.join(self.cache_dir, hash[:7])
+            if os.path.isdir(dst_dir):
+                same_content = self.read_content_key(dst_dir) == keys[hash]
+                if self.keep_generated or same_content:
+                    done += 1
+                    logger.info(f'  - [{done}/{total}] {hash[:7]} already generated')
+                    if same_content:
+                        generated.setdefault(keys[hash], dst_dir)
+                    continue
+                rmtree(dst_dir)
+            todo.append(hash)
+        self._git_lock = Lock()
+        self._worktrees = []
+        # Commits with the same content as a commit we are generating, indexed by content
+        waiting = {}
+        try:
+            with ThreadPoolExecutor(max_workers=self.jobs if self.jobs > 0 else cpu_count()) as executor:
+                futures = {}
+                for hash in todo:
+                    key = keys[hash]
+                    if key in generated:
+                        self.copy_commit(generated[key], hash)
+                        done += 1
+                        logger.info(f'  - [{done}/{total}] {hash[:7]} same content as {os.path.basename(generated[key])}')
+                    elif key in waiting:
+                        waiting[key].append(hash)
+                    else:
+                        waiting[key] = []
+                        futures[executor.submit(self.process_commit, hash)] = hash
+                try:
+                    for future in as_completed(futures):
+                        hash = futures[future]
+                        git_tmp_wd, name_sch = future.result()
+                        # Schematic hierarchy, loading the schematic isn't thread safe
+                        self.save_sch_sheet(hash, name_sch)
+                        # The workers are still adding worktrees
+                        with self._git_lock:
+                            self.remove_git_worktree(git_tmp_wd)
+                            self._worktrees.remove(git_tmp_wd)
+                        # Mark it as complete
+                        dst_dir = os.path.join(self.cache_dir, hash[:7])
+                        with open(os.path.join(dst_dir, CONTENT_KEY_FILE), 'wt') as f:
+                            f.write(keys[hash]+'\n')
+                        done += 1
+                        logger.info(f'  - [{done}/{total}] {hash[:7]} generated')
+                        for other in waiting.pop(keys[hash]):
+                            self.copy_commit(dst_dir, other)
+                            done += 1
+                            logger.info(f'  - [{done}/{total}] {other[:7]} same content as {hash[:7]}')
+                except BaseException:
+                    # Don't start more commits
+                    for future in futures:
+                        future.cancel()
+                    raise
+        finally:
+            for git_tmp_wd in self._worktrees:
+                self.remove_git_worktree(git_tmp_wd)
+
     def run(self, name):
         self.init_tools(self._parent.output_dir)
         hashes, sch_dirty, pcb_dirty, sch_files = self.collect_hashes()
@@ -281,34 +417,7 @@ class KiRiOptions(AnyDiffOptions):
         self.create_layers_incl(self.layers)
         self.solve_layer_colors()
         try:
-            git_tmp_wd = None
-            try:
-                for h in hashes:
-                    hash = h[0]
-                    dst_dir = os.path.join(self.cache_dir, hash[:7])
-                    already_generated = os.path.isdir(dst_dir)
-                    if self.keep_generated and already_generated:
-                        logger.debug(f'- Images for {hash} already generated')
-                        continue
-                    if already_generated:
-                        rmtree(dst_dir)
-                    git_tmp_wd = mkdtemp()
-                    logger.debug('Checking out '+hash+' to '+git_tmp_wd)
-                    self.run_git(['worktree', 'add', '--detach', '--force', git_tmp_wd, hash])
-                    self.run_git(['submodule', 'update', '--init', '--recursive'], cwd=git_tmp_wd)
-                    # Generate SVGs for the schematic
-                    name_sch = self.do_cache(self.sch_rel_name, git_tmp_wd, hash)
-                    # Generate SVGs for the PCB
-                    self.do_cache(self.pcb_rel_name, git_tmp_wd, hash)
-                    # List of layers
-                    self.save_pcb_layers(hash)
-                    # Schematic hierarchy
-                    self.save_sch_sheet(hash, name_sch)
-                    self.remove_git_worktree(git_tmp_wd)
-                    git_tmp_wd = None
-            finally:
-                if git_tmp_wd:
-                    self.remove_git_worktree(git_tmp_wd)
+            self.process_commits(hashes)
             # Do we have modifications?
             if sch_dirty or pcb_dirty:
                 # Include the current files
@@ -353,6 +462,8 @@ class KiRi(BaseOutput):  # noqa: F821
         super().__init__()
         self._category = ['PCB/docs', 'Schematic/docs']
         self._both_related = True
+        # Depends on the git history, we can't skip it
+        self._incremental = False
         with document:
             self.options = KiRiOptions
             """ *[dict] Options for the `diff` output """
@@ -18,16 +18,18 @@ Dependencies:
   - from: ImageMagick
     role: Create outputs preview
 """
+from glob import glob
+from hashlib import sha1
 import os
 import subprocess
 import pprint
 from shutil import copy2
 from math import ceil
 from struct import unpack
-from tempfile import NamedTemporaryFile
+from tempfile import NamedTemporaryFile, mkstemp
 from .gs import GS
 from .optionable import BaseOptions
-from .kiplot import config_output, get_output_dir
+from .kiplot import config_output, get_output_dir, run_in_parallel
 from .misc import W_NOTYET, W_MISSTOOL, W_NOOUTPUTS
 from .registrable import RegOutput
 from .macros import macros, document, output_class  # noqa: F401
@@ -108,6 +110,8 @@ BIG_2_MID_REL = int(ceil(BIG_ICON/MID_ICON))
 IMAGEABLES_SIMPLE = {'png', 'jpg'}
 IMAGEABLES_GS = {'pdf', 'eps', 'ps'}
 IMAGEABLES_SVG = {'svg'}
+# Size of the blocks used to compute the hashes
+HASH_CHUNK = 1 << 20
 STYLE = """
 .cat-table { margin-left: auto; margin-right: auto; }
 .cat-table td { padding: 20px 24px; }
@@ -174,6 +178,14 @@ class Navigate_ResultsOptions(BaseOptions):
             """ *The name of a file to create at the main output directory linking to the home page """
             self.skip_not_run = False
             """ Skip outputs with `run_by_default: false` """
+            self.jobs = 0
+            """ [0,256] Number of previews created in parallel. Use 0 to run one job for each CPU """
+            self.cache = False
+            """ Keep a copy of the previews in the KiBot cache dir (`~/.cache/kibot/thumbnails`).
+                The previews are reused when the content of the file didn't change """
+            self.cache_max_size = 100
+            """ [1,100000] Maximum size of the previews cache in MB. When exceeded the least recently used
+                previews are removed """
         super().__init__()
         self._expand_id = 'navigate'
         self._expand_ext = 'html'
@@ -212,42 +224,62 @@ class Navigate_ResultsOptions(BaseOptions):
         self.copied_images[id] = name
         return name
 
-    def can_be_converted(self, ext):
+    def can_be_converted(self, ext, warn=True):
         if ext in IMAGEABLES_SVG and self.rsvg_command is None:
-            logger.warning(W_MISSTOOL+"Missing SVG to PNG converter")
+            if warn:
+                logger.warning(W_MISSTOOL+"Missing SVG to PNG converter")
             return False
         if ext in IMAGEABLES_GS and not self.ps2img_avail:
-            logger.warning(W_MISSTOOL+"Missing PS/PDF to PNG converter")
+            if warn:
+                logger.warning(W_MISSTOOL+"Missing PS/PDF to PNG converter")
             return False
         if ext in IMAGEABLES_SIMPLE and self.convert_command is None:
-            logger.warning(W_MISSTOOL+"Missing ImageMagick converter")
+            if warn:
+                logger.warning(W_MISSTOOL+"Missing ImageMagick converter")
             return False
         return ext in IMAGEABLES_SVG or ext in IMAGEABLES_GS or ext in IMAGEABLES_SIMPLE
 
+    def get_output_targets(self, out, navigate=False):
+        """ Targets for `out`, computed only once """
+        key = (out.name, navigate)
+        res = self.out_targets.get(key)
+        if res is None:
+            out_dir = get_output_dir(out.dir, out, dry=True)
+            res = out.get_navigate_targets(out_dir) if navigate else out.get_targets(out_dir)
+            self.out_targets[key] = res
+        return res
+
+    def get_rep_file_for_cat(self, cat):
+        """ Looks for a file that can represent this category """
+        if cat not in CAT_REP or self.convert_command is None:
+            return None
+        if cat in self.cat_rep_files:
+            return self.cat_rep_files[cat]
+        outs_rep = CAT_REP[cat]
+        rep_file = None
+        # Look in all outputs
+        for o in RegOutput.get_outputs():
+            # Is this one that can be used to represent it?
+            if o.type in outs_rep:
+                # Look the output targets
+                for tg in self.get_output_targets(o):
+                    ext = os.path.splitext(tg)[1][1:].lower()
+                    # Can be converted to an image?
+                    if os.path.isfile(tg) and self.can_be_converted(ext):
+                        rep_file = tg
+                        break
+                if rep_file:
+                    break
+        self.cat_rep_files[cat] = rep_file
+        return rep_file
+
     def get_image_for_cat(self, cat):
         img = None
         # Check if we have an output that can represent this category
-        if cat in CAT_REP and self.convert_command is not None:
-            outs_rep = CAT_REP[cat]
-            rep_file = None
-            # Look in all outputs
-            for o in RegOutput.get_outputs():
-                # Is this one that can be used to represent it?
-                if o.type in outs_rep:
-                    out_dir = get_output_dir(o.dir, o, dry=True)
-                    targets = o.get_targets(out_dir)
-                    # Look the output targets
-                    for tg in targets:
-                        ext = os.path.splitext(tg)[1][1:].lower()
-                        # Can be converted to an image?
-                        if os.path.isfile(tg) and self.can_be_converted(ext):
-                            rep_file = tg
-                            break
-                    if rep_file:
-                        break
-            if rep_file:
-                cat, _ = self.get_image_for_file(rep_file, cat, no_icon=True)
-                return cat
+        rep_file = self.get_rep_file_for_cat(cat)
+        if rep_file:
+            cat, _ = self.get_image_for_file(rep_file, cat, no_icon=True)
+            return cat
         if cat in CAT_IMAGE:
             img = self.copy(CAT_IMAGE[cat], BIG_ICON)
             cat_img = '<img src="{}" alt="{}" width="{}" height="{}">'.format(img, cat, BIG_ICON, BIG_ICON)
@@ -255,15 +287,100 @@ class Navigate_ResultsOptions(BaseOptions):
                    format(cat_img, cat))
         return cat
 
+    def get_thumbnail_name(self, file, out_name):
+        # Create a unique name using the output name and the generated file name
+        bfname = os.path.splitext(os.path.basename(file))[0]
+        return os.path.join(self.out_dir, 'images', out_name+'_'+bfname+'.png')
+
+    def get_thumbnail_key(self, file, ext, img, no_icon):
+        """ Hash for the content of the file and the options used to create its preview """
+        h = sha1()
+        with open(file, 'rb') as f:
+            while True:
+                chunk = f.read(HASH_CHUNK)
+                if not chunk:
+                    break
+                h.update(chunk)
+        h.update('{}|{}|{}'.format(ext, BIG_ICON, '' if no_icon else os.path.basename(img)).encode())
+        return h.hexdigest()
+
+    def make_thumbnail(self, thumbnail):
+        """ Creates a preview, reusing the cached one if available. Returns True on success. """
+        file, ext, img, fname, no_icon = thumbnail
+        cached = None
+        if self.cache_dir is not None:
+            cached = os.path.join(self.cache_dir, self.get_thumbnail_key(file, ext, img, no_icon)+'.png')
+            if os.path.isfile(cached):
+                logger.debug('- Using cached preview for {} ({})'.format(file, cached))
+                copy2(cached, fname)
+                # Mark it as recently used
+                os.utime(cached)
+                return True
+        if not self.convert_to_thumbnail(file, ext, img, fname, no_icon):
+            return False
+        if cached is not None:
+            # Don't let other runs see a partially copied file
+            fd, tmp_name = mkstemp(dir=self.cache_dir, suffix='.tmp')
+            os.close(fd)
+            copy2(fname, tmp_name)
+            os.replace(tmp_name, cached)
+        return True
+
+    def evict_cache(self):
+        """ Removes the least recently used previews until the cache fits in the configured size """
+        max_size = self.cache_max_size*1024*1024
+        entries = []
+        total = 0
+        for f in glob(os.path.join(self.cache_dir, '*.png')):
+            try:
+                st = os.stat(f)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, f))
+            total += st.st_size
+        if total <= max_size:
+            return
+        for _, size, f in sorted(entries):
+            logger.debug('- Removing old preview from the cache '+f)
+            try:
+                os.remove(f)
+            except OSError:
+                continue
+            total -= size
+            if total <= max_size:
+                break
+
+    def add_thumbnail(self, file, ext, img, out_name, no_icon):
+        """ Schedules the creation of the preview for this file """
+        if not os.path.isfile(file):
+            return
+        # If two files use the same name the last one wins, as when we created them one by one
+        fname = self.get_thumbnail_name(file, out_name)
+        self.thumbnails[fname] = (file, ext, img, fname, no_icon)
+
+    def make_thumbnails(self):
+        """ Creates all the scheduled previews """
+        thumbnails = list(self.thumbnails.values())
+        if not thumbnails:
+            return
+        logger.debug('Creating {} previews'.format(len(thumbnails)))
+        res = run_in_parallel(self.make_thumbnail, thumbnails, self.jobs)
+        self.thumbnails_ok = {t[3]: r for t, r in zip(thumbnails, res)}
+
     def compose_image(self, file, ext, img, out_name, no_icon=False):
         if not os.path.isfile(file):
             logger.warning(W_NOTYET+"{} not yet generated, using an icon".format(os.path.relpath(file)))
             return False, None, None
         if self.convert_command is None:
             return False, None, None
-        # Create a unique name using the output name and the generated file name
-        bfname = os.path.splitext(os.path.basename(file))[0]
-        fname = os.path.join(self.out_dir, 'images', out_name+'_'+bfname+'.png')
+        fname = self.get_thumbnail_name(file, out_name)
+        res = self.thumbnails_ok.get(fname)
+        if res is None:
+            # Not scheduled in advance
+            res = self.make_thumbnail((file, ext, img, fname, no_icon))
+        return res, fname, os.path.relpath(fname, start=self.out_dir)
+
+    def convert_to_thumbnail(self, file, ext, img, fname, no_icon):
         # Full path for the icon image
         icon = os.path.join(self.out_dir, img)
         if ext == 'pdf':
@@ -274,7 +391,8 @@ class Navigate_ResultsOptions(BaseOptions):
                 tmp_name = f.name
             logger.debug('Temporal convert: {} -> {}'.format(file, tmp_name))
             if not self.svg_to_png(file, tmp_name, BIG_ICON):
-                return False, None, None
+                os.remove(tmp_name)
+                return False
             file = tmp_name
         cmd = [self.convert_command, file,
                # Size for the big icons (width)
@@ -294,14 +412,17 @@ class Navigate_ResultsOptions(BaseOptions):
         if ext == 'svg':
             logger.debug('Removing temporal {}'.format(tmp_name))
             os.remove(tmp_name)
-        return res, fname, os.path.relpath(fname, start=self.out_dir)
+        return res
+
+    def get_icon_for_file(self, file, ext, image=None):
+        # Copy the icon for this file extension
+        icon_name = 'folder' if os.path.isdir(file) else EXT_IMAGE.get(ext, 'unknown')
+        return self.copy(image or icon_name, MID_ICON)
 
     def get_image_for_file(self, file, out_name, no_icon=False, image=None):
         ext = os.path.splitext(file)[1][1:].lower()
         wide = False
-        # Copy the icon for this file extension
-        icon_name = 'folder' if os.path.isdir(file) else EXT_IMAGE.get(ext, 'unknown')
-        img = self.copy(image or icon_name, MID_ICON)
+        img = self.get_icon_for_file(file, ext, image)
         # Full name for the file
         file_full = file
         # Just the file, to display it
@@ -388,9 +509,8 @@ class Navigate_ResultsOptions(BaseOptions):
             if out.comment:
                 oname += ': '+out.comment
             f.write('<thead><tr><th colspan="{}">{}</th></tr></thead>\n'.format(OUT_COLS, oname))
-            out_dir = get_output_dir(out.dir, out, dry=True)
             f.write('<tbody><tr>\n')
-            targets, icons = out.get_navigate_targets(out_dir)
+            targets, icons = self.get_output_targets(out, navigate=True)
             if len(targets) == 1:
                 tg_rel = os.path.relpath(os.path.abspath(targets[0]), start=self.out_dir)
                 img, _ = self.get_image_for_file(targets[0], out_name, image=icons[0] if icons else None)
@@ -425,6 +545,28 @@ class Navigate_ResultsOptions(BaseOptions):
             f.write('</tbody>\n')
             f.write('</table>\n')
 
+    def collect_thumbnails_for_file(self, file, out_name, no_icon=False, image=None):
+        ext = os.path.splitext(file)[1][1:].lower()
+        if self.convert_command is not None and self.can_be_converted(ext, warn=False):
+            self.add_thumbnail(file, ext, self.get_icon_for_file(file, ext, image), 'cat_'+out_name, no_icon)
+
+    def collect_thumbnails(self, node):
+        """ Schedules the previews needed by the pages for this node, like generate_page_for """
+        for name, content in node.items():
+            if isinstance(content, dict):
+                rep_file = self.get_rep_file_for_cat(name)
+                if rep_file:
+                    self.collect_thumbnails_for_file(rep_file, name, no_icon=True)
+                self.collect_thumbnails(content)
+                continue
+            out_name = name.replace(' ', '_')
+            targets, icons = self.get_output_targets(content, navigate=True)
+            if len(targets) == 1:
+                self.collect_thumbnails_for_file(targets[0], out_name, image=icons[0] if icons else None)
+            else:
+                for tg in targets:
+                    self.collect_thumbnails_for_file(tg, out_name)
+
     def generate_end_page_for(self, name, node, prev, category):
         logger.debug('- Outputs: '+str(node.keys()))
         with open(os.path.join(self.out_dir, name), 'wt') as f:
@@ -491,6 +633,11 @@ class Navigate_ResultsOptions(BaseOptions):
         self.img_dst_dir = os.path.join(self.out_dir, 'images')
         os.makedirs(self.img_dst_dir, exist_ok=True)
         self.copied_images = {}
+        self.out_targets = {}
+        self.cat_rep_files = {}
+        self.thumbnails = {}
+        self.thumbnails_ok = {}
+        self.cache_dir = GS.get_cache_dir('thumbnails') if self.cache else None
         name = os.path.basename(name)
         # Create a tree with all the outputs
         o_tree = self.create_tree()
@@ -508,7 +655,12 @@ class Navigate_ResultsOptions(BaseOptions):
         self.back_img = self.copy('back', MID_ICON)
         self.home_img = self.copy('home', MID_ICON)
         copy2(os.path.join(self.img_src_dir, 'favicon.ico'), os.path.join(self.out_dir, 'favicon.ico'))
+        # Create all the previews in parallel, then the pages
+        self.collect_thumbnails(o_tree)
+        self.make_thumbnails()
         self.generate_page_for(o_tree, name)
+        if self.cache_dir is not None:
+            self.evict_cache()
         # Link it?
         if self.link_from_root:
             redir_file = os.path.join(GS.out_dir, self.link_from_root)
@@ -533,6 +685,8 @@ class Navigate_Results(BaseOutput):  # noqa: F821
         # The help is inherited and already mentions the default priority
         self.fix_priority_help()
         self._any_related = True
+        # Depends on the files generated by the other outputs, we can't skip it
+        self._incremental = False
 
     @staticmethod
     def get_conf_examples(name, layers):
@@ -34,8 +34,8 @@ import re
 import os
 import importlib
 from pcbnew import B_Cu, B_Mask, F_Cu, F_Mask, FromMM, IsCopperLayer, LSET, PLOT_CONTROLLER, PLOT_FORMAT_SVG
-from shutil import rmtree
-from tempfile import NamedTemporaryFile, mkdtemp
+from shutil import copyfileobj, rmtree
+from tempfile import NamedTemporaryFile, TemporaryFile, mkdtemp
 from .error import KiPlotConfigurationError
 from .gs import GS
 from .optionable import Optionable
@@ -51,8 +51,9 @@ from .create_pdf import create_pdf_from_pages
 from .macros import macros, document, output_class  # noqa: F401
 from .drill_marks import DRILL_MARKS_MAP, add_drill_marks
 from .layer import Layer, get_priority
-from .kiplot import run_command
+from .kiplot import run_command, run_in_parallel
 from . import __version__
+from . import plot_cache
 from . import log
 
 logger = log.get_logger()
@@ -96,22 +97,40 @@ def to_gray_hex(color):
 
 
 def load_svg(file, color, colored_holes, holes_color, monochrome):
-    with open(file, 'rt') as f:
+    """ Loads a layer changing its colors. The content is never decoded, lxml parses the bytes """
+    with open(file, 'rb') as f:
         content = f.read()
     color = color[:7]
     if monochrome:
         color = to_gray_hex(color)
         holes_color = to_gray_hex(holes_color)
     if colored_holes:
-        content = content.replace('#FFFFFF', '**black_hole**')
+        content = content.replace(b'#FFFFFF', b'**black_hole**')
     if color != '#000000':
         # Files plotted
-        content = content.replace('#000000', color)
+        content = content.replace(b'#000000', color.encode())
         # Files generated by "Print"
-        content = content.replace('stroke:rgb(0%,0%,0%)', 'stroke:'+color)
+        content = content.replace(b'stroke:rgb(0%,0%,0%)', b'stroke:'+color.encode())
     if colored_holes:
-        content = content.replace('**black_hole**', holes_color)
-    return content
+        content = content.replace(b'**black_hole**', holes_color.encode())
+    return svgutils.frombytes(content)
+
+
+def save_svg_with_layers(svg, layers, fname):
+    """ Saves `svg` adding the layers already serialized in the `layers` file at the end """
+    content = svg.to_str()
+    layers.seek(0)
+    if not content.rstrip().endswith(b'</svg>'):
+        # Self-closing or prefixed root, add the layers to the tree
+        for e in list(svgutils.frombytes(b'<g>'+layers.read()+b'</g>').root):
+            svg.root.append(e)
+        svg.save(fname)
+        return
+    end = content.rindex(b'</svg>')
+    with open(fname, 'wb') as f:
+        f.write(content[:end])
+        copyfileobj(layers, f)
+        f.write(content[end:])
 
 
 def get_size(svg):
@@ -362,6 +381,9 @@ class PCB_PrintOptions(VariantOptions):
             """ Invert the meaning of the `use_for_center` layer option.
                 This can be used to just select the edge cuts for centering, in this case enable this option
                 and disable the `use_for_center` option of the edge cuts layer """
+            self.jobs = 1
+            """ [0,256] Number of parallel jobs used to merge the layers and convert the pages.
+                The layers are always plotted one by one. Use 0 to run one job for each CPU """
         add_drill_marks(self)
         super().__init__()
         self._expand_id = 'assembly'
@@ -697,13 +719,13 @@ class PCB_PrintOptions(VariantOptions):
         # Add it to the list
         filelist.append((pc.GetPlotFileName(), via_c))
 
-    def add_frame_images(self, svg, monochrome):
+    def add_frame_images(self, svg, monochrome, worksheet):
         if (not self.plot_sheet_reference or not self.frame_plot_mechanism == 'internal' or
-           not self.last_worksheet.has_images):
+           not worksheet.has_images):
             return
         if monochrome:
             convert_command = self.ensure_tool('ImageMagick')
-            for img in self.last_worksheet.images:
+            for img in worksheet.images:
                 with NamedTemporaryFile(mode='wb', suffix='.png', delete=False) as f:
                     f.write(img.data)
                     fname = f.name
@@ -713,7 +735,7 @@ class PCB_PrintOptions(VariantOptions):
                     img.data = f.read()
                 os.remove(fname)
                 os.remove(dest)
-        self.last_worksheet.add_images_to_svg(svg, self.svg_precision)
+        worksheet.add_images_to_svg(svg, self.svg_precision)
 
     def fill_polygons(self, svg, color):
         """ I don't know how to generate filled polygons on KiCad 5.
@@ -810,45 +832,53 @@ class PCB_PrintOptions(VariantOptions):
                 # Process all text inside
                 self.search_text_for_g(e, texts)
 
-    def merge_svg(self, input_folder, input_files, output_folder, output_file, p):
-        """ Merge all layers into one page """
+    def merge_svg(self, input_folder, input_files, output_folder, output_file, p, worksheet=None):
+        """ Merge all layers into one page.
+            Only the first layer (the page) is kept in memory, the rest are serialized to a temporal file as soon as
+            they are processed. In this way the memory usage doesn't depend on the number of layers. """
         first = True
         texts = []
-        for (file, color) in input_files:
-            logger.debug(' - Loading layer file '+file)
-            file = os.path.join(input_folder, file)
-            new_layer = svgutils.fromstring(load_svg(file, color, p.colored_holes, p.holes_color, p.monochrome))
-            width, height = get_size(new_layer)
-            # Workaround for polygon fill on KiCad 5
-            if GS.ki5 and file.endswith('frame.svg'):
-                if p.monochrome:
-                    color = to_gray_hex(color)
-                self.fill_polygons(new_layer, color)
+        with TemporaryFile() as layers:
+            for (file, color) in input_files:
+                logger.debug(' - Loading layer file '+file)
+                file = os.path.join(input_folder, file)
+                new_layer = load_svg(file, color, p.colored_holes, p.holes_color, p.monochrome)
+                width, height = get_size(new_layer)
+                # Workaround for polygon fill on KiCad 5
+                if GS.ki5 and file.endswith('frame.svg'):
+                    if p.monochrome:
+                        color = to_gray_hex(color)
+                    self.fill_polygons(new_layer, color)
+                if self.format == 'PDF':
+                    # Look for transparent text that we will copy to a suitable place
+                    self.search_text(new_layer, texts)
+                if first:
+                    svg_out = new_layer
+                    # This is the width declared at the beginning of the file
+                    base_width = width
+                    first = False
+                    self.process_background(svg_out, width, height)
+                    self.add_frame_images(svg_out, p.monochrome, worksheet)
+                else:
+                    root = new_layer.getroot()
+                    # Adjust the coordinates of this section to the main width
+                    scale = base_width/width
+                    if scale != 1.0:
+                        logger.debug(' - Scaling {} by {}'.format(file, scale))
+                        # Iterate the lxml element, indexing the GroupElement is O(n) for each child
+                        for e in root.root:
+                            svgutils.FigureElement(e).scale(scale)
+                    layers.write(svgutils.GroupElement([root]).tostr())
             if self.format == 'PDF':
-                # Look for transparent text that we will copy to a suitable place
-                self.search_text(new_layer, texts)
-            if first:
-                svg_out = new_layer
-                # This is the width declared at the beginning of the file
-                base_width = width
-                first = False
-                self.process_background(svg_out, width, height)
-                self.add_frame_images(svg_out, p.monochrome)
-            else:
-                root = new_layer.getroot()
-                # Adjust the coordinates of this section to the main width
-                scale = base_width/width
-                if scale != 1.0:
-                    logger.debug(' - Scaling {} by {}'.format(file, scale))
-                    for e in root:
-                        e.scale(scale)
-                svg_out.append([root])
-        if self.format == 'PDF':
-            # Make the text searchable
-            # Add it before anything using the background color
-            for text in texts:
-                svg_out.insert(text)
-        svg_out.save(os.path.join(output_folder, output_file))
+                # Make the text searchable
+                # Add it before anything using the background color
+                for text in texts:
+                    svg_out.insert(text)
+            save_svg_with_layers(svg_out, layers, os.path.join(output_folder, output_file))
+
+    def merge_page(self, args):
+        logger.debug('- Merging layers to {}'.format(args[3]))
+        self.merge_svg(*args)
 
     def find_paper_size(self):
         pcb = PCB.load(GS.pcb_file)
@@ -1020,6 +1050,11 @@ class PCB_PrintOptions(VariantOptions):
                os.path.join(input_folder, svg_file)]
         _run_command(cmd)
 
+    def page_to_pdf(self, args):
+        input_folder, svg_file, pdf_file = args
+        logger.debug('- Creating {} from {}'.format(pdf_file, svg_file))
+        self.svg_to_pdf(input_folder, svg_file, pdf_file)
+
     # We can't control the resolution in this way
     # def svg_to_png(self, input_folder, svg_file, png_file, width):
     #     cmd = [self.rsvg_command, '-w', str(width), '-f', 'png', '-o', os.path.join(input_folder, png_file),
@@ -1051,20 +1086,15 @@ class PCB_PrintOptions(VariantOptions):
             # Adjust the width
             convert_command = self.ensure_tool('ImageMagick')
             size = str(self.png_width)+'x'
-            for n in range(len(self.pages)):
-                file = output % (n+1)
-                cmd = [convert_command, file, '-resize', size, file]
-                _run_command(cmd)
+            cmds = [[convert_command, output % (n+1), '-resize', size, output % (n+1)] for n in range(len(self.pages))]
+            run_in_parallel(_run_command, cmds, self.jobs)
 
     def create_pdf_from_svg_pages(self, input_folder, input_files, output_fn):
         """ Convert individual SVG files into individual PDF files using 360 dpi.
             Then join the individual PDF files into one PDF file scaled to the right page size. """
-        svg_files = []
-        for svg_file in input_files:
-            pdf_file = svg_file.replace('.svg', '.pdf')
-            logger.debug('- Creating {} from {}'.format(pdf_file, svg_file))
-            self.svg_to_pdf(input_folder, svg_file, pdf_file)
-            svg_files.append(os.path.join(input_folder, pdf_file))
+        pdf_files = [svg_file.replace('.svg', '.pdf') for svg_file in input_files]
+        run_in_parallel(self.page_to_pdf, [(input_folder, f, pdf) for f, pdf in zip(input_files, pdf_files)], self.jobs)
+        svg_files = [os.path.join(input_folder, pdf_file) for pdf_file in pdf_files]
         logger.debug('- Joining {} into {} ({}x{})'.format(svg_files, output_fn, self.paper_w, self.paper_h))
         create_pdf_from_pages(svg_files, output_fn, forced_width=self.paper_w)
 
@@ -1181,6 +1211,7 @@ class PCB_PrintOptions(VariantOptions):
             GS.board.SetVisibleLayers(vis_layers)
         # Generate the output, page by page
         pages = []
+        merges = []
         for n, p in enumerate(self.pages):
             # Make visible only the layers we need
             # This is very important when scaling, otherwise the results are controlled by the .kicad_prl (See #407)
@@ -1229,14 +1260,17 @@ class PCB_PrintOptions(VariantOptions):
                 # Avoid holes on non-copper layers
                 po.SetDrillMarksType(self.drill_marks if IsCopperLayer(id) else 0)
                 pc.SetLayer(id)
-                if id in user_layer_ids:
+                if id in user_layer_ids and p.mirror:
+                    # The text is mirrored in the board, so this plot can't be shared
                     self.mirror_text(p, id)
-                pc.OpenPlotfile(la.suffix, PLOT_FORMAT_SVG, p.sheet)
-                pc.PlotLayer()
-                if id in user_layer_ids:
+                    pc.OpenPlotfile(la.suffix, PLOT_FORMAT_SVG, p.sheet)
+                    pc.PlotLayer()
                     self.mirror_text(p, id)
-                pc.ClosePlot()
-                filelist.append((pc.GetPlotFileName(), la.color))
+                    pc.ClosePlot()
+                    fname = pc.GetPlotFileName()
+                else:
+                    fname = plot_cache.plot_layers(pc, [id], la.suffix, PLOT_FORMAT_SVG, p.sheet)
+                filelist.append((fname, la.color))
                 self.plot_extra_cu(id, la, pc, p, filelist)
                 self.plot_realistic_solder_mask(id, temp_dir, filelist[-1][0], filelist[-1][1], p.mirror, p.scaling)
 #                 if needs_ki7_scale_workaround:
@@ -1259,10 +1293,12 @@ class PCB_PrintOptions(VariantOptions):
                 assembly_file = self.expand_filename(output_dir, self.output, id, ext)
             else:
                 assembly_file = GS.pcb_basename+".svg"
-            logger.debug('- Merging layers to {}'.format(assembly_file))
-            self.merge_svg(temp_dir, filelist, temp_dir, assembly_file, p)
+            # The worksheet is used to add the images, each page has its own worksheet
+            merges.append((temp_dir, filelist, temp_dir, assembly_file, p, getattr(self, 'last_worksheet', None)))
             pages.append(os.path.join(page_str, assembly_file))
             self.restore_title()
+        # Merge the layers of each page, they don't need KiCad, so we can do it in parallel
+        run_in_parallel(self.merge_page, merges, self.jobs, use_processes=True)
         # Join all pages in one file
         if self.format != 'SVG':
             if self.format == 'PDF':
@@ -16,6 +16,7 @@ from .optionable import Optionable
 from .out_base import VariantOptions
 from .error import KiPlotConfigurationError
 from .macros import macros, document, output_class  # noqa: F401
+from . import board_snapshot
 from . import log
 
 logger = log.get_logger()
@@ -202,20 +203,20 @@ class PositionOptions(VariantOptions):
             bothf.close()
 
     @staticmethod
-    def is_pure_smd_5(m):
-        return m.GetAttributes() == UI_SMD
+    def is_pure_smd_5(attrs):
+        return attrs == UI_SMD
 
     @staticmethod
-    def is_pure_smd_6(m):
-        return m.GetAttributes() & (MOD_THROUGH_HOLE | MOD_SMD | MOD_EXCLUDE_FROM_POS_FILES) == MOD_SMD
+    def is_pure_smd_6(attrs):
+        return attrs & (MOD_THROUGH_HOLE | MOD_SMD | MOD_EXCLUDE_FROM_POS_FILES) == MOD_SMD
 
     @staticmethod
-    def is_not_virtual_5(m):
-        return m.GetAttributes() != UI_VIRTUAL
+    def is_not_virtual_5(attrs):
+        return attrs != UI_VIRTUAL
 
     @staticmethod
-    def is_not_virtual_6(m):
-        return not (m.GetAttributes() & MOD_EXCLUDE_FROM_POS_FILES)
+    def is_not_virtual_6(attrs):
+        return not (attrs & MOD_EXCLUDE_FROM_POS_FILES)
 
     @staticmethod
     def get_attr_tests():
@@ -269,8 +270,9 @@ class PositionOptions(VariantOptions):
         if self.use_aux_axis_as_origin:
             (x_origin, y_origin) = GS.get_aux_origin()
             logger.debug('Using auxiliary origin: x={} y={}'.format(x_origin, y_origin))
-        for m in sorted(GS.get_modules(), key=lambda c: _ref_key(c.GetReference())):
-            ref = m.GetReference()
+        fps = board_snapshot.get().footprints
+        for n in sorted(range(len(fps)), key=lambda n: _ref_key(fps.ref[n])):
+            ref = fps.ref[n]
             logger.debug('P&P ref: {}'.format(ref))
             value = None
             # Apply any filter or variant data
@@ -285,24 +287,24 @@ class PositionOptions(VariantOptions):
                     is_bottom = c.bottom
                     rotation = c.footprint_rot
                     # Here we can't use c.footprint_x/y because this doesn't work for panels
-                    center = GS.get_center(m)
-                    center_x = center.x
-                    center_y = center.y
+                    center_x = fps.x[n]
+                    center_y = fps.y[n]
                     if c.pos_offset_x is not None:
                         # Offset from the rotation filter
                         # logger.error(f"{center_x},{center_y} -> {center_x+c.pos_offset_x},{center_y+c.pos_offset_y}")
                         center_x += c.pos_offset_x
                         center_y += c.pos_offset_y
             if value is None:
-                value = m.GetValue()
-                footprint = str(m.GetFPID().GetLibItemName())  # pcbnew.UTF8 type
-                is_bottom = m.IsFlipped()
-                rotation = m.GetOrientationDegrees()
-                center = GS.get_center(m)
-                center_x = center.x
-                center_y = center.y
+                value = fps.value[n]
+                footprint = fps.package[n]
+                is_bottom = fps.flipped[n]
+                rotation = fps.rot[n]
+                center_x = fps.x[n]
+                center_y = fps.y[n]
             # If passed check the position options
-            if (self.only_smd and is_pure_smd(m)) or (not self.only_smd and (is_not_virtual(m) or self.include_virtual)):
+            attrs = fps.attrs[n]
+            if ((self.only_smd and is_pure_smd(attrs)) or
+               (not self.only_smd and (is_not_virtual(attrs) or self.include_virtual))):
                 # KiCad: PLACE_FILE_EXPORTER::GenPositionData() in export_footprints_placefile.cpp
                 row = []
                 if self.right_digits != 0:
@@ -331,7 +333,7 @@ class PositionOptions(VariantOptions):
                 modules.append(row)
                 modules_side.append(is_bottom)
             else:
-                logger.debug('- pure_smd: {} not_virtual {}'.format(is_pure_smd(m), is_not_virtual(m)))
+                logger.debug('- pure_smd: {} not_virtual {}'.format(is_pure_smd(attrs), is_not_virtual(attrs)))
         # Find max width for all columns
         maxlengths = []
         for col, name in enumerate(columns):
@@ -15,6 +15,7 @@ Dependencies:
     extra_arch: ['texlive-core']
     comments: 'In CI/CD environments: the `kicad_auto_test` docker image contains it.'
 """
+from collections import Counter
 import os
 import re
 import pcbnew
@@ -28,6 +29,7 @@ from .error import KiPlotConfigurationError
 from .kiplot import config_output, run_command
 from .dep_downloader import get_dep_data
 from .macros import macros, document, output_class  # noqa: F401
+from . import board_snapshot
 from . import log
 from . import __version__
 
@@ -421,20 +423,20 @@ class ReportOptions(BaseOptions):
         return self._context_individual_images(line, self._schematic_svgs)
 
     @staticmethod
-    def is_pure_smd_5(m):
-        return m.GetAttributes() == UI_SMD
+    def is_pure_smd_5(attrs):
+        return attrs == UI_SMD
 
     @staticmethod
-    def is_pure_smd_6(m):
-        return m.GetAttributes() & (MOD_THROUGH_HOLE | MOD_SMD) == MOD_SMD
+    def is_pure_smd_6(attrs):
+        return attrs & (MOD_THROUGH_HOLE | MOD_SMD) == MOD_SMD
 
     @staticmethod
-    def is_not_virtual_5(m):
-        return m.GetAttributes() != UI_VIRTUAL
+    def is_not_virtual_5(attrs):
+        return attrs != UI_VIRTUAL
 
     @staticmethod
-    def is_not_virtual_6(m):
-        return not (m.GetAttributes() & MOD_EXCLUDE_FROM_POS_FILES)
+    def is_not_virtual_6(attrs):
+        return not (attrs & MOD_EXCLUDE_FROM_POS_FILES)
 
     def get_attr_tests(self):
         if GS.ki5:
@@ -492,19 +494,21 @@ class ReportOptions(BaseOptions):
             hole_ec = hole
         return oar, oar_ec, hole_ec
 
-    def analyze_oar(self, oar_t, oar_ec_t, is_pth, min_oar, pad, dr_x_real, dr_y_real, pad_sz, dr):
+    def analyze_oar(self, oar_t, oar_ec_t, is_pth, min_oar, pads, dr_x_real, dr_y_real, pad_sz, dr):
         """ Check the computed OAR and choose if we use it or not.
-            Inform anomalies to the user. """
+            Inform anomalies to the user.
+            `pads` is the list of pads with this drill and size. """
         if oar_t > 0:
             if is_pth:
                 # For plated holes we always use it and report anomalies
                 self.oar_pads = min(self.oar_pads, oar_t)
                 self.oar_pads_ec = min(self.oar_pads_ec, oar_ec_t)
                 if oar_t < min_oar:
-                    logger.warning(W_WRONGOAR+"Really small OAR detected ({} mm) for pad {} using drill tool ({}, {})".
-                                   format(to_mm(oar_t, 4), get_pad_info(pad), to_mm(dr_x_real), to_mm(dr_y_real)))
-                    if pad_sz == dr:
-                        logger.warning(W_WRONGOAR+"Try adjusting the drill size to an available drill tool")
+                    for pad in pads:
+                        logger.warning(W_WRONGOAR+"Really small OAR detected ({} mm) for pad {} using drill tool ({}, {})".
+                                       format(to_mm(oar_t, 4), get_pad_info(pad), to_mm(dr_x_real), to_mm(dr_y_real)))
+                        if pad_sz == dr:
+                            logger.warning(W_WRONGOAR+"Try adjusting the drill size to an available drill tool")
             else:
                 # For non plated holes KiCad doesn't even create a pad if pad_sz == dr
                 if pad_sz != dr:
@@ -514,9 +518,11 @@ class ReportOptions(BaseOptions):
             # The negative value can be a result of converting the drill size to a real drill size
             # So we inform it only if the pad and drill are different
             if pad_sz != dr and is_pth:
-                logger.warning(W_WRONGOAR+"Negative OAR detected for pad "+get_pad_info(pad))
+                for pad in pads:
+                    logger.warning(W_WRONGOAR+"Negative OAR detected for pad "+get_pad_info(pad))
         elif oar_t == 0 and is_pth:
-            logger.warning(W_WRONGOAR+"Plated pad without copper "+get_pad_info(pad))
+            for pad in pads:
+                logger.warning(W_WRONGOAR+"Plated pad without copper "+get_pad_info(pad))
 
     def collect_data(self, board):
         ds = board.GetDesignSettings()
@@ -559,49 +565,35 @@ class ReportOptions(BaseOptions):
         # Track width (min)
         ###########################################################
         self.track_d = ds.m_TrackMinWidth
-        tracks = board.GetTracks()
-        self.oar_vias = self.oar_vias_ec = self.track = INF
-        self._vias = {}
-        self._vias_ec = {}
-        self._tracks_m = {}
-        self._drills_real = {}
-        self._drills_ec = {}
-        track_type = 'TRACK' if GS.ki5 else 'PCB_TRACK'
-        via_type = 'VIA' if GS.ki5 else 'PCB_VIA'
-        self.thru_vias_count = self.blind_vias_count = self.micro_vias_count = self.vias_count = 0
-        for t in tracks:
-            tclass = t.GetClass()
-            if tclass == track_type:
-                w = t.GetWidth()
-                self.track = min(w, self.track)
-                self._tracks_m[w] = self._tracks_m.get(w, 0) + 1
-            elif tclass == via_type:
-                via = t.Cast()
-                via_id = (via.GetDrill(), via.GetWidth())
-                self._vias[via_id] = self._vias.get(via_id, 0) + 1
-                d = adjust_drill(via_id[0])
-                oar, oar_ec, d_ec = self.compute_oar(via_id[1], d)
-                via_id_ec = (d_ec, via_id[1])
-                self._vias_ec[via_id_ec] = self._vias.get(via_id_ec, 0) + 1
-                self.oar_vias = min(self.oar_vias, oar)
-                self.oar_vias_ec = min(self.oar_vias_ec, oar_ec)
-                self._drills_real[d] = self._drills_real.get(d, 0) + 1
-                self._drills_ec[d_ec] = self._drills_ec.get(d_ec, 0) + 1
-                self.vias_count += 1
-                via_t = via.GetViaType()
-                if via_t == VIATYPE_THROUGH:
-                    self.thru_vias_count += 1
-                elif via_t == VIATYPE_BLIND_BURIED:
-                    self.blind_vias_count += 1
-                elif via_t == VIATYPE_MICROVIA:
-                    self.micro_vias_count += 1
+        snapshot = board_snapshot.get(board)
+        self.oar_vias = self.oar_vias_ec = INF
+        # The statistics are computed for each different size, using the number of times it was used
+        self._tracks_m = Counter(snapshot.tracks.width)
+        self.track = min(self._tracks_m, default=INF)
+        vias = snapshot.vias
+        self._vias = Counter(zip(vias.drill, vias.width))
+        self._vias_ec = Counter()
+        self._drills_real = Counter()
+        self._drills_ec = Counter()
+        for via_id, count in self._vias.items():
+            d = adjust_drill(via_id[0])
+            oar, oar_ec, d_ec = self.compute_oar(via_id[1], d)
+            self._vias_ec[(d_ec, via_id[1])] += count
+            self.oar_vias = min(self.oar_vias, oar)
+            self.oar_vias_ec = min(self.oar_vias_ec, oar_ec)
+            self._drills_real[d] += count
+            self._drills_ec[d_ec] += count
+        via_types = Counter(vias.type)
+        self.vias_count = len(vias)
+        self.thru_vias_count = via_types[VIATYPE_THROUGH]
+        self.blind_vias_count = via_types[VIATYPE_BLIND_BURIED]
+        self.micro_vias_count = via_types[VIATYPE_MICROVIA]
         self.track_min = min(self.track_d, self.track)
         ###########################################################
         # Drill (min)
         ###########################################################
-        modules = board.GetModules() if GS.ki5 else board.GetFootprints()
-        self._drills = {}
-        self._drills_oval = {}
+        self._drills = Counter()
+        self._drills_oval = Counter()
         self.oar_pads = self.oar_pads_ec = self.pad_drill = self.pad_drill_real = self.pad_drill_real_ec = INF
         self.slot = INF
         self.top_smd = self.top_tht = self.bot_smd = self.bot_tht = 0
@@ -610,56 +602,53 @@ class ReportOptions(BaseOptions):
         is_pure_smd, is_not_virtual = self.get_attr_tests()
         npth_attrib = 3 if GS.ki5 else pcbnew.PAD_ATTRIB_NPTH
         min_oar = GS.from_mm(0.1)
-        for m in modules:
-            layer = m.GetLayer()
+        fps = snapshot.footprints
+        for (layer, attrs), count in Counter(zip(fps.layer, fps.attrs)).items():
             if layer == top_layer:
-                if is_pure_smd(m):
-                    self.top_smd += 1
-                elif is_not_virtual(m):
-                    self.top_tht += 1
+                if is_pure_smd(attrs):
+                    self.top_smd += count
+                elif is_not_virtual(attrs):
+                    self.top_tht += count
             elif layer == bottom_layer:
-                if is_pure_smd(m):
-                    self.bot_smd += 1
-                elif is_not_virtual(m):
-                    self.bot_tht += 1
-            pads = m.Pads()
-            for pad in pads:
-                dr = pad.GetDrillSize()
-                if not dr.x:
-                    continue
-                self.pad_drill = min(dr.x, self.pad_drill)
-                self.pad_drill = min(dr.y, self.pad_drill)
-                # Compute the drill size to get it after plating
-                is_pth = pad.GetAttribute() != npth_attrib
-                dr_x_real = adjust_drill(dr.x, is_pth, pad)
-                dr_y_real = adjust_drill(dr.y, is_pth, pad)
-                self.pad_drill_real = min(dr_x_real, self.pad_drill_real)
-                self.pad_drill_real = min(dr_y_real, self.pad_drill_real)
-                if dr.x == dr.y:
-                    self._drills[dr.x] = self._drills.get(dr.x, 0) + 1
-                    self._drills_real[dr_x_real] = self._drills_real.get(dr_x_real, 0) + 1
+                if is_pure_smd(attrs):
+                    self.bot_smd += count
+                elif is_not_virtual(attrs):
+                    self.bot_tht += count
+        # Pads with the same drill, size and plating
+        pads = snapshot.pads
+        pad_groups = {}
+        for key, pad in zip(zip(pads.drill_x, pads.drill_y, pads.size_x, pads.size_y, pads.attrib), pads.pad):
+            pad_groups.setdefault(key, []).append(pad)
+        for (dr_x, dr_y, pad_sz_x, pad_sz_y, attrib), pad_list in pad_groups.items():
+            count = len(pad_list)
+            self.pad_drill = min(dr_x, dr_y, self.pad_drill)
+            # Compute the drill size to get it after plating
+            is_pth = attrib != npth_attrib
+            dr_x_real = adjust_drill(dr_x, is_pth)
+            dr_y_real = adjust_drill(dr_y, is_pth)
+            self.pad_drill_real = min(dr_x_real, dr_y_real, self.pad_drill_real)
+            if dr_x == dr_y:
+                self._drills[dr_x] += count
+                self._drills_real[dr_x_real] += count
+            else:
+                if dr_x < dr_y:
+                    m = (dr_x, dr_y)
+                    d_r = dr_x_real
                 else:
-                    if dr.x < dr.y:
-                        m = (dr.x, dr.y)
-                        d = dr.x
-                        d_r = dr_x_real
-                    else:
-                        m = (dr.y, dr.x)
-                        d = dr.y
-                        d_r = dr_y_real
-                    self._drills_oval[m] = self._drills_oval.get(m, 0) + 1
-                    self.slot = min(self.slot, m[0])
-                    # print('{} @ {}'.format(dr, pad.GetPosition()))
-                    self._drills_real[d_r] = self._drills_real.get(d_r, 0) + 1
-                pad_sz = pad.GetSize()
-                oar_x, oar_ec_x, dr_x_ec = self.compute_oar(pad_sz.x, dr_x_real)
-                oar_y, oar_ec_y, dr_y_ec = self.compute_oar(pad_sz.y, dr_y_real)
-                dr_ec = min(dr_x_ec, dr_y_ec)
-                self._drills_ec[dr_ec] = self._drills_ec.get(dr_ec, 0) + 1
-                self.pad_drill_real_ec = min(dr_ec, self.pad_drill_real_ec)
-                oar_t = min(oar_x, oar_y)
-                oar_ec_t = min(oar_ec_x, oar_ec_y)
-                self.analyze_oar(oar_t, oar_ec_t, is_pth, min_oar, pad, dr_x_real, dr_y_real, pad_sz, dr)
+                    m = (dr_y, dr_x)
+                    d_r = dr_y_real
+                self._drills_oval[m] += count
+                self.slot = min(self.slot, m[0])
+                self._drills_real[d_r] += count
+            oar_x, oar_ec_x, dr_x_ec = self.compute_oar(pad_sz_x, dr_x_real)
+            oar_y, oar_ec_y, dr_y_ec = self.compute_oar(pad_sz_y, dr_y_real)
+            dr_ec = min(dr_x_ec, dr_y_ec)
+            self._drills_ec[dr_ec] += count
+            self.pad_drill_real_ec = min(dr_ec, self.pad_drill_real_ec)
+            oar_t = min(oar_x, oar_y)
+            oar_ec_t = min(oar_ec_x, oar_ec_y)
+            self.analyze_oar(oar_t, oar_ec_t, is_pth, min_oar, pad_list, dr_x_real, dr_y_real, (pad_sz_x, pad_sz_y),
+                             (dr_x, dr_y))
         self._vias_m = sorted(self._vias.keys())
         self._vias_ec_m = sorted(self._vias_ec.keys())
         # Via Pad size
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2024 Salvador E. Tropea
+# Copyright (c) 2024 Instituto Nacional de Tecnología Industrial
+# License: GPL-3.0
+# Project: KiBot (formerly KiPlot)
+"""
+Run-scoped cache for the layers plotted using KiCad's PLOT_CONTROLLER.
+Outputs like `pcb_print` and `pcbdraw` plot the same layers, using the same options, many times in the same run.
+Here we keep a copy of each plotted file, the key is computed using:
+- The board (object and revision) and its title
+- The filter/variant applied to the board
+- The visible layers
+- All the plot options (PCB_PLOT_PARAMS getters) and the color mode
+- The plotted layers, the format, the suffix and the sheet description
+"""
+import os
+from shutil import copy2, rmtree
+from tempfile import mkdtemp
+from .gs import GS
+from . import log
+
+logger = log.get_logger()
+# Plot options that don't affect the content of the plotted file
+IGNORED_OPTIONS = {'GetOutputDirectory'}
+# key -> cached file
+cache = {}
+# Incremented each time the board is changed in a way we can't describe
+revision = 0
+# Fingerprint of the filter/variant currently applied to the board
+board_filter = None
+# Where the plots are stored and the process that created it
+temp_dir = None
+temp_dir_pid = None
+# Name of the getters for each plot options class
+getters = {}
+hits = 0
+
+
+def board_changed():
+    """ Invalidates the cached plots (i.e. a new board was loaded) """
+    global revision
+    revision += 1
+
+
+def set_board_filter(fingerprint):
+    """ Informs the filter/variant currently applied to the board, None for none """
+    global board_filter
+    board_filter = fingerprint
+
+
+def options_key(po):
+    """ Returns a hashable representation of the plot options """
+    cls = type(po)
+    names = getters.get(cls)
+    if names is None:
+        names = getters[cls] = [n for n in sorted(dir(po)) if n.startswith('Get') and n not in IGNORED_OPTIONS]
+    key = []
+    for name in names:
+        try:
+            v = getattr(po, name)()
+        except Exception:
+            # Getters needing arguments or not implemented
+            continue
+        if isinstance(v, (bool, int, float, str)):
+            key.append((name, v))
+        elif hasattr(v, 'FmtHex'):
+            # LSET
+            key.append((name, v.FmtHex()))
+    return tuple(key)
+
+
+def _get_key(pc, board, layers, suffix, fmt, sheet, color_mode):
+    return (id(board), revision, board.GetFileName(), board.GetTitleBlock().GetTitle(), board_filter,
+            board.GetVisibleLayers().FmtHex(), options_key(pc.GetPlotOptions()), color_mode, tuple(layers), suffix, fmt,
+            sheet)
+
+
+def _store(key, fname):
+    global temp_dir, temp_dir_pid
+    if temp_dir is None or temp_dir_pid != os.getpid():
+        # Forked processes use their own dir
+        temp_dir = mkdtemp(prefix='tmp-kibot-plot_cache-')
+        temp_dir_pid = os.getpid()
+    cached = os.path.join(temp_dir, str(len(cache)))
+    copy2(fname, cached)
+    cache[key] = (cached, os.path.basename(fname))
+
+
+def plot_layers(pc, layers, suffix, fmt, sheet, board=None, color_mode=None):
+    """ Plots `layers` to one file, like OpenPlotfile + SetLayer/PlotLayer + ClosePlot.
+        The color mode only applies to an open plot, use `color_mode` to change it.
+        Reuses a previous plot when all the involved parameters are the same.
+        Returns the name of the plotted file. """
+    global hits
+    if board is None:
+        board = GS.board
+    if not GS.global_cache_layer_plots:
+        key = None
+    else:
+        key = _get_key(pc, board, layers, suffix, fmt, sheet, color_mode)
+        cached = cache.get(key)
+        if cached is not None:
+            hits += 1
+            fname = os.path.join(pc.GetPlotOptions().GetOutputDirectory(), cached[1])
+            logger.debugl(2, f'- Reusing the plot of layers {layers} ({cached[0]} -> {fname})')
+            copy2(cached[0], fname)
+            return fname
+    # KiCad 6.0.8 needs a layer before opening the file
+    pc.SetLayer(layers[0])
+    pc.OpenPlotfile(suffix, fmt, sheet)
+    for la in layers:
+        if color_mode is not None:
+            pc.SetColorMode(color_mode)
+        pc.SetLayer(la)
+        pc.PlotLayer()
+    pc.ClosePlot()
+    fname = pc.GetPlotFileName()
+    if key is not None:
+        _store(key, fname)
+    return fname
+
+
+def clear():
+    """ Discards all the cached plots """
+    global temp_dir, hits
+    if cache:
+        logger.debug(f'Layer plots cache: {len(cache)} plots, reused {hits} times')
+    cache.clear()
+    hits = 0
+    if temp_dir is not None and temp_dir_pid == os.getpid():
+        rmtree(temp_dir, ignore_errors=True)
+    temp_dir = None
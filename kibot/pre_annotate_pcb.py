@@ -10,6 +10,7 @@ from .misc import W_NOANNO
 from .kicad.v5_sch import SchematicComponent
 from .optionable import Optionable
 from .macros import macros, document, pre_class  # noqa: F401
+from . import plot_cache
 from .log import get_logger
 
 logger = get_logger(__name__)
@@ -224,6 +225,8 @@ class Annotate_PCB(BasePreFlight):  # noqa: F821
             else:
                 changes[old_ref] = m.new_ref_suffix
             m.footprint.SetReference(new_ref)
+        # The references changed
+        plot_cache.board_changed()
         logger.debug('- Saving PCB')
         GS.make_bkp(GS.pcb_file)
         GS.board.Save(GS.pcb_file)
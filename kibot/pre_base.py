@@ -17,6 +17,7 @@ logger = get_logger(__name__)
 
 class BasePreFlight(Registrable):
     _registered = {}
+    _kind = 'pre'
     _in_use = {}
     _options = {}
     _targets = None
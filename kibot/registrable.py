@@ -21,6 +21,12 @@ def fname(file):
 
 class Registrable(object):
     """ This class adds the mechanism to register plug-ins """
+    # Kind of plug-in, used to import them on demand
+    _kind = None
+    # Functions used to import the plug-ins on demand (assigned by kiplot.load_actions)
+    _load_plugin = None
+    _load_all_plugins = None
+
     def __init__(self):
         super().__init__()
 
@@ -28,16 +34,25 @@ class Registrable(object):
     def register(cl, name, aclass):
         cl._registered[name] = aclass
 
+    @classmethod
+    def _solve_plugin(cl, name):
+        if name not in cl._registered and Registrable._load_plugin is not None:
+            Registrable._load_plugin(cl._kind, name)
+
     @classmethod
     def is_registered(cl, name):
+        cl._solve_plugin(name)
         return name in cl._registered
 
     @classmethod
     def get_class_for(cl, name):
+        cl._solve_plugin(name)
         return cl._registered[name]
 
     @classmethod
     def get_registered(cl):
+        if Registrable._load_all_plugins is not None:
+            Registrable._load_all_plugins(cl._kind)
         return cl._registered
 
     def __str__(self):
@@ -49,6 +64,7 @@ class RegOutput(Optionable, Registrable):
         Used by BaseOutput.
         Here because it doesn't need macros. """
     _registered = {}
+    _kind = 'output'
     # Defined filters
     _def_filters = {}
     # Defined variants
@@ -114,6 +130,10 @@ class RegOutput(Optionable, Registrable):
     def get_filter(name):
         return RegOutput._def_filters[name]
 
+    @staticmethod
+    def get_filters():
+        return RegOutput._def_filters
+
     @staticmethod
     def add_filter(obj):
         RegOutput._def_filters[obj.name] = obj
@@ -211,6 +231,7 @@ class RegVariant(Optionable, Registrable):
         Used by BaseVariant.
         Here because it doesn't need macros. """
     _registered = {}
+    _kind = 'variant'
 
     def __init__(self):
         super().__init__()
@@ -221,6 +242,7 @@ class RegFilter(Optionable, Registrable):
         Used by BaseFilter.
         Here because it doesn't need macros. """
     _registered = {}
+    _kind = 'filter'
 
     def __init__(self):
         super().__init__()
@@ -403,6 +403,24 @@ def fromstring(text):
     return fig
 
 
+def frombytes(data):
+    """Create a SVG figure from the raw content of a file.
+
+    Parameters
+    ----------
+    data : bytes
+        content of the SVG file, no need to decode it.
+
+    Returns
+    -------
+    SVGFigure
+        newly created :py:class:`SVGFigure` initialised with the content.
+    """
+    fig = SVGFigure()
+    fig.root = etree.fromstring(data, parser=etree.XMLParser(huge_tree=True))
+    return fig
+
+
 def from_mpl(fig, savefig_kw=None):
     """Create a SVG figure from a ``matplotlib`` figure.
 
@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2024 Salvador E. Tropea
+# Copyright (c) 2024 Instituto Nacional de Tecnología Industrial
+# License: GPL-3.0
+# Project: KiBot (formerly KiPlot)
+"""
+Persistent KiBot process used by the generated Makefiles (`make WORKER=1 -jN`).
+The worker loads the configuration, the PCB and the schematic, configures the outputs and runs the preflights only once.
+Then it waits for requests in a Unix socket, each request is solved by a forked process, so we can run many outputs
+in parallel and they can't affect each other.
+The protocol (see worker_client.py):
+- The client sends a JSON line: {"targets": [...], "cwd": "..."} or {"stop": true}
+- The reply is the log of the outputs, followed by EXIT_MARKER and the exit code
+- When the inputs changed the worker exits and replies RESTART_MARKER to all the waiting clients, so they can start a
+  fresh one
+"""
+import json
+from multiprocessing import get_all_start_methods
+import os
+import selectors
+import socket
+import sys
+import time
+import traceback
+from .gs import GS
+from .kiplot import config_output, preflight_checks, setup_resources, _generate_outputs
+from .misc import EXIT_BAD_ARGS, FAILED_EXECUTE, INTERNAL_ERROR
+from .registrable import RegOutput
+from .worker_client import EXIT_MARKER, RESTART_MARKER, CHUNK_SIZE
+from . import board_snapshot
+from . import build_state
+from . import plot_cache
+from . import log
+
+logger = log.get_logger()
+# Exit after this time (in seconds) without requests
+IDLE_TIMEOUT = 900
+# How often we check for finished children and the idle time
+POLL_TIME = 1
+# Maximum time to get the request after a connection, we keep serving other connections meanwhile
+REQUEST_TIMEOUT = 10
+MAX_REQUEST = 1 << 20
+
+
+def get_stamps(files):
+    stamps = {}
+    for f in files:
+        try:
+            stamps[f] = os.stat(f).st_mtime_ns
+        except OSError:
+            stamps[f] = None
+    return stamps
+
+
+def inputs_changed(stamps):
+    for f, stamp in get_stamps(stamps.keys()).items():
+        if stamp != stamps[f]:
+            logger.debug(f'Worker: `{f}` changed')
+            return True
+    return False
+
+
+def listen(name):
+    """ Creates the socket, returns None if another worker is using it """
+    if os.path.exists(name):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(name)
+            sock.close()
+            return None
+        except OSError:
+            # Stale socket
+            sock.close()
+            os.remove(name)
+    srv = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(name)), exist_ok=True)
+        srv.bind(name)
+        srv.listen()
+    except OSError as e:
+        srv.close()
+        GS.exit_with_error(f'Unable to create the worker socket `{name}`: {e}', FAILED_EXECUTE)
+    return srv
+
+
+def close(srv, name):
+    srv.close()
+    try:
+        os.remove(name)
+    except OSError:
+        pass
+
+
+def daemonize():
+    """ Goes to background, the parent informs we are ready to accept requests """
+    sys.stdout.flush()
+    sys.stderr.flush()
+    if os.fork():
+        os._exit(0)
+    os.setsid()
+    null = os.open(os.devnull, os.O_RDWR)
+    for fd in range(3):
+        os.dup2(null, fd)
+    os.close(null)
+
+
+def read_request(conn, data):
+    """ Reads the available data for a request, the socket is non-blocking.
+        Returns the data read so far and the request, None if incomplete and False if malformed """
+    try:
+        chunk = conn.recv(CHUNK_SIZE)
+    except BlockingIOError:
+        return data, None
+    except OSError as e:
+        logger.debug(f'Worker: discarding request ({e})')
+        return data, False
+    data += chunk
+    if chunk and not data.endswith(b'\n') and len(data) < MAX_REQUEST:
+        return data, None
+    try:
+        req = json.loads(data)
+        if isinstance(req, dict):
+            return data, req
+        logger.debug('Worker: discarding malformed request (not a dict)')
+    except ValueError as e:
+        logger.debug(f'Worker: discarding malformed request ({e})')
+    return data, False
+
+
+def accept_waiting(srv, name):
+    """ Accepts the connections waiting in the backlog.
+        The socket is removed first, so no new connections can arrive. """
+    try:
+        os.remove(name)
+    except OSError:
+        pass
+    srv.setblocking(False)
+    conns = []
+    while True:
+        try:
+            conn, _ = srv.accept()
+        except OSError:
+            return conns
+        conns.append(conn)
+
+
+def reply_restart(conns):
+    """ Asks the clients to start a fresh worker.
+        We wait until the client closes the connection, closing it with an unread request resets it. """
+    for conn in conns:
+        try:
+            conn.settimeout(POLL_TIME)
+            conn.sendall(RESTART_MARKER)
+            conn.shutdown(socket.SHUT_WR)
+            while conn.recv(CHUNK_SIZE):
+                pass
+        except OSError:
+            pass
+        conn.close()
+
+
+def reply_error(conn, msg, code):
+    try:
+        conn.sendall(('ERROR:'+msg+'\n').encode()+EXIT_MARKER+f'{code}\n'.encode())
+    except OSError:
+        pass
+
+
+def run_request(conn, srv, targets, dont_stop):
+    """ Runs the requested outputs, the log goes to the client. Executed by a forked process. """
+    srv.close()
+    fd = conn.fileno()
+    os.dup2(fd, 1)
+    os.dup2(fd, 2)
+    code = 0
+    try:
+        try:
+            _generate_outputs(RegOutput.get_outputs(), targets, False, 'all', False, False, dont_stop, 1)
+        finally:
+            plot_cache.clear()
+            board_snapshot.clear()
+            build_state.save()
+    except SystemExit as e:
+        code = e.code if isinstance(e.code, int) else int(bool(e.code))
+    except BaseException:
+        traceback.print_exc()
+        code = INTERNAL_ERROR
+    try:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        conn.sendall(EXIT_MARKER+f'{code}\n'.encode())
+    finally:
+        os._exit(0)
+
+
+def reap(children, wait=False):
+    for pid in list(children):
+        try:
+            res, _ = os.waitpid(pid, 0 if wait else os.WNOHANG)
+        except ChildProcessError:
+            res = pid
+        if res:
+            children.discard(pid)
+
+
+def serve(srv, name, stamps, dont_stop):
+    children = set()
+    # Connections waiting for its request: socket -> [data, deadline]
+    pending = {}
+    sel = selectors.DefaultSelector()
+    sel.register(srv, selectors.EVENT_READ)
+    last = time.monotonic()
+    restart = None
+    finish = False
+    while not finish:
+        reap(children)
+        events = sel.select(POLL_TIME)
+        now = time.monotonic()
+        if not events and not children and not pending and now-last > IDLE_TIMEOUT:
+            logger.debug('Worker: idle timeout')
+            break
+        for key, _ in events:
+            if key.fileobj is srv:
+                try:
+                    conn, _ = srv.accept()
+                except OSError:
+                    continue
+                # A slow client can't block the other requests
+                conn.setblocking(False)
+                pending[conn] = [b'', now+REQUEST_TIMEOUT]
+                sel.register(conn, selectors.EVENT_READ)
+                last = now
+                continue
+            conn = key.fileobj
+            entry = pending[conn]
+            entry[0], req = read_request(conn, entry[0])
+            if req is None:
+                continue
+            sel.unregister(conn)
+            del pending[conn]
+            if req is False:
+                conn.close()
+                continue
+            conn.setblocking(True)
+            if req.get('stop'):
+                logger.debug('Worker: stop requested')
+                conn.sendall(EXIT_MARKER+b'0\n')
+                conn.close()
+                finish = True
+                break
+            if req.get('cwd') != os.getcwd():
+                reply_error(conn, f"The worker runs from `{os.getcwd()}`, not `{req.get('cwd')}`", EXIT_BAD_ARGS)
+                conn.close()
+                continue
+            if inputs_changed(stamps):
+                # Let the clients start a fresh worker
+                restart = [conn]
+                finish = True
+                break
+            targets = req.get('targets', [])
+            logger.debug(f'Worker: generating {targets}')
+            sys.stdout.flush()
+            sys.stderr.flush()
+            pid = os.fork()
+            if pid == 0:
+                for c in pending:
+                    c.close()
+                run_request(conn, srv, targets, dont_stop)
+            children.add(pid)
+            conn.close()
+        # Discard the connections that didn't send a request in time
+        for conn, (_, deadline) in list(pending.items()):
+            if finish or now > deadline:
+                sel.unregister(conn)
+                del pending[conn]
+                if restart is not None:
+                    # Its request will also need a fresh worker
+                    restart.append(conn)
+                    continue
+                logger.debug('Worker: discarding a connection without request')
+                conn.close()
+    sel.close()
+    if restart is not None:
+        restart.extend(accept_waiting(srv, name))
+        # The socket was already removed, a new worker could be using the name
+        srv.close()
+    else:
+        close(srv, name)
+    reap(children, wait=True)
+    return restart
+
+
+def run_worker(name, cfg_files, outputs, skip_pre, dont_stop):
+    """ Loads everything, goes to background and serves the requests from the Makefile """
+    if not hasattr(socket, 'AF_UNIX') or 'fork' not in get_all_start_methods():
+        GS.exit_with_error('The worker needs Unix sockets and `fork` support', EXIT_BAD_ARGS)
+    setup_resources()
+    prj = None
+    if GS.global_restore_project:
+        # Memorize the project content to restore it at exit
+        prj = GS.read_pro()
+    # Configure all the outputs, this also loads the PCB and schematic
+    for out in outputs:
+        config_output(out, dont_stop=dont_stop)
+    # The preflights with targets are handled by the Makefile
+    preflight_checks(skip_pre, list(RegOutput.get_outputs()))
+    files = list(cfg_files)
+    if GS.pcb_file:
+        files.append(GS.pcb_file)
+    if GS.sch:
+        files.extend(GS.sch.get_files())
+    elif GS.sch_file:
+        files.append(GS.sch_file)
+    stamps = get_stamps(os.path.abspath(f) for f in files)
+    srv = listen(name)
+    if srv is None:
+        logger.info(f'- A worker is already using `{name}`')
+        GS.write_pro(prj)
+        return
+    logger.info(f'- Worker ready, listening at `{name}`')
+    daemonize()
+    restart = None
+    try:
+        restart = serve(srv, name, stamps, dont_stop)
+    except Exception:
+        logger.error('Worker: '+traceback.format_exc())
+    finally:
+        GS.write_pro(prj)
+        if restart is not None:
+            reply_restart(restart)
+        os._exit(0)
@@ -0,0 +1,138 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# Copyright (c) 2024 Salvador E. Tropea
+# Copyright (c) 2024 Instituto Nacional de Tecnología Industrial
+# License: GPL-3.0
+# Project: KiBot (formerly KiPlot)
+"""
+Client for the persistent KiBot worker (see worker.py), used by the generated Makefiles.
+It only uses the Python standard library, so it starts fast.
+
+Usage: worker_client.py [--start | --stop] SOCKET [TARGET...]
+
+- Asks the worker listening at SOCKET to generate the TARGETs, the log is sent to stderr.
+- The exit code is the one from the worker.
+- If the worker isn't running we start it using the command in the KIBOT_WORKER_CMD environment variable.
+"""
+import errno
+import json
+import os
+import socket
+import subprocess
+import sys
+
+# Default name for the socket, created in the output dir
+WORKER_SOCKET = '.kibot_worker.sock'
+# Markers used by the worker to finish a reply, they can't be part of the log
+EXIT_MARKER = b'\x00KIBOT_EXIT '
+RESTART_MARKER = b'\x00KIBOT_RESTART\n'
+# Errors reported by the client, same values used by KiBot (misc.py)
+EXIT_BAD_ARGS = 6
+FAILED_EXECUTE = 25
+CHUNK_SIZE = 65536
+
+
+def error(msg, code):
+    print('ERROR:'+msg, file=sys.stderr)
+    sys.exit(code)
+
+
+def connect(name):
+    """ Connects to the worker, returns None if it isn't running """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(name)
+    except OSError as e:
+        sock.close()
+        if e.errno in (errno.ENOENT, errno.ECONNREFUSED):
+            return None
+        error(f'Unable to connect to the KiBot worker at `{name}`: {e}', FAILED_EXECUTE)
+    return sock
+
+
+def start_worker(name):
+    """ Connects to the worker, starting it if needed.
+        A lock avoids starting more than one worker when `make` runs many clients in parallel. """
+    import fcntl
+    os.makedirs(os.path.dirname(os.path.abspath(name)), exist_ok=True)
+    with open(name+'.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        sock = connect(name)
+        if sock is not None:
+            return sock
+        cmd = os.environ.get('KIBOT_WORKER_CMD')
+        if not cmd:
+            error('The KiBot worker is not running and KIBOT_WORKER_CMD is undefined', EXIT_BAD_ARGS)
+        # The worker goes to background once its ready to accept requests
+        res = subprocess.run(cmd, shell=True)
+        if res.returncode:
+            sys.exit(res.returncode)
+        sock = connect(name)
+        if sock is None:
+            error(f'The KiBot worker failed to start (`{cmd}`)', FAILED_EXECUTE)
+        return sock
+
+
+def request(name, data):
+    """ Sends a request and copies the reply to stderr.
+        Returns the exit code or None if the worker asked for a restart.
+        A connection reset, or closed without the exit code, is also a restart, the worker could be finishing. """
+    sock = start_worker(name)
+    with sock:
+        try:
+            sock.sendall(json.dumps(data).encode()+b'\n')
+            out = sys.stderr.buffer
+            pending = b''
+            while True:
+                chunk = sock.recv(CHUNK_SIZE)
+                if not chunk:
+                    return None
+                pending += chunk
+                pos = pending.find(b'\x00')
+                if pos < 0:
+                    out.write(pending)
+                    out.flush()
+                    pending = b''
+                    continue
+                out.write(pending[:pos])
+                out.flush()
+                pending = pending[pos:]
+                if pending.startswith(RESTART_MARKER):
+                    return None
+                if pending.startswith(EXIT_MARKER) and pending.endswith(b'\n'):
+                    return int(pending[len(EXIT_MARKER):])
+        except (ConnectionResetError, BrokenPipeError):
+            return None
+
+
+def main(args):
+    start = stop = False
+    if args and args[0] in ('--start', '--stop'):
+        start = args[0] == '--start'
+        stop = not start
+        args = args[1:]
+    if not args:
+        error('Usage: worker_client.py [--start | --stop] SOCKET [TARGET...]', EXIT_BAD_ARGS)
+    name = args[0]
+    if stop:
+        sock = connect(name)
+        if sock is None:
+            return 0
+        with sock:
+            sock.sendall(json.dumps({'stop': True}).encode()+b'\n')
+            sock.recv(CHUNK_SIZE)
+        return 0
+    if start:
+        start_worker(name).close()
+        return 0
+    data = {'targets': args[1:], 'cwd': os.getcwd()}
+    # The worker asks for a restart when the configuration, PCB or schematic changed
+    for _ in range(3):
+        res = request(name, data)
+        if res is not None:
+            return res
+    error('The KiBot worker keeps asking for a restart, or closing the connection', FAILED_EXECUTE)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
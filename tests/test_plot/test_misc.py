@@ -34,10 +34,14 @@ import shutil
 import logging
 import pytest
 import subprocess
+import sys
+import time
 import json
+import zipfile
 from . import context
 from kibot.misc import (EXIT_BAD_ARGS, EXIT_BAD_CONFIG, NO_PCB_FILE, NO_SCH_FILE, EXAMPLE_CFG, WONT_OVERWRITE, CORRUPTED_PCB,
                         PCBDRAW_ERR, NO_PCBNEW_MODULE, NO_YAML_MODULE, INTERNAL_ERROR, MISSING_FILES)
+from kibot import worker_client
 
 
 POS_DIR = 'positiondir'
@@ -645,6 +649,11 @@ def check_test_v5_sch_deps(ctx, deps, extra=(), in_output=False):
         assert os.path.relpath(ctx.yaml_file) in deps
 
 
+def check_out_deps(deps, expected):
+    """ The rules must depend on the board/schematic, the files mentioned in the options and the configuration """
+    assert sorted(deps) == sorted(expected), deps
+
+
 def check_makefile(ctx, mkfile, prj, dbg, txt):
     ctx.expect_out_file('Makefile')
     res = ctx.search_in_file('Makefile', [r'DEBUG\?=(.*)', txt])
@@ -665,39 +674,26 @@ def check_makefile(ctx, mkfile, prj, dbg, txt):
     assert len(deps) == 2, deps
     assert ctx.get_out_path(os.path.join(POS_DIR, prj+'-top_pos.csv')) in deps
     assert ctx.get_out_path(os.path.join(POS_DIR, prj+'-bottom_pos.csv')) in deps
-    deps = targets[targets['position']].split(' ')
-    assert len(deps) == 2
-    assert board_file in deps
-    assert yaml in deps
+    check_out_deps(targets[targets['position']].split(' '), [board_file, yaml])
     logging.debug('- Target `position` OK')
     # interactive_bom target
     deps = targets['interactive_bom'].split(' ')
     assert len(deps) == 1, deps
     assert ctx.get_out_path(os.path.join('ibom', prj+'-ibom.html')) in deps
-    deps = targets[targets['interactive_bom']].split(' ')
-    assert len(deps) == 3
-    assert board_file in deps
-    assert yaml in deps
-    assert 'tests/board_samples/kicad_5/bom.xml' in deps
+    check_out_deps(targets[targets['interactive_bom']].split(' '),
+                   [board_file, yaml, 'tests/board_samples/kicad_5/bom.xml'])
     logging.debug('- Target `interactive_bom` OK')
     # pcb_render target
     deps = targets['pcb_render'].split(' ')
     assert len(deps) == 1, deps
     assert ctx.get_out_path(prj+'-top$.svg') in deps
-    deps = targets[targets['pcb_render']].split(' ')
-    assert len(deps) == 3
-    assert board_file in deps
-    assert yaml in deps
-    assert 'tests/data/html_style.css' in deps
+    check_out_deps(targets[targets['pcb_render']].split(' '), [board_file, yaml, 'tests/data/html_style.css'])
     logging.debug('- Target `pcb_render` OK')
     # print_front target
     deps = targets['print_front'].split(' ')
     assert len(deps) == 1, deps
     assert ctx.get_out_path(prj+'-F_Cu+F_SilkS.pdf') in deps
-    deps = targets[targets['print_front']].split(' ')
-    assert len(deps) == 2
-    assert board_file in deps
-    assert yaml in deps
+    check_out_deps(targets[targets['print_front']].split(' '), [board_file, yaml])
     logging.debug('- Target `print_front` OK')
     # drill target
     deps = targets['drill'].split(' ')
@@ -705,10 +701,7 @@ def check_makefile(ctx, mkfile, prj, dbg, txt):
     assert ctx.get_out_path(os.path.join('gerbers', prj+'-drill.drl')) in deps
     assert ctx.get_out_path(os.path.join('gerbers', prj+'-drill_report.txt')) in deps
     assert ctx.get_out_path(os.path.join('gerbers', prj+'-drill_map.pdf')) in deps
-    deps = targets[targets['drill']].split(' ')
-    assert len(deps) == 2
-    assert board_file in deps
-    assert yaml in deps
+    check_out_deps(targets[targets['drill']].split(' '), [board_file, yaml])
     logging.debug('- Target `drill` OK')
     # svg_sch_def
     deps = targets['svg_sch_def'].split(' ')
@@ -732,10 +725,7 @@ def check_makefile(ctx, mkfile, prj, dbg, txt):
     deps = targets['Board_View_Test'].split(' ')
     assert len(deps) == 1, deps
     assert ctx.get_out_path(prj+'-boardview.brd') in deps
-    deps = targets[targets['Board_View_Test']].split(' ')
-    assert len(deps) == 2
-    assert board_file in deps
-    assert yaml in deps
+    check_out_deps(targets[targets['Board_View_Test']].split(' '), [board_file, yaml])
     logging.debug('- Target `Board View Test` OK')
     # pdf_sch_int
     deps = targets['pdf_sch_int'].split(' ')
@@ -850,6 +840,114 @@ def test_makefile_2(test_dir):
     ctx.clean_up()
 
 
+def run_make(mkfile, target):
+    res = subprocess.run(['make', '-f', mkfile, 'WORKER=1', target], capture_output=True, text=True)
+    logging.debug(res.stdout+res.stderr)
+    return res.returncode, res.stdout+res.stderr
+
+
+def test_makefile_worker_1(test_dir):
+    """ Makefile using the persistent worker: start, request, restart after a PCB change, wrong dir and stop """
+    prj = 'test_v5'
+    ctx = context.TestContext(test_dir, prj, 'makefile_worker_1')
+    pcb_file = ctx.get_out_path(os.path.basename(ctx.board_file))
+    shutil.copy2(ctx.board_file, pcb_file)
+    mkfile = ctx.get_out_path('Makefile')
+    sock = ctx.get_out_path(worker_client.WORKER_SOCKET)
+    client = [sys.executable, worker_client.__file__]
+    csv = ctx.get_out_path(os.path.join(POS_DIR, prj+'-both_pos.csv'))
+    ctx.run(extra=['-b', pcb_file, '-m', mkfile], no_board_file=True)
+    try:
+        # 1) Start the worker
+        code, log = run_make(mkfile, 'worker_start')
+        assert code == 0, log
+        assert 'Worker ready' in log
+        assert os.path.exists(sock)
+        # 2) A request solved by the running worker
+        code, log = run_make(mkfile, 'position')
+        assert code == 0, log
+        assert 'Worker ready' not in log
+        assert os.path.isfile(csv)
+        mtime = os.path.getmtime(csv)
+        # 3) The PCB changed, the client must start a fresh worker
+        stamp = time.time()+2
+        os.utime(pcb_file, (stamp, stamp))
+        code, log = run_make(mkfile, 'position')
+        assert code == 0, log
+        assert 'Worker ready' in log
+        assert os.path.getmtime(csv) > mtime
+        # 4) Requests from another directory are rejected
+        res = subprocess.run(client+[os.path.abspath(sock), 'position'], cwd=ctx.output_dir, capture_output=True,
+                             text=True)
+        assert res.returncode == EXIT_BAD_ARGS, res.stderr
+        assert 'The worker runs from' in res.stderr
+        # 5) Stop it
+        code, log = run_make(mkfile, 'worker_stop')
+        assert code == 0, log
+        for _ in range(50):
+            if not os.path.exists(sock):
+                break
+            time.sleep(0.2)
+        assert not os.path.exists(sock)
+    finally:
+        subprocess.run(client+['--stop', sock])
+    ctx.clean_up()
+
+
+def test_jobs_1(test_dir):
+    """ Parallel generation, compared to the sequential one """
+    prj = 'test_v5'
+    ctx = context.TestContext(test_dir, prj, 'jobs_1')
+    files = ['positiondir/'+prj+'-top_pos.csv', 'positiondir/'+prj+'-bottom_pos.csv', 'empty_1.zip', 'empty_2.zip',
+             'archive.zip', ctx.get_gerber_filename('F_Cu', '.svg'), 'Browse/'+prj+'-navigate.html']
+    totals = r'Found (\d+) unique warning/s \((\d+) total'
+    ctx.run(extra=['-j', '1'])
+    ctx.expect_out_file(files)
+    seq = ctx.search_out(totals).groups()
+    for f in files:
+        os.remove(ctx.get_out_path(f))
+    ctx.run(extra=['-j', '2'])
+    ctx.expect_out_file(files)
+    ctx.test_compress('archive.zip', [prj+'-top_pos.csv', prj+'-bottom_pos.csv'])
+    # The same warning from two outputs is counted as unique only once
+    assert ctx.search_out(totals).groups() == seq
+    # navigate_results has less priority, so it waits for the files it shows
+    ctx.search_err(r'W091', invert=True)
+    ctx.clean_up()
+
+
+def test_incremental_1(test_dir):
+    """ Incremental build, the archive must be updated when the board changes """
+    prj = 'test_v5'
+    ctx = context.TestContext(test_dir, prj, 'incremental_1')
+    pcb_file = ctx.get_out_path(os.path.basename(ctx.board_file))
+    shutil.copy2(ctx.board_file, pcb_file)
+    csv = 'positiondir/'+prj+'-both_pos.csv'
+    # 1) Create all
+    ctx.run(extra=['-b', pcb_file], no_board_file=True)
+    ctx.expect_out_file([csv, 'archive.zip'])
+    ctx.search_err('Skipped, nothing changed', invert=True)
+    # 2) Nothing changed
+    ctx.run(extra=['-b', pcb_file, 'archive'], no_board_file=True)
+    ctx.search_err('Skipped, nothing changed')
+    # 3) Change a value in the board and ask for the archive, the position must be updated first
+    with open(pcb_file, 'rt') as f:
+        pcb = f.read()
+    pcb = re.sub(r'(\(fp_text value |\(property "Value" )("[^"]*"|\S+)', r'\1"KIBOT_CHANGED"', pcb, count=1)
+    assert 'KIBOT_CHANGED' in pcb
+    with open(pcb_file, 'wt') as f:
+        f.write(pcb)
+    ctx.run(extra=['-b', pcb_file, 'archive'], no_board_file=True)
+    ctx.search_err('Skipped, nothing changed', invert=True)
+    with zipfile.ZipFile(ctx.get_out_path('archive.zip')) as zip:
+        assert 'KIBOT_CHANGED' in zip.read(prj+'-both_pos.csv').decode()
+    # 4) The state recorded after generating the archive is the final one
+    ctx.run(extra=['-b', pcb_file, 'archive'], no_board_file=True)
+    ctx.search_err('Skipped, nothing changed')
+    ctx.search_err('Updating `position`')
+    ctx.clean_up()
+
+
 def test_empty_zip(test_dir):
     prj = 'test_v5'
     ctx = context.TestContext(test_dir, prj, 'empty_zip')
@@ -1072,14 +1170,58 @@ def test_date_format_2(test_dir):
 def test_download_datasheets_1(test_dir):
     prj = 'kibom-variant_2ds'
     ctx = context.TestContextSCH(test_dir, prj, 'download_datasheets_1')
-    # We use a fake server to avoid needing good URLs and reliable internet connection
-    ctx.run(kicost=True)
+    # Don't touch the user cache
+    os.environ['KIBOT_CACHE_DIR'] = ctx.get_out_path('cache')
+    try:
+        # We use a fake server to avoid needing good URLs and reliable internet connection
+        ctx.run(kicost=True)
+    finally:
+        del os.environ['KIBOT_CACHE_DIR']
     ctx.expect_out_file('DS/C0805C102J4GAC7800.pdf')
     ctx.expect_out_file('DS/CR0805-JW-102ELF.pdf')
     ctx.expect_out_file('DS_production/CR0805-JW-102ELF.pdf')
     ctx.expect_out_file('DS_test/C0805C102J4GAC7800-1000 pF__test.pdf')
     ctx.expect_out_file('DS_test/C0805C102J4GAC7800-1nF__test.pdf')
     ctx.expect_out_file('DS_test/CR0805-JW-102ELF-3k3__test.pdf')
+    # The cache is disabled by default
+    assert not os.path.isdir(ctx.get_out_path(os.path.join('cache', 'datasheets')))
+    ctx.clean_up()
+
+
+@pytest.mark.slow
+def test_download_datasheets_2(test_dir):
+    """ Concurrent download and cache """
+    prj = 'kibom-variant_2ds'
+    ctx = context.TestContextSCH(test_dir, prj, 'download_datasheets_2')
+    os.environ['KIBOT_CACHE_DIR'] = ctx.get_out_path('cache')
+    try:
+        # 1) Download using the fake server
+        ctx.run(kicost=True)
+        ctx.expect_out_file('DS/C0805C102J4GAC7800.pdf')
+        ctx.expect_out_file('DS/CR0805-JW-102ELF.pdf')
+        ctx.search_err(r'Downloaded: http://localhost:8000/c.pdf')
+        # 2) Now the server reports the files aren't modified, so we use the cache
+        shutil.rmtree(ctx.get_out_path('DS'))
+        ctx.run(kicost=True)
+        ctx.expect_out_file('DS/C0805C102J4GAC7800.pdf')
+        ctx.expect_out_file('DS/CR0805-JW-102ELF.pdf')
+        ctx.search_err(r'Not modified: http://localhost:8000/c.pdf')
+    finally:
+        del os.environ['KIBOT_CACHE_DIR']
+    ctx.clean_up()
+
+
+@pytest.mark.slow
+def test_download_datasheets_3(test_dir):
+    """ Retry downloads that failed """
+    prj = 'kibom-variant_2ds'
+    ctx = context.TestContextSCH(test_dir, prj, 'download_datasheets_3')
+    # The fake server fails the first request for each /flaky/ URL
+    ctx.run(kicost=True)
+    ctx.expect_out_file('DS/C0805C102J4GAC7800.pdf')
+    ctx.expect_out_file('DS/CR0805-JW-102ELF.pdf')
+    ctx.search_err(r'Failed with status 503 downloading `http://localhost:8000/flaky/c.pdf`, retry 1')
+    ctx.search_err(r'Downloaded: http://localhost:8000/flaky/c.pdf')
     ctx.clean_up()
 
 
@@ -1,22 +1,39 @@
+from collections import Counter
 from decimal import Decimal as D
+from io import BytesIO
+import itertools
+import json
 import os
+import pickle
+import random
 import re
 import pytest
+import socket
+import threading
+import time
 import coverage
 import logging
 import requests
 import subprocess
 import sys
+import zipfile
 from . import context
 from kibot.layer import Layer
 from kibot.pre_base import BasePreFlight
-from kibot.out_base import BaseOutput
+from kibot.out_base import BaseOutput, VariantOptions
 from kibot.gs import GS
-from kibot.kiplot import load_actions, _import, load_board, generate_makefile
+from kibot.error import KiPlotConfigurationError
+from kibot.kiplot import (load_actions, _import, load_board, generate_makefile, get_plugins_index, plugins_types,
+                          PLUGINS_CLASSES, _macro_cache_source_to_code, load_any_sch, load_sch, expand_fields,
+                          get_board_comps_data, get_outputs_dag)
+import kibot.kiplot as kiplot
+import kibot.mcpyrate.importer as mcpyrate_importer
 from kibot.dep_downloader import search_as_plugin
 from kibot.registrable import RegOutput, RegFilter
-from kibot.misc import (WRONG_INSTALL, BOM_ERROR, DRC_ERROR, ERC_ERROR, PDF_PCB_PRINT, KICAD2STEP_ERR)
+from kibot.misc import (WRONG_INSTALL, BOM_ERROR, DRC_ERROR, ERC_ERROR, PDF_PCB_PRINT, KICAD2STEP_ERR, W_WRONGOAR,
+                        VIATYPE_THROUGH, VIATYPE_BLIND_BURIED, VIATYPE_MICROVIA, WARN_AS_ERROR)
 from kibot.bom.columnlist import ColumnList
+from kibot.bom.bom import create_groups
 from kibot.bom.units import get_prefix, comp_match
 import kibot.bom.units as units
 from kibot.bom.electro_grammar import parse
@@ -24,7 +41,18 @@ from kibot.__main__ import detect_kicad
 from kibot.kicad.config import KiConf
 from kibot.globals import Globals
 from kibot.PcbDraw.unit import read_resistance
-from kibot.out_download_datasheets import Download_Datasheets_Options
+from kibot.kicad.sexpdata import (LazySExp, loads, dumps, sexp_iter, Parser, FastParser, Symbol, Quoted, Bracket)
+from kibot.kicad.v5_sch import get_attrs
+import kibot.kicad.v5_sch as v5_sch
+import kibot.kicad.v6_sch as v6_sch
+from kibot import plot_cache, build_state, worker, comps_cache, board_snapshot, log
+from kibot.worker_client import EXIT_MARKER, RESTART_MARKER
+from kibot import worker_client
+from kibot.out_download_datasheets import Download_Datasheets_Options, DatasheetsFetcher
+from kibot.out_bom import DEFAULT_ALIASES
+from kibot.out_report import INF, adjust_drill
+from kibot.bom.xlsx_writer import copy_specs_to_components
+import kibot.svgutils.transform as svgutils
 
 cov = coverage.Coverage()
 mocked_check_output_FNF = True
@@ -590,6 +618,12 @@ def mocked_requests_get(url, allow_redirects=True, headers=None, timeout=20):
     return res
 
 
+def mocked_session_get(self, url, **kwargs):
+    res = mocked_requests_get(url)
+    res.raw = BytesIO()
+    return res
+
+
 @pytest.mark.indep
 def test_ds_net_error(test_dir, caplog, monkeypatch):
     ctx = context.TestContext(test_dir, 'test_v5', 'empty_zip', '')
@@ -600,6 +634,7 @@ def test_ds_net_error(test_dir, caplog, monkeypatch):
         o = Download_Datasheets_Options()
         o._downloaded = {'dnl'}
         o._created = []
+        o._fetcher = DatasheetsFetcher(1, 1, 0, 0, 20, False)
         c = Comp()
         o.download(c, '1N1234.pdf', 'pp', '1N1234', None)
         assert 'Invalid URL' in caplog.text
@@ -612,7 +647,7 @@ def test_ds_net_error(test_dir, caplog, monkeypatch):
             o.download(c, 'ok', '', dummy, None)
             o._dry = False
             assert dummy in o._created
-            m.setattr('requests.get', mocked_requests_get)
+            m.setattr('requests.Session.get', mocked_session_get)
             caplog.clear()
             o.download(c, '1', 'pp', '1N1234', None)
             assert 'Failed with status 666' in caplog.text
@@ -631,3 +666,1710 @@ def test_ds_net_error(test_dir, caplog, monkeypatch):
             caplog.clear()
             o.download(c, '6', 'pp', '1N1234', None)
             assert 'Hello!' in caplog.text
+        o._fetcher.close()
+
+
+class DSComp(object):
+    def __init__(self, ref):
+        self.ref = ref
+
+    def get_field_value(self, field):
+        return None
+
+
+@pytest.mark.indep
+def test_ds_out_name(caplog):
+    """ The names are computed once, so the warnings aren't repeated """
+    with context.cover_it(cov):
+        load_actions()
+        init_globals()
+        o = Download_Datasheets_Options()
+        o.output = '${no_field}.pdf'
+        c = DSComp('R1')
+        assert o.out_name(c) == 'Unknown.pdf'
+        assert o.out_name(c) == 'Unknown.pdf'
+        assert caplog.text.count('Field `no_field` not defined for R1') == 1
+
+
+@pytest.mark.indep
+def test_ds_cache_evict(tmp_path, monkeypatch):
+    """ The least recently used datasheets are removed from the cache """
+    monkeypatch.setenv('KIBOT_CACHE_DIR', str(tmp_path))
+    cache_dir = os.path.join(str(tmp_path), 'datasheets')
+    with context.cover_it(cov):
+        fetcher = DatasheetsFetcher(1, 1, 0, 0, 20, True, cache_max_size=1)
+        assert fetcher.cache_dir == cache_dir
+        for n in range(4):
+            base = os.path.join(cache_dir, str(n))
+            with open(base+'.data', 'wb') as f:
+                f.write(b'x'*400*1024)
+            with open(base+'.json', 'wt') as f:
+                f.write('{}')
+            os.utime(base+'.data', (1000+n, 1000+n))
+        # Recently used
+        os.utime(os.path.join(cache_dir, '0.data'), (2000, 2000))
+        fetcher.close()
+        assert sorted(os.listdir(cache_dir)) == ['0.data', '0.json', '3.data', '3.json']
+
+
+class FakeOutput(object):
+    """ Output with known targets and dependencies, `targets` is None when they can't be determined """
+    def __init__(self, name, priority, targets, deps=()):
+        self.name = name
+        self.priority = priority
+        self.dir = '.'
+        self.targets = targets
+        self.deps = deps
+
+    def expand_dirname(self, name):
+        return name
+
+    def get_targets(self, out_dir):
+        if self.targets is None:
+            raise KiPlotConfigurationError('unknown targets')
+        return [os.path.join(out_dir, f) for f in self.targets]
+
+    def get_dependencies(self):
+        return [os.path.join(GS.out_dir, f) for f in self.deps]
+
+
+@pytest.mark.indep
+def test_outputs_dag(tmp_path, monkeypatch):
+    """ Outputs wait for the ones generating the files they need and for the ones with more priority """
+    monkeypatch.setattr(GS, 'out_dir', str(tmp_path))
+    qr_lib = FakeOutput('qr_lib', 90, ['qr.kicad_sym'])
+    pos = FakeOutput('pos', 50, ['pos.csv'])
+    svg = FakeOutput('svg', 50, ['layer.svg'])
+    compress = FakeOutput('zip', 50, ['pos.zip'], ['pos.csv'])
+    unknown = FakeOutput('unknown', 50, None)
+    navigate = FakeOutput('navigate', 10, ['navigate.html'])
+    with context.cover_it(cov):
+        needs = get_outputs_dag([qr_lib, pos, svg, compress, unknown, navigate])
+        assert needs == {'qr_lib': set(), 'pos': {'qr_lib'}, 'svg': {'qr_lib'}, 'zip': {'qr_lib', 'pos'},
+                         'unknown': {'qr_lib', 'pos', 'svg', 'zip'},
+                         'navigate': {'qr_lib', 'pos', 'svg', 'zip', 'unknown'}}
+        # Without priority (CLI order) we keep the order when the priority is different
+        needs = get_outputs_dag([navigate, compress, pos, svg])
+        assert needs == {'navigate': set(), 'zip': {'navigate', 'pos'}, 'pos': {'navigate'}, 'svg': {'navigate'}}
+
+
+@pytest.mark.indep
+def test_plugins_index(tmp_path, monkeypatch):
+    """ The plug-ins index must resolve all the internal plug-ins, for each kind """
+    monkeypatch.setenv('KIBOT_CACHE_DIR', str(tmp_path))
+    with context.cover_it(cov):
+        load_actions()
+        internal_dir = os.path.dirname(os.path.abspath(sys.modules['kibot.kiplot'].__file__))
+        # Created from scratch and then reused from the cache
+        index = get_plugins_index(internal_dir)
+        fname = os.path.join(str(tmp_path), 'plugins_index.json')
+        with open(fname, 'rt') as f:
+            assert json.load(f) == index
+        index['reused'] = True
+        with open(fname, 'wt') as f:
+            json.dump(index, f)
+        assert get_plugins_index(internal_dir) == index
+        for kind, cls in PLUGINS_CLASSES.items():
+            types = plugins_types[kind]
+            assert types, kind
+            indexed = {tname: mod for mod, data in index['modules'].items() for k, tname in data['types'] if k == kind}
+            assert indexed == types
+            # Each indexed type is implemented by the module pointed by the index
+            for tname, mod in types.items():
+                assert cls.get_class_for(tname).__module__ == 'kibot.'+mod, tname
+            # Loading all the plug-ins doesn't add types missing in the index
+            assert set(types) <= set(cls.get_registered())
+            assert not cls.is_registered('__no_such_plugin__')
+
+
+class MacroLoader(object):
+    name = 'kibot.out_dummy'
+
+
+@pytest.mark.indep
+def test_macro_cache(tmp_path, monkeypatch):
+    """ The code after expanding the macros is reused, unless the source changes """
+    src_dir = os.path.join(str(tmp_path), 'src')
+    cache_dir = os.path.join(str(tmp_path), 'cache')
+    os.makedirs(cache_dir)
+    monkeypatch.setattr(kiplot, 'macro_cache_dir', cache_dir)
+    monkeypatch.setattr(kiplot, 'macro_cache_salt', b'salt')
+    monkeypatch.setattr(kiplot, 'macro_cache_paths', [os.path.join(src_dir, '')])
+    expanded = []
+    source_to_xcode = mcpyrate_importer.source_to_xcode
+
+    def mocked_source_to_xcode(loader, data, path):
+        expanded.append(path)
+        return source_to_xcode(loader, data, path)
+
+    monkeypatch.setattr(mcpyrate_importer, 'source_to_xcode', mocked_source_to_xcode)
+    path = os.path.join(src_dir, 'out_dummy.py')
+    with context.cover_it(cov):
+        # Miss: expanded and stored
+        code = _macro_cache_source_to_code(MacroLoader(), b'a = 1\n', path)
+        assert expanded == [path]
+        assert len(os.listdir(cache_dir)) == 1
+        # Hit: loaded from the cache
+        assert _macro_cache_source_to_code(MacroLoader(), b'a = 1\n', path) == code
+        assert expanded == [path]
+        # Miss: the source changed
+        _macro_cache_source_to_code(MacroLoader(), b'a = 2\n', path)
+        assert expanded == [path, path]
+        assert len(os.listdir(cache_dir)) == 2
+        # A corrupted entry is just a miss
+        for f in os.listdir(cache_dir):
+            with open(os.path.join(cache_dir, f), 'wb') as fh:
+                fh.write(b'x')
+        ns = {}
+        exec(_macro_cache_source_to_code(MacroLoader(), b'a = 1\n', path), ns)
+        assert ns['a'] == 1
+        assert len(expanded) == 3
+        # Files outside the cached paths aren't stored
+        other = os.path.join(str(tmp_path), 'other.py')
+        _macro_cache_source_to_code(MacroLoader(), b'a = 1\n', other)
+        assert expanded[-1] == other
+        assert len(os.listdir(cache_dir)) == 2
+
+
+@pytest.mark.indep
+def test_macro_cache_evict(tmp_path, monkeypatch):
+    """ The least recently used entries are removed when the cache is too big """
+    src_dir = os.path.join(str(tmp_path), 'src')
+    cache_dir = os.path.join(str(tmp_path), 'cache')
+    os.makedirs(cache_dir)
+    monkeypatch.setattr(kiplot, 'macro_cache_dir', cache_dir)
+    monkeypatch.setattr(kiplot, 'macro_cache_salt', b'salt')
+    monkeypatch.setattr(kiplot, 'macro_cache_paths', [os.path.join(src_dir, '')])
+    path = os.path.join(src_dir, 'out_dummy.py')
+    with context.cover_it(cov):
+        for n in range(3):
+            _macro_cache_source_to_code(MacroLoader(), f'a = {n}\n'.encode(), path)
+        entries = {os.path.join(cache_dir, f): os.path.getsize(os.path.join(cache_dir, f)) for f in os.listdir(cache_dir)}
+        assert len(entries) == 3
+        # Old entries, the first one is used again
+        for n, f in enumerate(sorted(entries)):
+            os.utime(f, (1000+n, 1000+n))
+        _macro_cache_source_to_code(MacroLoader(), b'a = 0\n', path)
+        used = max(entries, key=os.path.getmtime)
+        # Room for two entries, the new one and the recently used
+        monkeypatch.setattr(kiplot, 'macro_cache_max_size', (2*max(entries.values())+10)/(1024*1024))
+        _macro_cache_source_to_code(MacroLoader(), b'a = 3\n', path)
+        remain = {os.path.join(cache_dir, f) for f in os.listdir(cache_dir)}
+        assert len(remain) == 2
+        assert used in remain
+
+
+@pytest.mark.indep
+def test_macro_cache_user_plugin(tmp_path, monkeypatch):
+    """ The user plug-ins can import macros from their own modules, a change there must be detected """
+    internal_dir = os.path.join(os.path.dirname(kiplot.__file__), '')
+    with context.cover_it(cov):
+        load_actions()
+    # Only the internal plug-ins use the cache
+    assert all(p == internal_dir for p in kiplot.macro_cache_paths)
+    monkeypatch.setattr(kiplot, 'macro_cache_paths', [internal_dir])
+    monkeypatch.setattr(kiplot, 'macro_cache_mtime', 0)
+    monkeypatch.syspath_prepend(str(tmp_path))
+    macros_file = os.path.join(str(tmp_path), 'user_macros.py')
+    with open(macros_file, 'wt') as f:
+        f.write('def m(tree, **kw):\n    return tree\n')
+    plugin = os.path.join(str(tmp_path), 'out_user.py')
+    with open(plugin, 'wt') as f:
+        f.write('from user_macros import macros, m  # noqa: F401\n')
+    os.utime(plugin, (1000, 1000))
+    os.utime(macros_file, (2000, 2000))
+    with context.cover_it(cov):
+        # The user plug-in uses the mcpyrate stats, they include the macros module
+        assert kiplot._macro_cache_path_stats(MacroLoader(), plugin)['mtime'] == pytest.approx(2000)
+        # The internal ones just use `macros.py`
+        mtime = os.path.getmtime(kiplot.__file__)+1000
+        monkeypatch.setattr(kiplot, 'macro_cache_mtime', mtime)
+        assert kiplot._macro_cache_path_stats(MacroLoader(), kiplot.__file__)['mtime'] == mtime
+
+
+@pytest.mark.indep
+@pytest.mark.parametrize("board", ['kicad_6/light_control', 'kicad_7/glasgow', 'kicad_8/3Rs'])
+def test_lazy_sexp(board):
+    """ The lazy parser must give the same result as a full parse """
+    with open(os.path.join(os.path.dirname(__file__), '..', 'board_samples', board+'.kicad_pcb'), 'rt') as f:
+        text = f.read()
+    with context.cover_it(cov):
+        full = loads(text)[0]
+        lazy = LazySExp(text)
+        assert lazy.name == 'kicad_pcb'
+        for name in ('general', 'layers', 'setup', 'net', 'footprint', 'via', 'zone', 'not_used'):
+            assert lazy.get(name) == [e for e in full[1:] if isinstance(e, list) and e and e[0].value() == name], name
+        assert list(sexp_iter(LazySExp(text), 'setup/pcbplotparams')) == list(sexp_iter(full, 'setup/pcbplotparams'))
+        assert lazy.materialize() == full
+        # Without the KiCad indentation we must fall back to a full parse
+        text = text.replace('\n', ' ')
+        full = loads(text)[0]
+        flat = LazySExp(text)
+        assert flat.get('net') == [e for e in full[1:] if isinstance(e, list) and e and e[0].value() == 'net']
+        assert list(flat) == full
+
+
+def sexp_tree(e):
+    """ The S-expression with the type of each element, so 1, 1.0 and True aren't equal """
+    if isinstance(e, Bracket):
+        return ('bracket', e._bra, sexp_tree(e.value()))
+    if isinstance(e, Quoted):
+        return ('quoted', sexp_tree(e.value()))
+    if isinstance(e, Symbol):
+        return ('symbol', e.value())
+    if isinstance(e, list):
+        return [sexp_tree(v) for v in e]
+    # repr for floats, so NaN can be compared
+    return (type(e).__name__, repr(e) if isinstance(e, float) else e)
+
+
+def sexp_parse(parser, text):
+    try:
+        return sexp_tree(parser(text).parse())
+    except Exception as e:
+        # The reference parser fails with AttributeError for unterminated strings
+        return type(e).__name__
+
+
+@pytest.mark.indep
+@pytest.mark.parametrize("file", ['kicad_6/light_control.kicad_pcb', 'kicad_7/glasgow.kicad_pcb', 'kicad_8/3Rs.kicad_pcb',
+                                  'kicad_7/light_control.kicad_sch', 'kicad_8/3Rs.kicad_sch'])
+def test_fast_parser_samples(file):
+    """ The fast parser must give the same result as the reference parser, without falling back """
+    with open(os.path.join(os.path.dirname(__file__), '..', 'board_samples', file), 'rt') as f:
+        text = f.read()
+    with context.cover_it(cov):
+        assert sexp_tree(FastParser(text)._parse_fast()) == sexp_tree(Parser(text).parse())
+
+
+@pytest.mark.indep
+@pytest.mark.parametrize("text", [
+    # Strings and escapes
+    r'(a "b c" "" "esc \" \\ \n \t \r \b \f \x" "a;b" "(b)")',
+    '(a "multi\nline")',
+    # Numbers, special floats and things that look like numbers
+    '(a 1 -2 +3 1.5 -.5 .5 5. 1e5 1.5E-3 -1e+2 007)',
+    '(a nan NaN -nan inf -inf +inf Infinity infinity)',
+    '(a 1e 1.2.3 0x10 1a - + . -. e5 1_000)',
+    # Symbols, escaped symbols and special values
+    '(a b_c d-e f.g µF ñandú I N i n)',
+    r'(a b\ c d\(e\) \; f\"g)',
+    '(a t nil (nil) (t) T NIL)',
+    # Quoted and bracketed forms
+    "(a 'b '(c d) '[e])",
+    "'a",
+    '(a [b c] [d (e [f])] [])',
+    # Comments and white space
+    '(a b) ; comment\n(c ; inner ) comment\n d)',
+    '; only a comment',
+    '(a\tb\x0bc\x0cd\re)',
+    '',
+    '   \n ',
+    'a b 1',
+    # Malformed
+    '(a', 'a)', '(a]', '[a)', '(a "b)', '(a))',
+])
+def test_fast_parser_edge_cases(text):
+    """ The fast parser must give the same result as the reference parser """
+    with context.cover_it(cov):
+        assert sexp_parse(FastParser, text) == sexp_parse(Parser, text)
+        # Other options
+        for ops in ({'nil': None}, {'true': None}, {'false': 'f'}, {'line_comment': '#'}, {'nil': '0'}):
+            assert sexp_parse(lambda t: FastParser(t, **ops), text) == sexp_parse(lambda t: Parser(t, **ops), text)
+
+
+@pytest.mark.indep
+def test_sch_cache_version(tmp_path, monkeypatch):
+    """ A schematic from the cache must be usable by the writers """
+    sch_file = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'board_samples', 'kicad_7',
+                                            'light_control.kicad_sch'))
+    monkeypatch.setenv('KIBOT_CACHE_DIR', str(tmp_path))
+    with context.cover_it(cov):
+        load_actions()
+        init_globals()
+        monkeypatch.setattr(GS, 'global_cache_sch', True)
+        monkeypatch.setattr(GS, 'global_cache_sch_dir', '')
+        sch = load_any_sch(sch_file, 'light_control')
+        assert os.listdir(os.path.join(str(tmp_path), 'sch'))
+        fields = [dumps(f.write()) for c in sch.get_components() for f in c.fields]
+        # Now from the cache, the version isn't set by the parser
+        v6_sch.version = None
+        cached = load_any_sch(sch_file, 'light_control')
+        assert cached is not sch
+        assert v6_sch.version == sch.version
+        assert [dumps(f.write()) for c in cached.get_components() for f in c.fields] == fields
+
+
+def comps_by_sheet(sch):
+    """ The references of the components for each sheet instance """
+    res = {}
+    for c in sch.get_components():
+        res.setdefault((c.sheet_path, c.sheet_path_h), []).append(c.ref)
+    return res
+
+
+@pytest.mark.indep
+@pytest.mark.parametrize("sch_file,loader", [('kicad_5/test_v5.sch', (v5_sch, '_read_sch_file')),
+                                             ('kicad_7/test_v5.kicad_sch', (v6_sch, '_load_sch_sexp'))])
+def test_sch_repeated_sub_sheet(monkeypatch, sch_file, loader):
+    """ A sub-sheet used twice is loaded only once, each instance keeps its sheet path and references """
+    sch_file = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'board_samples', sch_file))
+    module, name = loader
+    loaded = Counter()
+    ori_loader = getattr(module, name)
+
+    def count_loaded(fname):
+        loaded[os.path.basename(fname)] += 1
+        return ori_loader(fname)
+
+    with context.cover_it(cov):
+        load_actions()
+        init_globals()
+        monkeypatch.setattr(GS, 'global_cache_sch', False)
+        monkeypatch.setattr(module, name, count_loaded)
+        sch = load_any_sch(sch_file, 'test_v5')
+        # The sub-sheet and the sheet inside it are used twice, but loaded once
+        ext = os.path.splitext(sch_file)[1]
+        assert loaded == {'test_v5'+ext: 1, 'sub-sheet'+ext: 1, 'deeper'+ext: 1}
+        assert not v5_sch.sheet_files.data
+        # Now without the cache
+        monkeypatch.setattr(v5_sch.SheetFilesCache, 'get', lambda self, fname, loader: loader(fname))
+        loaded.clear()
+        ref = load_any_sch(sch_file, 'test_v5')
+        assert loaded == {'test_v5'+ext: 1, 'sub-sheet'+ext: 2, 'deeper'+ext: 2}
+    by_sheet = comps_by_sheet(sch)
+    assert by_sheet == comps_by_sheet(ref)
+    # Each instance of the sub-sheet has its own path and references
+    subs = [s for s in by_sheet if s[1].startswith('/Sub Sheet') and s[1].count('/') == 1]
+    assert len(subs) == 2
+    assert subs[0][0] != subs[1][0]
+    assert by_sheet[subs[0]] and set(by_sheet[subs[0]]).isdisjoint(by_sheet[subs[1]])
+
+
+class GroupingConfig(object):
+    """ The BoM options used to group the components """
+    def __init__(self, fast_grouping, merge_blank_fields=True, merge_both_blank=True, fallbacks=False,
+                 group_connectors=True):
+        self.fast_grouping = fast_grouping
+        self.debug_level = 0
+        self.group_connectors = group_connectors
+        self.merge_blank_fields = merge_blank_fields
+        self.merge_both_blank = merge_both_blank
+        self.parse_value = True
+        self.group_fields = ColumnList.DEFAULT_GROUPING + ['voltage', 'tolerance', 'current', 'power']
+        self.group_fields_fallbacks = [None]*len(self.group_fields)
+        if fallbacks:
+            self.group_fields_fallbacks[self.group_fields.index('value')] = 'footprint'
+            self.group_fields_fallbacks[self.group_fields.index('voltage')] = 'power'
+        self.component_aliases = DEFAULT_ALIASES
+
+
+@pytest.mark.indep
+@pytest.mark.parametrize("opts", [{}, {'merge_blank_fields': False},
+                                  {'merge_blank_fields': False, 'merge_both_blank': False},
+                                  {'fallbacks': True}, {'group_connectors': False}])
+def test_bom_fast_grouping(opts):
+    """ The hashed grouping must create the same groups as the pairwise comparison """
+    samples = os.path.join(os.path.dirname(__file__), '..', 'board_samples')
+    with context.cover_it(cov):
+        load_actions()
+        init_globals()
+        comps = []
+        for sch in ('kicad_5/kibom-test.sch', 'kicad_5/kibom-test-2.sch', 'kicad_7/kibom-test-3.kicad_sch',
+                    'kicad_7/kibom-test-4.kicad_sch', 'kicad_7/kibom-test-rep.kicad_sch', 'kicad_7/bom.kicad_sch',
+                    'kicad_7/light_control.kicad_sch'):
+            file = os.path.abspath(os.path.join(samples, sch))
+            comps.extend(load_any_sch(file, os.path.splitext(os.path.basename(file))[0]).get_components())
+        assert len(comps) > 100
+        slow = create_groups(GroupingConfig(False, **opts), comps)
+        fast = create_groups(GroupingConfig(True, **opts), comps)
+        assert [[c.ref for c in g.components] for g in fast] == [[c.ref for c in g.components] for g in slow]
+
+
+class FakeLSET(object):
+    def __init__(self, val):
+        self.val = val
+
+    def FmtHex(self):
+        return self.val
+
+
+class FakeTitleBlock(object):
+    def GetTitle(self):
+        return 'Title'
+
+
+class FakeBoard(object):
+    def GetFileName(self):
+        return 'fake.kicad_pcb'
+
+    def GetTitleBlock(self):
+        return FakeTitleBlock()
+
+    def GetVisibleLayers(self):
+        return FakeLSET('ff')
+
+
+class FakePlotOptions(object):
+    def __init__(self, out_dir):
+        self.out_dir = out_dir
+        self.mirror = False
+
+    def GetOutputDirectory(self):
+        return self.out_dir
+
+    def GetMirror(self):
+        return self.mirror
+
+    def GetLayerSelection(self):
+        return FakeLSET('01')
+
+
+class FakePlotController(object):
+    """ Writes the plotted layers and options to the file """
+    def __init__(self, out_dir):
+        self.po = FakePlotOptions(out_dir)
+        self.plots = 0
+
+    def GetPlotOptions(self):
+        return self.po
+
+    def SetLayer(self, layer):
+        self.layer = layer
+
+    def SetColorMode(self, mode):
+        self.color_mode = mode
+
+    def OpenPlotfile(self, suffix, fmt, sheet):
+        self.fname = os.path.join(self.po.out_dir, suffix+'.svg')
+        self.content = f'{fmt} {sheet} {self.po.mirror} {plot_cache.board_filter}:'
+
+    def PlotLayer(self):
+        self.content += f' {self.layer}'
+
+    def ClosePlot(self):
+        self.plots += 1
+        with open(self.fname, 'wt') as f:
+            f.write(self.content)
+
+    def GetPlotFileName(self):
+        return self.fname
+
+
+@pytest.mark.indep
+def test_plot_cache(tmp_path, monkeypatch):
+    """ Identical plots are reused, different layers, options or variants are plotted again """
+    monkeypatch.setattr(GS, 'global_cache_layer_plots', True)
+    pc = FakePlotController(str(tmp_path))
+    board = FakeBoard()
+
+    def plot(layers, suffix='plot'):
+        fname = plot_cache.plot_layers(pc, layers, suffix, 1, 'sheet', board=board)
+        with open(fname, 'rt') as f:
+            return f.read()
+
+    with context.cover_it(cov):
+        plot_cache.clear()
+        try:
+            fab = plot([5])
+            # Same plot, reused
+            assert plot([5]) == fab
+            assert pc.plots == 1 and plot_cache.hits == 1
+            # Different layers
+            assert plot([6]) != fab
+            assert pc.plots == 2
+            # Different options
+            pc.po.mirror = True
+            mirrored = plot([5])
+            assert mirrored != fab
+            assert pc.plots == 3
+            pc.po.mirror = False
+            # Different variant applied to the board
+            plot_cache.set_board_filter('variant_1')
+            assert plot([5]) != fab
+            assert pc.plots == 4
+            plot_cache.set_board_filter(None)
+            assert plot([5]) == fab
+            assert pc.plots == 4
+            # The board changed
+            plot_cache.board_changed()
+            assert plot([5]) == fab
+            assert pc.plots == 5
+            # Disabled
+            monkeypatch.setattr(GS, 'global_cache_layer_plots', False)
+            plot([5])
+            assert pc.plots == 6
+            assert plot_cache.hits == 2
+        finally:
+            plot_cache.clear()
+
+
+@pytest.mark.indep
+def test_navigate_results_cache_evict(tmp_path):
+    """ The least recently used previews are removed from the cache """
+    with context.cover_it(cov):
+        load_actions()
+        o = RegOutput.get_class_for('navigate_results')().options()
+        o.cache_dir = str(tmp_path)
+        o.cache_max_size = 1
+        for n in range(4):
+            fname = os.path.join(o.cache_dir, str(n)+'.png')
+            with open(fname, 'wb') as f:
+                f.write(b'x'*400*1024)
+            os.utime(fname, (1000+n, 1000+n))
+        # Recently used
+        os.utime(os.path.join(o.cache_dir, '0.png'), (2000, 2000))
+        o.evict_cache()
+        assert sorted(os.listdir(o.cache_dir)) == ['0.png', '3.png']
+
+
+def git_commit(repo, files, msg):
+    for name, content in files.items():
+        fname = os.path.join(repo, name)
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+        with open(fname, 'wt') as f:
+            f.write(content)
+    subprocess.run(['git', 'add', '.'], cwd=repo, check=True)
+    subprocess.run(['git', '-c', 'user.name=KiBot', '-c', 'user.email=kibot@test', 'commit', '-q', '-m', msg], cwd=repo,
+                   check=True)
+    return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=repo, check=True, capture_output=True, text=True).stdout.strip()
+
+
+@pytest.mark.indep
+def test_kiri_content_keys(tmp_path):
+    """ The content key must change when a lib outside the project dir changes """
+    repo = str(tmp_path)
+    subprocess.run(['git', 'init', '-q'], cwd=repo, check=True)
+    h1 = git_commit(repo, {'prj/test.kicad_sch': 'sch', 'prj/test.kicad_pcb': 'pcb',
+                           'prj/sym-lib-table': '(lib (uri ${KIPRJMOD}/../libs/my.kicad_sym))',
+                           'libs/my.kicad_sym': 'sym 1'}, 'First')
+    h2 = git_commit(repo, {'libs/my.kicad_sym': 'sym 2'}, 'Lib changed')
+    h3 = git_commit(repo, {'README.md': 'Hello'}, 'Docs changed')
+    h4 = git_commit(repo, {'prj/test.kicad_pcb': 'pcb 2'}, 'PCB changed')
+    with context.cover_it(cov):
+        load_actions()
+        init_globals()
+        o = RegOutput.get_class_for('kiri')().options()
+        o.command = 'kidiff'
+        o.zones = 'none'
+        o.repo_dir = repo
+        o.git_command = 'git'
+        o.incl_file = None
+        o.sch_rel_name = 'prj/test.kicad_sch'
+        o.pcb_rel_name = 'prj/test.kicad_pcb'
+        keys = o.get_content_keys([[h1], [h2], [h3], [h4]])
+        assert keys[h1] != keys[h2]
+        assert keys[h2] == keys[h3]
+        assert keys[h3] != keys[h4]
+
+
+@pytest.mark.indep
+@pytest.mark.parametrize("compression", ['auto', 'stored', 'deflated', 'bzip2', 'lzma'])
+@pytest.mark.parametrize("jobs", [1, 4])
+def test_compress_zip_round_trip(tmp_path, compression, jobs):
+    """ The ZIP members compressed in parallel must be valid """
+    src = tmp_path / 'src'
+    src.mkdir()
+    files = {}
+    contents = {'big.txt': b'KiBot '*500000+os.urandom(100000), 'empty.txt': b'', 'image.png': os.urandom(1000)}
+    for n in range(8):
+        contents[f'file_{n}.txt'] = (f'File {n}\n'*(n*1000)).encode()
+    for name, data in contents.items():
+        (src / name).write_bytes(data)
+        files[str(src / name)] = 'dir/'+name
+    output = str(tmp_path / 'test.zip')
+    with context.cover_it(cov):
+        load_actions()
+        o = RegOutput.get_class_for('compress')().options()
+        o.compression = compression
+        o.jobs = jobs
+        o.create_zip(output, files)
+    with zipfile.ZipFile(output) as zip:
+        assert zip.testzip() is None
+        assert zip.namelist() == list(files.values())
+        for name, data in contents.items():
+            assert zip.read('dir/'+name) == data, name
+        expected = o.ZIP_ALGORITHMS[compression]
+        assert zip.getinfo('dir/big.txt').compress_type == expected
+        assert zip.getinfo('dir/image.png').compress_type == (zipfile.ZIP_STORED if compression == 'auto' else expected)
+
+
+@pytest.mark.indep
+def test_build_state_save_merge(tmp_path, monkeypatch):
+    """ Many processes (i.e. the Makefile worker) saving the build state at the same time """
+    monkeypatch.setattr(GS, 'out_dir', str(tmp_path))
+    monkeypatch.setattr(build_state, 'updates', {})
+    pids = []
+    for n in range(8):
+        pid = os.fork()
+        if pid == 0:
+            for i in range(20):
+                build_state.updates[f'out_{n}_{i}'] = {'fingerprint': str(n), 'targets': [str(i)]}
+                build_state.save()
+            os._exit(0)
+        pids.append(pid)
+    for pid in pids:
+        os.waitpid(pid, 0)
+    build_state.state = None
+    state = build_state.load()
+    assert len(state) == 8*20
+    assert state['out_3_7'] == {'fingerprint': '3', 'targets': ['7']}
+
+
+def worker_request(name, data):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(name)
+        sock.sendall(json.dumps(data).encode()+b'\n')
+        reply = b''
+        while True:
+            chunk = sock.recv(4096)
+            if not chunk:
+                return reply
+            reply += chunk
+
+
+@pytest.mark.indep
+def test_worker_slow_client(tmp_path):
+    """ A client that doesn't send its request can't block the worker """
+    with context.cover_it(cov):
+        name = str(tmp_path / 'worker.sock')
+        srv = worker.listen(name)
+        assert srv is not None
+        th = threading.Thread(target=worker.serve, args=(srv, name, {}, False), daemon=True)
+        th.start()
+        try:
+            slow = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            slow.connect(name)
+            # Requests from another directory are rejected
+            start = time.monotonic()
+            reply = worker_request(name, {'targets': ['position'], 'cwd': str(tmp_path)})
+            assert time.monotonic()-start < worker.REQUEST_TIMEOUT/2
+            assert reply.startswith(b'ERROR:The worker runs from')
+            assert reply.endswith(EXIT_MARKER+b'6\n')
+            assert worker_request(name, {'stop': True}) == EXIT_MARKER+b'0\n'
+        finally:
+            th.join(worker.REQUEST_TIMEOUT/2)
+            slow.close()
+        assert not th.is_alive()
+        assert not os.path.exists(name)
+
+
+def worker_client_thread(name, data, replies):
+    """ A client waiting for the reply of the worker """
+    def client():
+        reply = b''
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.connect(name)
+                if data is not None:
+                    sock.sendall(data)
+                while True:
+                    chunk = sock.recv(4096)
+                    if not chunk:
+                        break
+                    reply += chunk
+        except OSError as e:
+            reply = e
+        replies.append(reply)
+    th = threading.Thread(target=client, daemon=True)
+    th.start()
+    return th
+
+
+@pytest.mark.indep
+def test_worker_restart_all(tmp_path):
+    """ When the inputs changed all the waiting clients must get the restart, not just the first one """
+    with context.cover_it(cov):
+        name = str(tmp_path / 'worker.sock')
+        pcb = str(tmp_path / 'board.kicad_pcb')
+        with open(pcb, 'wt') as f:
+            f.write('old')
+        stamps = worker.get_stamps([pcb])
+        os.utime(pcb, ns=(stamps[pcb]+10**9, stamps[pcb]+10**9))
+        srv = worker.listen(name)
+        req = (json.dumps({'targets': ['position'], 'cwd': os.getcwd()})+'\n').encode()
+        replies = []
+        # Complete requests, incomplete requests and clients that didn't send the request, all in the backlog
+        clients = [worker_client_thread(name, data, replies) for data in [req, req, req[:5], None, req, None]]
+        time.sleep(0.2)
+        restart = worker.serve(srv, name, stamps, False)
+        assert len(restart) == len(clients)
+        assert not os.path.exists(name)
+        worker.reply_restart(restart)
+        for th in clients:
+            th.join(worker.REQUEST_TIMEOUT/2)
+        assert replies == [RESTART_MARKER]*len(clients)
+
+
+@pytest.mark.indep
+def test_worker_client_reset(tmp_path, monkeypatch):
+    """ A connection closed without the exit code is a restart, the client retries """
+    name = str(tmp_path / 'worker.sock')
+    srv = worker.listen(name)
+    accepted = []
+
+    def reset_connections():
+        for _ in range(3):
+            conn, _ = srv.accept()
+            # Close it without reading the request
+            time.sleep(0.1)
+            conn.close()
+            accepted.append(conn)
+    th = threading.Thread(target=reset_connections, daemon=True)
+    th.start()
+    with context.cover_it(cov):
+        try:
+            with pytest.raises(SystemExit) as e:
+                worker_client.main([name, 'position'])
+            assert e.value.code == worker_client.FAILED_EXECUTE
+            assert len(accepted) == 3
+        finally:
+            th.join(worker.REQUEST_TIMEOUT/2)
+            worker.close(srv, name)
+
+
+class FakeVariant(object):
+    """ Changes the fields and removes the components with an even number, sets the global variant """
+    def __init__(self):
+        self._sub_pcb = None
+        self.runs = 0
+
+    def filter(self, comps):
+        self.runs += 1
+        GS.variant = ['fake']
+        for c in comps:
+            c.set_field('Variant', 'fake')
+            if c.ref[-1] in '02468':
+                c.fitted = False
+        return comps
+
+
+class FakeFilter(object):
+    """ Removes the components with an odd number """
+    name = 'fake'
+    type = 'fake'
+
+    def __init__(self):
+        self.runs = 0
+
+    def filter(self, c):
+        self.runs += 1
+        return c.ref[-1] not in '13579'
+
+
+def comps_snapshot(comps):
+    return [(c.ref, c.fitted, c.included, c.value, [(f.name, f.value) for f in c.fields]) for c in comps]
+
+
+@pytest.mark.indep
+@pytest.mark.parametrize("use", ['variant', 'dnf_filter'])
+def test_comps_cache(tmp_path, monkeypatch, use):
+    """ An output changing the filtered components can't affect the next output using the same variant/filter """
+    sch_file = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'board_samples', 'kicad_7',
+                                            'light_control.kicad_sch'))
+    with context.cover_it(cov):
+        load_actions()
+        init_globals()
+        monkeypatch.setattr(GS, 'global_cache_filtered_components', True)
+        monkeypatch.setattr(GS, 'sch', load_any_sch(sch_file, 'light_control'))
+        monkeypatch.setattr(GS, 'pcb_file', None)
+        monkeypatch.setattr(GS, 'variant', None)
+        fil = FakeVariant() if use == 'variant' else FakeFilter()
+        outs = []
+        for _ in range(2):
+            o = VariantOptions()
+            o.variant = fil if use == 'variant' else None
+            o.dnf_filter = fil if use == 'dnf_filter' else None
+            o.pre_transform = None
+            outs.append(o)
+        try:
+            outs[0].run(str(tmp_path))
+            comps = outs[0]._comps
+            assert any(not c.fitted for c in comps)
+            ref = comps_snapshot(comps)
+            variant = GS.variant
+            runs = fil.runs
+            # The first output changes the components and the global variant
+            for c in comps:
+                c.fitted = not c.fitted
+                c.set_field('Value', 'CHANGED')
+                c.set_field('New', 'field')
+            GS.variant = None
+            # The second must get the list as it was after applying the filters
+            outs[1].run(str(tmp_path))
+            assert fil.runs == runs
+            assert comps_cache.hits == 1
+            assert comps_snapshot(outs[1]._comps) == ref
+            assert GS.variant == variant
+        finally:
+            comps_cache.clear()
+
+
+def sch_snapshot(sch):
+    return [(c.ref, c.value, c.fitted, [(f.name, f.value) for f in c.fields]) for c in sch.get_components()]
+
+
+class FakeKiCostPart(object):
+    """ The part created by KiCost for a group of components """
+    def __init__(self, comps):
+        self.kibot_group = self
+        self.components = comps
+
+
+@pytest.mark.indep
+def test_bom_overlays(tmp_path, monkeypatch):
+    """ The BoM works with copies of the components, the schematic must remain untouched """
+    sch_file = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'board_samples', 'kicad_7',
+                                            'light_control.kicad_sch'))
+    for attr in ('sch', 'sch_file', 'sch_fname', 'sch_basename', 'sch_no_ext', 'sch_dir', 'sch_last_dir', 'pcb_file',
+                 'sch_date', 'sch_rev', 'variant'):
+        monkeypatch.setattr(GS, attr, None)
+    with context.cover_it(cov):
+        load_actions()
+        init_globals()
+        GS.set_sch(sch_file)
+        load_sch()
+        monkeypatch.setitem(KiConf.kicad_env, 'KIBOT_TEST_VAR', 'EXPANDED')
+        ori = GS.sch.get_components()[0]
+        ori.set_field('Test', '${KIBOT_TEST_VAR}')
+        ori.set_field('manf#', 'PART_A; PART_B')
+        ref = sch_snapshot(GS.sch)
+        # A BoM using a reference prefix, text variables and the subparts filter
+        sp = RegFilter.get_class_for('subparts')()
+        sp.set_tree({'name': 'test_subparts', 'type': 'subparts'})
+        sp.config(None)
+        monkeypatch.setitem(RegOutput.get_filters(), 'test_subparts', sp)
+        out = RegOutput.get_class_for('bom')()
+        out.set_tree({'name': 'bom', 'type': 'bom', 'options': {'format': 'CSV', 'ref_id': 'B1:', 'group_fields': [],
+                      'pre_transform': 'test_subparts', 'columns': ['References', 'Value', 'Test', 'manf#']}})
+        out.config(None)
+        csv = str(tmp_path / 'bom.csv')
+        out.options.run(csv)
+        with open(csv, 'rt') as f:
+            bom = f.read()
+        assert 'B1:'+ori.ref+'#1' in bom
+        assert 'EXPANDED' in bom
+        assert 'PART_B' in bom
+        assert sch_snapshot(GS.sch) == ref
+        # The specs from KiCost must reach the schematic components, even for the subparts
+        comps = expand_fields(GS.sch.get_components())
+        parts = sp.filter(comps[0])
+        assert len(parts) == 2
+        assert all(c.original_copy is ori for c in parts)
+        kicost_part = FakeKiCostPart(parts)
+        copy_specs_to_components([kicost_part], None)
+        assert ori.kicost_part is kicost_part
+        assert all(c.kicost_part is kicost_part for c in parts)
+        assert sch_snapshot(GS.sch) == ref
+
+
+@pytest.mark.indep
+def test_sch_shared_font_effects(monkeypatch):
+    """ The fields share the font effects, changing a field must use a copy """
+    sch_file = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'board_samples', 'kicad_7',
+                                            'light_control.kicad_sch'))
+    with context.cover_it(cov):
+        load_actions()
+        init_globals()
+        monkeypatch.setattr(GS, 'global_cache_sch', False)
+        sch = load_any_sch(sch_file, 'light_control')
+    fields = [f for c in sch.get_components() for f in c.fields if f.effects is not None]
+    assert len({id(f.effects) for f in fields}) < len(fields)
+    # Two fields using the same object
+    by_id = {}
+    for f in fields:
+        by_id.setdefault(id(f.effects), []).append(f)
+    f, other = next(fs for fs in by_id.values() if len(fs) > 1)[:2]
+    effects = f.effects
+    key = effects.key()
+    visible = f.is_visible()
+    f.visible(not visible)
+    f.set_xy(f.x, f.y, hjustify='L' if effects.hjustify != 'L' else 'R')
+    assert f.effects is not effects
+    assert f.is_visible() != visible
+    assert f.effects.hjustify != effects.hjustify
+    # The shared object isn't affected
+    assert other.effects is effects
+    assert other.is_visible() == visible
+    assert effects.key() == key
+    assert v6_sch.FontEffects.shared[key] is effects
+
+
+def comp_state(c):
+    """ Slots and dict attributes of a component and its fields, the font effects are compared using its key """
+    attrs = get_attrs(c)
+    fields = []
+    for f in attrs.pop('fields'):
+        # The fields only have slots
+        fa = {n: getattr(f, n, None) for cls in type(f).__mro__ for n in getattr(cls, '__slots__', ())}
+        if fa.get('effects') is not None:
+            fa['effects'] = fa['effects'].key()
+        fields.append(fa)
+    return ({k: v for k, v in attrs.items() if isinstance(v, (str, int, float, bool, type(None)))}, fields)
+
+
+@pytest.mark.indep
+@pytest.mark.parametrize("sch_file", ['kicad_5/test_v5.sch', 'kicad_7/light_control.kicad_sch'])
+def test_sch_slots_pickle(monkeypatch, sch_file):
+    """ The schematics using slots can be stored in the cache (pickle) """
+    sch_file = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'board_samples', sch_file))
+    with context.cover_it(cov):
+        load_actions()
+        init_globals()
+        monkeypatch.setattr(GS, 'global_cache_sch', False)
+        sch = load_any_sch(sch_file, os.path.splitext(os.path.basename(sch_file))[0])
+    comps = sch.get_components()
+    # Attributes added by the outputs and filters, stored in the __dict__
+    comps[0].kibot_test = 'extra'
+    loaded = pickle.loads(pickle.dumps(sch, pickle.HIGHEST_PROTOCOL))
+    new_comps = loaded.get_components()
+    assert len(new_comps) == len(comps)
+    for c, n in zip(comps, new_comps):
+        assert comp_state(n) == comp_state(c), c.ref
+    assert new_comps[0].kibot_test == 'extra'
+    # The copies still work
+    n = new_comps[0].overlay()
+    n.set_field('Value', 'CHANGED')
+    assert new_comps[0].value != 'CHANGED'
+
+
+def mm(val):
+    """ Millimeters to KiCad internal units """
+    return int(round(val*1000000))
+
+
+class MockPoint(object):
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+
+    def __iter__(self):
+        return iter((self.x, self.y))
+
+
+class MockBBox(object):
+    def __init__(self, w, h):
+        self.w = w
+        self.h = h
+
+    def GetWidth(self):
+        return self.w
+
+    def GetHeight(self):
+        return self.h
+
+
+class MockPad(object):
+    def __init__(self, r):
+        self.drill = MockPoint(*r.choice([(0, 0), (0, 0), (mm(0.3), mm(0.3)), (mm(0.8), mm(0.8)), (mm(0.6), mm(1.2)),
+                                          (mm(1.2), mm(0.6)), (mm(1.0), mm(1.0)), (mm(0.35), mm(0.35))]))
+        self.size = MockPoint(*r.choice([(mm(0.3), mm(0.3)), (mm(1.0), mm(1.0)), (mm(0.5), mm(0.5)), (mm(1.6), mm(1.6)),
+                                         (mm(1.0), mm(1.8)), (mm(0.45), mm(0.45)), (mm(0.8), mm(0.8))]))
+        # 3 is PAD_ATTRIB_NPTH
+        self.attrib = r.choice([0, 0, 0, 3])
+        self.pos = MockPoint(mm(r.randint(0, 1000)/10), mm(r.randint(0, 1000)/10))
+
+    def GetDrillSize(self):
+        return self.drill
+
+    def GetSize(self):
+        return self.size
+
+    def GetAttribute(self):
+        return self.attrib
+
+    def GetPosition(self):
+        return self.pos
+
+    def GetLayer(self):
+        return 0
+
+
+class MockFPID(object):
+    def __init__(self, lib, name):
+        self.lib = lib
+        self.name = name
+
+    def GetLibItemName(self):
+        return self.name
+
+    def GetLibNickname(self):
+        return self.lib
+
+    def GetUniStringLibId(self):
+        return self.lib+':'+self.name
+
+
+class MockFootprint(object):
+    def __init__(self, r, n):
+        self.ref = r.choice(['R', 'C', 'U', 'J'])+str(n+1)
+        self.attrs = r.choice([0, 1, 2, 3, 4, 8, 9, 10, 16, 17])
+        self.layer = r.choice([0, 31, 31, 0, 5])
+        self.pads = [MockPad(r) for _ in range(r.randint(0, 8))]
+        self.value = r.choice(['10k', '100n', 'LM358'])
+        self.rot = r.choice([0.0, 90.0, 180.0, 45.0])
+        self.pos = MockPoint(mm(r.randint(0, 1000)/10), mm(r.randint(0, 1000)/10))
+        self.size = MockBBox(mm(r.randint(1, 100)/10), mm(r.randint(1, 100)/10))
+        self.fpid = MockFPID(r.choice(['Resistor_SMD', 'Package_SO']), r.choice(['R_0603', 'SOIC-8']))
+
+    def GetReference(self):
+        return self.ref
+
+    def GetAttributes(self):
+        return self.attrs
+
+    def GetLayer(self):
+        return self.layer
+
+    def Pads(self):
+        return self.pads
+
+    def GetValue(self):
+        return self.value
+
+    def IsFlipped(self):
+        return self.layer == 31
+
+    def GetOrientationDegrees(self):
+        return self.rot
+
+    def GetPosition(self):
+        return self.pos
+
+    def GetFpPadsLocalBbox(self):
+        return self.size
+
+    def GetFPID(self):
+        return self.fpid
+
+    def GraphicalItems(self):
+        return []
+
+    def GetProperties(self):
+        return {}
+
+
+class MockTrack(object):
+    def __init__(self, r):
+        self.cls = r.choice(['PCB_TRACK', 'PCB_TRACK', 'PCB_VIA', 'PCB_ARC'])
+        self.width = mm(r.choice([0.15, 0.2, 0.25, 0.5, 0.6, 0.8]))
+        self.drill = mm(r.choice([0.3, 0.4, 0.2]))
+        self.via_type = r.choice([3, 3, 2, 1])
+
+    def GetClass(self):
+        return self.cls
+
+    def GetWidth(self):
+        return self.width
+
+    def Cast(self):
+        return self
+
+    def GetDrill(self):
+        return self.drill
+
+    def GetViaType(self):
+        return self.via_type
+
+
+class MockDesignSettings(object):
+    m_TrackMinWidth = mm(0.2)
+    m_ViasMinSize = mm(0.5)
+    m_ViasMinDrill = mm(0.3)
+    m_MinThroughDrill = mm(0.3)
+    m_MicroViasAllowed = False
+    m_BlindBuriedViaAllowed = False
+    m_MicroViasMinSize = mm(0.2)
+    m_MicroViasMinDrill = mm(0.1)
+
+    def GetBoardThickness(self):
+        return mm(1.6)
+
+    def GetCopperLayerCount(self):
+        return 2
+
+    def GetSmallestClearanceValue(self):
+        return mm(0.2)
+
+    def GetAuxOrigin(self):
+        return MockPoint(0, 0)
+
+
+class MockBoard(object):
+    """ Random board with the methods used by the report, position and get_board_comps_data """
+    def __init__(self, seed, fps=150, tracks=1000):
+        r = random.Random(seed)
+        self.fps = [MockFootprint(r, n) for n in range(fps)]
+        self.tracks = [MockTrack(r) for _ in range(tracks)]
+
+    def GetDesignSettings(self):
+        return MockDesignSettings()
+
+    def ComputeBoundingBox(self, _):
+        return MockBBox(mm(100), mm(80))
+
+    def GetDrawings(self):
+        return []
+
+    def GetLayerID(self, name):
+        return {'F.Cu': 0, 'B.Cu': 31}.get(name, 40)
+
+    def IsLayerEnabled(self, _):
+        return True
+
+    def GetTracks(self):
+        return self.tracks
+
+    def GetFootprints(self):
+        return self.fps
+
+    def GetModules(self):
+        return self.fps
+
+    def GetViasDimensionsList(self):
+        return []
+
+    def GetTrackWidthList(self):
+        return []
+
+    def GetLayerName(self, layer):
+        return 'F.Cu'
+
+
+class MockSubPCB(object):
+    """ Moves the footprints, like the internal tool used to separate a sub-PCB """
+    name = 'mock'
+
+    def __init__(self, board, dx):
+        self.board = board
+        self.dx = dx
+
+    def move(self, dx):
+        for m in self.board.fps:
+            m.pos = MockPoint(m.pos.x+dx, m.pos.y)
+
+    def apply(self, comps_hash):
+        self.move(self.dx)
+
+    def revert(self, comps_hash):
+        self.move(-self.dx)
+
+
+def use_mock_board(monkeypatch, board):
+    monkeypatch.setattr(GS, 'board', board)
+    monkeypatch.setattr(GS, 'pcb_file', 'mock.kicad_pcb')
+    monkeypatch.setattr(kiplot, 'load_board', lambda *args, **kwargs: board)
+    monkeypatch.setattr(GS, 'global_include_components_from_pcb', True)
+    monkeypatch.setattr(GS, 'global_cache_board_snapshot', True)
+    monkeypatch.setattr(plot_cache, 'board_filter', None)
+    board_snapshot.clear()
+
+
+def board_comps_data(board):
+    """ The data from the footprints, read without the snapshot """
+    return sorted((m.GetReference(), m.GetValue(), m.IsFlipped(), m.GetOrientationDegrees(), m.GetPosition().x,
+                   m.GetPosition().y, m.GetFpPadsLocalBbox().GetWidth(), m.GetFpPadsLocalBbox().GetHeight())
+                  for m in board.GetFootprints())
+
+
+def comps_data(comps):
+    return sorted((c.ref, c.value, c.bottom, c.footprint_rot, c.footprint_x, c.footprint_y, c.footprint_w, c.footprint_h)
+                  for c in comps)
+
+
+def position_data(board, is_pure_smd, is_not_virtual):
+    """ The position file rows, computed without the snapshot """
+    rows = []
+    conv = GS.unit_name_to_scale_factor('millimeters')
+    for m in board.GetFootprints():
+        if not is_not_virtual(m.GetAttributes()):
+            continue
+        pos = m.GetPosition()
+        rows.append((m.GetReference(), m.GetValue(), m.GetFPID().GetLibItemName(), '{:.4f}'.format(pos.x*conv),
+                     '{:.4f}'.format(-pos.y*conv), '{:.4f}'.format(m.GetOrientationDegrees()),
+                     'bottom' if m.IsFlipped() else 'top'))
+    return sorted(rows)
+
+
+def run_position(tmp_path):
+    out = RegOutput.get_class_for('position')()
+    out.set_tree({'name': 'position', 'type': 'position', 'options': {'format': 'CSV', 'only_smd': False,
+                  'separate_files_for_front_and_back': False, 'output': 'pos.%x'}})
+    out.config(None)
+    out.options.run(str(tmp_path / 'pos.csv'))
+    with open(str(tmp_path / 'pos.csv'), 'rt') as f:
+        rows = [tuple(col.strip('"') for col in ln.split(',')) for ln in f.read().splitlines()[1:]]
+    return sorted(rows), out.options.get_attr_tests()
+
+
+def report_options():
+    out = RegOutput.get_class_for('report')()
+    out.set_tree({'name': 'report', 'type': 'report'})
+    out.config(None)
+    return out.options
+
+
+def report_vars(o):
+    """ The values available for the report templates """
+    return {k: v for k, v in o.__dict__.items() if not k.startswith('_parent') and not callable(v)}
+
+
+@pytest.mark.indep
+def test_board_snapshot(tmp_path, monkeypatch):
+    """ The data from the board snapshot is the same we get reading the board, also after moving the footprints """
+    if context.ki5():
+        pytest.skip('The mock board uses the KiCad 6+ API')
+    board = MockBoard(1)
+    with context.cover_it(cov):
+        load_actions()
+        init_globals()
+        use_mock_board(monkeypatch, board)
+        try:
+            # The tables
+            snapshot = board_snapshot.get()
+            fps = snapshot.footprints
+            assert fps.fp == board.fps
+            assert list(zip(fps.ref, fps.layer, fps.attrs, fps.package)) == [
+                   (m.ref, m.layer, m.attrs, m.fpid.name) for m in board.fps]
+            pads = [(p.drill.x, p.drill.y, p.size.x, p.size.y, p.attrib) for m in board.fps for p in m.pads if p.drill.x]
+            p = snapshot.pads
+            assert list(zip(p.drill_x, p.drill_y, p.size_x, p.size_y, p.attrib)) == pads
+            assert snapshot.tracks.width == [t.width for t in board.tracks if t.cls == 'PCB_TRACK']
+            v = snapshot.vias
+            assert list(zip(v.drill, v.width, v.type)) == [(t.drill, t.width, t.via_type) for t in board.tracks
+                                                           if t.cls == 'PCB_VIA']
+            # The data used by the filters/variants
+            comps = []
+            get_board_comps_data(comps)
+            ref_comps = board_comps_data(board)
+            assert comps_data(comps) == ref_comps
+            # Position
+            rows, tests = run_position(tmp_path)
+            ref_rows = position_data(board, *tests)
+            assert rows == ref_rows
+            assert board_snapshot.hits >= 1
+            # Report, the cached snapshot gives the same results
+            o = report_options()
+            o.collect_data(board)
+            monkeypatch.setattr(GS, 'global_cache_board_snapshot', False)
+            o2 = report_options()
+            o2.collect_data(board)
+            assert report_vars(o) == report_vars(o2)
+            assert o.vias_count == len(v.drill)
+            assert o._tracks_m == Counter(t.width for t in board.tracks if t.cls == 'PCB_TRACK')
+            monkeypatch.setattr(GS, 'global_cache_board_snapshot', True)
+            # Internal sub-PCB, the footprints are moved
+            var = VariantOptions()
+            var._sub_pcb = MockSubPCB(board, mm(50))
+            var.filter_pcb_components()
+            moved = board_comps_data(board)
+            assert moved != ref_comps
+            comps = []
+            get_board_comps_data(comps)
+            assert comps_data(comps) == moved
+            rows, _ = run_position(tmp_path)
+            assert rows == position_data(board, *tests)
+            assert rows != ref_rows
+            var.unfilter_pcb_components()
+            comps = []
+            get_board_comps_data(comps)
+            assert comps_data(comps) == ref_comps
+            rows, _ = run_position(tmp_path)
+            assert rows == ref_rows
+        finally:
+            board_snapshot.clear()
+
+
+def report_by_object(o, board):
+    """ The report statistics computed for each via and pad, without grouping them by size.
+        The OAR warnings are sent by `o` """
+    tracks = Counter()
+    vias = Counter()
+    vias_ec = set()
+    via_types = Counter()
+    drills = Counter()
+    drills_oval = Counter()
+    drills_real = Counter()
+    drills_ec = Counter()
+    o.oar_vias = o.oar_vias_ec = o.oar_pads = o.oar_pads_ec = INF
+    for t in board.GetTracks():
+        if t.GetClass() == 'PCB_TRACK':
+            tracks[t.GetWidth()] += 1
+        elif t.GetClass() == 'PCB_VIA':
+            via = t.Cast()
+            d = adjust_drill(via.GetDrill())
+            oar, oar_ec, d_ec = o.compute_oar(via.GetWidth(), d)
+            o.oar_vias = min(o.oar_vias, oar)
+            o.oar_vias_ec = min(o.oar_vias_ec, oar_ec)
+            vias[(via.GetDrill(), via.GetWidth())] += 1
+            vias_ec.add((d_ec, via.GetWidth()))
+            via_types[via.GetViaType()] += 1
+            drills_real[d] += 1
+            drills_ec[d_ec] += 1
+    pad_drill = pad_drill_real = pad_drill_real_ec = slot = INF
+    for m in board.GetFootprints():
+        for pad in m.Pads():
+            dr = pad.GetDrillSize()
+            if not dr.x:
+                continue
+            size = pad.GetSize()
+            is_pth = pad.GetAttribute() != 3
+            dr_x_real = adjust_drill(dr.x, is_pth)
+            dr_y_real = adjust_drill(dr.y, is_pth)
+            pad_drill = min(dr.x, dr.y, pad_drill)
+            pad_drill_real = min(dr_x_real, dr_y_real, pad_drill_real)
+            if dr.x == dr.y:
+                drills[dr.x] += 1
+                drills_real[dr_x_real] += 1
+            else:
+                drills_oval[(min(dr.x, dr.y), max(dr.x, dr.y))] += 1
+                slot = min(slot, dr.x, dr.y)
+                drills_real[dr_x_real if dr.x < dr.y else dr_y_real] += 1
+            oar_x, oar_ec_x, dr_x_ec = o.compute_oar(size.x, dr_x_real)
+            oar_y, oar_ec_y, dr_y_ec = o.compute_oar(size.y, dr_y_real)
+            dr_ec = min(dr_x_ec, dr_y_ec)
+            drills_ec[dr_ec] += 1
+            pad_drill_real_ec = min(dr_ec, pad_drill_real_ec)
+            o.analyze_oar(min(oar_x, oar_y), min(oar_ec_x, oar_ec_y), is_pth, GS.from_mm(0.1), [pad], dr_x_real, dr_y_real,
+                          (size.x, size.y), (dr.x, dr.y))
+    return {'track': min(tracks), '_tracks_m': tracks, '_vias_m': sorted(vias), '_vias_ec_m': sorted(vias_ec),
+            'vias_count': sum(vias.values()), 'thru_vias_count': via_types[VIATYPE_THROUGH],
+            'blind_vias_count': via_types[VIATYPE_BLIND_BURIED], 'micro_vias_count': via_types[VIATYPE_MICROVIA],
+            'oar_vias': o.oar_vias, 'oar_vias_ec': o.oar_vias_ec, 'oar_pads': o.oar_pads, 'oar_pads_ec': o.oar_pads_ec,
+            '_drills': drills, '_drills_oval': drills_oval, '_drills_real': drills_real, '_drills_ec': drills_ec,
+            'pad_drill': pad_drill, 'pad_drill_real': pad_drill_real, 'pad_drill_real_ec': pad_drill_real_ec, 'slot': slot}
+
+
+def oar_warnings():
+    """ OAR warnings and how many times we got them, the logger doesn't repeat them """
+    warnings = Counter({k: v for k, v in log.MyLogger.warn_hash.items() if k.startswith(W_WRONGOAR)})
+    log.MyLogger.reset_warn_hash()
+    return warnings
+
+
+@pytest.mark.indep
+@pytest.mark.parametrize("seed", [1, 2])
+def test_report_grouped_sizes(monkeypatch, seed):
+    """ The report statistics computed for each size are the ones we get for each via and pad.
+        The OAR warnings are computed for each group of pads with the same size, but we get one for each pad """
+    if context.ki5():
+        pytest.skip('The mock board uses the KiCad 6+ API')
+    board = MockBoard(seed)
+    with context.cover_it(cov):
+        load_actions()
+        init_globals()
+        use_mock_board(monkeypatch, board)
+        log.MyLogger.reset_warn_hash()
+        try:
+            o = report_options()
+            o.collect_data(board)
+            warnings = oar_warnings()
+            # Templates use the public values, most of them computed from these
+            ref_vars = report_vars(o)
+            ref = report_by_object(report_options(), board)
+            assert {k: ref_vars[k] for k in ref} == ref
+            assert oar_warnings() == warnings
+            # The mock board has pads with OAR problems and most of them share the size
+            pads = board_snapshot.get(board).pads
+            groups = set(zip(pads.drill_x, pads.drill_y, pads.size_x, pads.size_y, pads.attrib))
+            assert sum(warnings.values()) > len(groups)
+        finally:
+            board_snapshot.clear()
+
+
+def parallel_task(n):
+    """ Finishes in a different order and reports warnings, one of them repeated """
+    time.sleep((5-n)*0.05)
+    kiplot.logger.warning(f'Parallel task {n}')
+    if n == 3:
+        kiplot.logger.warning('Parallel task 3')
+    if n == 4 and GS.debug_level == -10:
+        sys.exit(5)
+    return n*n
+
+
+@pytest.mark.indep
+def test_run_in_parallel(monkeypatch):
+    """ The results keep the order of the tasks, and the warnings from the workers are counted """
+    with context.cover_it(cov):
+        monkeypatch.setattr(log.MyLogger, 'warn_hash', {})
+        for use_processes in (False, True):
+            log.MyLogger.reset_warn_hash()
+            counters = log.get_warn_counters()
+            unique = log.MyLogger.warn_cnt
+            assert kiplot.run_in_parallel(parallel_task, list(range(6)), 3, use_processes=use_processes) == \
+                [n*n for n in range(6)]
+            total, _, warnings = log.get_warn_counters(counters)
+            assert total == 7
+            assert warnings == {f'Parallel task {n}': 2 if n == 3 else 1 for n in range(6)}
+            assert log.MyLogger.warn_cnt-unique == 6
+        # An error in a worker stops the run
+        monkeypatch.setattr(GS, 'debug_level', -10)
+        with pytest.raises(SystemExit) as e:
+            kiplot.run_in_parallel(parallel_task, list(range(6)), 3, use_processes=True)
+        assert e.value.code == 5
+        monkeypatch.setattr(GS, 'debug_level', 0)
+        # Warnings from the workers are errors when using --stop-on-warnings
+        log.MyLogger.reset_warn_hash()
+        monkeypatch.setattr(log, 'stop_on_warnings', True)
+        with pytest.raises(SystemExit) as e:
+            kiplot.run_in_parallel(parallel_task, list(range(6)), 3, use_processes=True)
+        assert e.value.code == WARN_AS_ERROR
+
+
+class FakePage(object):
+    colored_holes = False
+    holes_color = '#FFFFFF'
+    monochrome = False
+
+
+def make_layer(fname, name, width=1000, height=500, groups=3):
+    """ A layer like the ones plotted by KiCad, the groups are identified using `name` """
+    with open(fname, 'wt') as f:
+        f.write('<?xml version="1.0" standalone="no"?>\n')
+        f.write(f'<svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" width="{width/10}mm" '
+                f'height="{height/10}mm" viewBox="0 0 {width} {height}">\n')
+        f.write(f'<title>{name}</title>\n')
+        for n in range(groups):
+            f.write(f'<g id="{name}-{n}" style="fill:#000000; stroke:#000000;">\n')
+            f.write(f'<path d="M{n} {n} L{width-n} {height-n}"/>\n<text x="{n}" y="{n}">{name} &amp; {n}</text>\n</g>\n')
+        f.write('</svg>\n')
+
+
+def group_ids(fname):
+    from lxml import etree
+    return [e.get('id') for e in etree.parse(fname).getroot().iter('{http://www.w3.org/2000/svg}g') if e.get('id')]
+
+
+@pytest.mark.indep
+def test_pcb_print_parallel_merge(tmp_path, monkeypatch):
+    """ The pages merged by the workers contain their own layers, in order """
+    with context.cover_it(cov):
+        load_actions()
+        o = RegOutput.get_class_for('pcb_print')().options()
+        # Loaded when running the output
+        monkeypatch.setitem(type(o).merge_svg.__globals__, 'svgutils', svgutils)
+        o.format = 'SVG'
+        o.plot_sheet_reference = False
+        merges = []
+        for page in range(5):
+            files = []
+            for la in range(3):
+                name = f'page{page}-layer{la}'
+                make_layer(str(tmp_path / (name+'.svg')), name)
+                files.append((name+'.svg', '#FF0000'))
+            merges.append((str(tmp_path), files, str(tmp_path), f'page{page}.svg', FakePage(), None))
+        kiplot.run_in_parallel(o.merge_page, merges, 3, use_processes=True)
+        for page in range(5):
+            ids = [f'page{page}-layer{la}-{n}' for la in range(3) for n in range(3)]
+            assert group_ids(str(tmp_path / f'page{page}.svg')) == ids
+
+
+def old_merge_svg(input_files, output_file):
+    """ How the layers were merged using svgutils, the whole tree in memory """
+    first = True
+    for file, color in input_files:
+        with open(file, 'rt') as f:
+            content = f.read().replace('#000000', color)
+        new_layer = svgutils.fromstring(content)
+        width = float(new_layer.root.get('viewBox').split(' ')[2])
+        if first:
+            svg_out = new_layer
+            base_width = width
+            first = False
+        else:
+            root = new_layer.getroot()
+            scale = base_width/width
+            if scale != 1.0:
+                for e in root:
+                    e.scale(scale)
+            svg_out.append([root])
+    svg_out.save(output_file)
+
+
+def svg_tree(fname):
+    """ All the elements, ignoring the white spaces between them """
+    from lxml import etree
+    return [(e.tag, sorted(e.attrib.items()), (e.text or '').strip(), (e.tail or '').strip())
+            for e in etree.parse(fname).getroot().iter()]
+
+
+@pytest.mark.indep
+@pytest.mark.parametrize("first", ['normal', 'empty'])
+def test_pcb_print_merge_svg(tmp_path, monkeypatch, first):
+    """ The layers spliced at the end of the page are the same we got merging the trees """
+    with context.cover_it(cov):
+        load_actions()
+        o = RegOutput.get_class_for('pcb_print')().options()
+        # Loaded when running the output
+        monkeypatch.setitem(type(o).merge_svg.__globals__, 'svgutils', svgutils)
+        o.format = 'SVG'
+        o.plot_sheet_reference = False
+        page = str(tmp_path / 'page.svg')
+        if first == 'empty':
+            # The root is self-closing when saved
+            with open(page, 'wt') as f:
+                f.write('<svg xmlns="http://www.w3.org/2000/svg" width="100mm" height="50mm" viewBox="0 0 1000 500"/>\n')
+        else:
+            make_layer(page, 'page')
+        files = [(page, '#000000')]
+        for la, width in enumerate([1000, 2000, 1000]):
+            name = str(tmp_path / f'layer{la}.svg')
+            make_layer(name, f'layer{la}', width=width, height=width//2)
+            files.append((name, '#FF000080'))
+        # The raw content is the same we get from the decoded string
+        with open(files[1][0], 'rb') as f:
+            data = f.read()
+        assert svgutils.frombytes(data).to_str() == svgutils.fromstring(data.decode()).to_str()
+        o.merge_svg('/', files, str(tmp_path), 'new.svg', FakePage())
+        old_merge_svg([(f, c[:7]) for f, c in files], str(tmp_path / 'old.svg'))
+        new = svg_tree(str(tmp_path / 'new.svg'))
+        assert new == svg_tree(str(tmp_path / 'old.svg'))
+        # All the layers are there, the title and the groups of the second one scaled
+        assert len([e for e in new if 'scale(0.5 0.5)' in dict(e[1]).get('transform', '')]) == 4
+        widths = ([1000] if first == 'normal' else []) + [1000, 2000, 1000]
+        paths = [[('d', f'M{n} {n} L{w-n} {w//2-n}')] for w in widths for n in range(3)]
+        assert [e[1] for e in new if e[0].endswith('}path')] == paths
+
+
+def make_diff_entry(cache_dir, name, size, mtime):
+    os.makedirs(os.path.join(cache_dir, name, 'pcb'))
+    with open(os.path.join(cache_dir, name, 'pcb', 'layer.svg'), 'wb') as f:
+        f.write(b'x'*size)
+    os.utime(os.path.join(cache_dir, name), (mtime, mtime))
+
+
+class FakeKiDiff(object):
+    """ Creates the cache entries and the comparison results.
+        The first comparison using an entry adds files to it, we check nobody else is using it meanwhile """
+    def __init__(self, calls):
+        self.calls = calls
+        self.lock = threading.Lock()
+        self.writing = set()
+
+    def __call__(self, cmd, just_raise=False):
+        self.calls.append(cmd)
+        cache_dir = cmd[cmd.index('--cache_dir')+1]
+        old_hash = cmd[cmd.index('--old_file_hash')+1]
+        if '--only_cache' in cmd:
+            entry = os.path.join(cache_dir, old_hash)
+            if not os.path.isdir(entry):
+                make_diff_entry(cache_dir, old_hash, 1024, time.time())
+            return
+        new_hash = cmd[cmd.index('--new_file_hash')+1]
+        cold = [h for h in (old_hash, new_hash) if not os.path.isfile(os.path.join(cache_dir, h, 'pcb', 'page.png'))]
+        with self.lock:
+            assert not self.writing & set(cold)
+            self.writing |= set(cold)
+        time.sleep(0.05)
+        for h in cold:
+            with open(os.path.join(cache_dir, h, 'pcb', 'page.png'), 'wt') as f:
+                f.write(h)
+        with self.lock:
+            self.writing -= set(cold)
+        out = os.path.join(cmd[cmd.index('--output_dir')+1], cmd[cmd.index('--output_name')+1])
+        with open(out, 'wt') as f:
+            f.write(f'{old_hash} vs {new_hash}: {cmd[-2]} {cmd[-1]}\n')
+
+
+def diff_options(monkeypatch, calls):
+    """ A diff output using the shared cache, KiDiff is simulated """
+    o = RegOutput.get_class_for('diff')().options()
+    kidiff = FakeKiDiff(calls)
+    monkeypatch.setitem(type(o).add_to_cache.__globals__, 'run_command', kidiff)
+    monkeypatch.setitem(type(o).run_compare.__globals__, 'run_command', kidiff)
+    o.command = 'kidiff'
+    o.incl_file = None
+    o._to_remove = []
+    o.cache_dir = o.get_shared_cache_dir()
+    o._shared_cache = True
+    return o
+
+
+@pytest.mark.indep
+def test_diff_cache_evict(tmp_path, monkeypatch):
+    """ The least recently used entries are removed until the cache fits, entries in use are kept """
+    cache_dir = str(tmp_path)
+    with context.cover_it(cov):
+        load_actions()
+        monkeypatch.setattr(GS, 'global_cache_diff_dir', cache_dir)
+        o = diff_options(monkeypatch, [])
+        evict_diff_cache = type(o).run.__globals__['evict_diff_cache']
+        for n in range(4):
+            make_diff_entry(cache_dir, f'hash{n}', 400*1024, 1000+n)
+        # Recently used
+        os.utime(os.path.join(cache_dir, 'hash0'), (2000, 2000))
+        # Fits, nothing removed
+        evict_diff_cache(cache_dir, 1600*1024)
+        assert sorted(os.listdir(cache_dir)) == ['hash0', 'hash1', 'hash2', 'hash3']
+        evict_diff_cache(cache_dir, 1000*1024)
+        assert sorted(os.listdir(cache_dir)) == ['.locks', 'hash0', 'hash3']
+        # The oldest entry is in use by another job
+        with o.locked_cache('hash3', shared=('hash3',)):
+            evict_diff_cache(cache_dir, 500*1024)
+            assert sorted(os.listdir(cache_dir)) == ['.locks', 'hash3']
+        # Using it marked it as recently used
+        assert os.path.getmtime(os.path.join(cache_dir, 'hash3')) > 2000
+
+
+@pytest.mark.indep
+def test_diff_cache_shared(tmp_path, monkeypatch):
+    """ Two outputs comparing the same file use the same cache entry """
+    cache_dir = str(tmp_path / 'cache')
+    pcb = str(tmp_path / 'board.kicad_pcb')
+    with open(pcb, 'wt') as f:
+        f.write('(kicad_pcb (version 20171130) (host pcbnew 5.1.5))\n')
+    with context.cover_it(cov):
+        load_actions()
+        monkeypatch.setattr(GS, 'global_cache_diff_dir', cache_dir)
+        calls = []
+        o1 = diff_options(monkeypatch, calls)
+        o2 = diff_options(monkeypatch, calls)
+        assert o1.cache_dir == o2.cache_dir == cache_dir
+        hash = o1.cache_pcb(pcb, False)
+        assert o1.name_used_for_cache == pcb
+        entry = os.path.join(cache_dir, hash)
+        os.utime(entry, (1000, 1000))
+        make_diff_entry(cache_dir, 'other', 1024, 2000)
+        assert o2.cache_pcb(pcb, False) == hash
+        assert o2.name_used_for_cache == pcb
+        assert [c[c.index('--cache_dir')+1] for c in calls] == [cache_dir, cache_dir]
+        # The second output marked it as recently used, so the other entry is removed first
+        assert os.path.getmtime(entry) > 2000
+        type(o1).run.__globals__['evict_diff_cache'](cache_dir, 1500)
+        assert sorted(os.listdir(cache_dir)) == ['.locks', hash]
+
+
+@pytest.mark.indep
+def test_diff_run_compares(tmp_path, monkeypatch):
+    """ The comparisons done in parallel give the same results, each file is added to the cache only once """
+    boards = []
+    for n in range(4):
+        pcb = str(tmp_path / f'board{n}.kicad_pcb')
+        with open(pcb, 'wt') as f:
+            f.write(f'(kicad_pcb (version 20171130) (host pcbnew 5.1.5) (comment {n}))\n')
+        boards.append(pcb)
+    results = {}
+    with context.cover_it(cov):
+        load_actions()
+        for jobs in (1, 3):
+            monkeypatch.setattr(GS, 'global_cache_diff_dir', str(tmp_path / f'cache_{jobs}'))
+            out_dir = tmp_path / f'out_{jobs}'
+            out_dir.mkdir()
+            calls = []
+            o = diff_options(monkeypatch, calls)
+            o.jobs = jobs
+            o._cached_objs = {}
+            compares = []
+            for old, new in itertools.combinations(boards, 2):
+                name = str(out_dir / (os.path.basename(old)+'-'+os.path.basename(new)+'.pdf'))
+                compares.append(o.prepare_compare(old, 'file', new, 'file', name, name))
+            assert len([c for c in calls if '--only_cache' in c]) == len(boards)
+            o.run_compares(compares)
+            results[jobs] = {f: (out_dir / f).read_text() for f in os.listdir(str(out_dir))}
+            cache = {h: sorted(os.listdir(os.path.join(o.cache_dir, h, 'pcb'))) for h in os.listdir(o.cache_dir)
+                     if not h.startswith('.')}
+            assert cache == {c.old_hash: ['layer.svg', 'page.png'] for c in compares} | \
+                   {c.new_hash: ['layer.svg', 'page.png'] for c in compares}
+        assert len(results[1]) == 6
+        assert results[1] == results[3]
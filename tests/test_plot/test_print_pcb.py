@@ -99,6 +99,26 @@ def test_print_variant_1(test_dir):
     ctx.clean_up(keep_project=True)
 
 
+@pytest.mark.slow
+@pytest.mark.pcbnew
+def test_print_pcb_cache_1(test_dir):
+    """ The plots are reused only when the layers, options and variant are the same """
+    prj = 'kibom-variant_3_txt'
+    ctx = context.TestContext(test_dir, prj, 'pcb_print_cache_1')
+    ctx.run()
+    svgs = {}
+    for name in ('fab_1', 'fab_2', 'fab_variant', 'cu'):
+        ctx.expect_out_file(name+'.svg')
+        with open(ctx.get_out_path(name+'.svg'), 'rt') as f:
+            svgs[name] = f.read()
+    assert svgs['fab_1'] == svgs['fab_2']
+    assert svgs['fab_variant'] != svgs['fab_1']
+    assert svgs['cu'] != svgs['fab_1']
+    # Only `fab_2` reused the plot of the F.Fab layer
+    ctx.search_err(r'Layer plots cache: \d+ plots, reused 1 times')
+    ctx.clean_up(keep_project=True)
+
+
 @pytest.mark.slow
 @pytest.mark.pcbnew
 def test_print_pcb_options(test_dir):
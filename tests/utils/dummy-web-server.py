@@ -43,6 +43,7 @@ OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 """
 import argparse
 import errno
+from hashlib import sha1
 import os.path as op
 import sys
 import time
@@ -50,6 +51,7 @@ from urllib.parse import unquote
 from http.server import HTTPServer, BaseHTTPRequestHandler
 queries = {}
 comments = {}
+failed = set()
 
 
 class S(BaseHTTPRequestHandler):
@@ -67,6 +69,17 @@ class S(BaseHTTPRequestHandler):
         return content.encode("utf8")  # NOTE: must return a bytes object!
 
     def do_GET(self):
+        if self.path.startswith('/flaky/') and self.path not in failed:
+            # Fail the first time, used to test retries
+            failed.add(self.path)
+            print(f'Simulating a failure for {self.path}')
+            self.send_response(503)
+            self.end_headers()
+            return
+        if self.path.endswith('.pdf'):
+            # Fake datasheets, support ETag to test caches
+            self.datasheet()
+            return
         self._set_headers()
         if self.path.startswith('/api/'):
             self.easyeda_api(self.path[5:])
@@ -77,6 +90,21 @@ class S(BaseHTTPRequestHandler):
         else:
             self.wfile.write(self._html(self.path))
 
+    def datasheet(self):
+        etag = '"{}"'.format(sha1(self.path.encode()).hexdigest())
+        if self.headers.get('If-None-Match') == etag:
+            print(f'Datasheet not modified {self.path}')
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        print(f'Datasheet request {self.path}')
+        self.send_response(200)
+        self.send_header("Content-type", "application/pdf")
+        self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(self._html(self.path))
+
     def easyeda_api(self, component):
         print(f'EasyEDA api request for {component}')
         with open(op.join(op.dirname(__file__), '../data/EasyEDA_API_C181094.json'), 'rb') as f: